@@ -1,22 +1,122 @@
 import numpy as np
 import copy
-from math import log, exp
-from multiprocessing import Pool
+import threading
+from multiprocessing import Pool, cpu_count, current_process
+from multiprocessing.pool import ThreadPool
 
-from src.mcmc import Chain, Ladder
+from src.mcmc import Chain, Chain_xyz, Ladder
 from src.mcmc_biased import Chain_biased, Ladder_biased
 from src.mcmc_alpha import Chain_alpha, Ladder_alpha
+from src.fingerprint import unique_chains
+from src.sketch import Length_sketches
+from src.parallel_tempering import parallel_tempering
+from src.packed_model import code_lattice
+from src.batch import pack_chains, _ewd_batch, _single_temp_batch
+from src.lattice import _log_weight
+from src.rng import random_seed, stream_seed, seed_task
 
 
-def MCMC(init_code, p, Nc=None, SEQ=2, TOPS=10, tops_burn=2, eps=0.1, steps=50000000, iters=10, conv_criteria='error_based'):
+class DecoderSession():
+    '''
+    Long lived pool of worker processes, started once and used by the decoders for every syndrome instead of a new
+    Pool per call. The workers are warmed up when they start: they decode a small syndrome of the model of code
+    (a distance 3 planar code by default), which loads the compiled kernels. Pass it as session to EWD(_N_n),
+    EWD_alpha(_N_n), EWD_general_noise(_shortest) and the MCMC decoders, and close it when done or use it as a
+    context manager:
+        with DecoderSession(4) as session:
+            EWD(init_code, p_error, droplets=4, session=session)
+    With backend='thread' the workers are threads of this process instead, which share its memory: nothing is
+    pickled, and the compiled kernels release the GIL so that the droplets and the ladders of several syndromes
+    run at the same time.
+    '''
+    def __init__(self, processes=None, code=None, backend='process'):
+        assert backend in ('process', 'thread'), 'backend has to be process or thread'
+        self.processes = processes or cpu_count()
+        self.backend = backend
+        pool = ThreadPool if backend == 'thread' else Pool
+        self.pool = pool(self.processes, initializer=_warm_up, initargs=(code,))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # func(*args) run in one of the workers
+    def run(self, func, *args):
+        return self.pool.apply(func, args)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    # stops the workers without finishing their tasks, the session can only be closed afterwards
+    def terminate(self):
+        self.pool.terminate()
+        self.pool.join()
+
+
+def _warm_up(code):
+    # forked workers start from the random state of the parent, every worker draws a state of its own
+    seed_task(random_seed())
+
+    # one short run of the droplets and the tempering loop, so that the kernels are compiled or loaded from the cache
+    if code is None:
+        from src.planar_model import Planar_code
+        code = Planar_code(3)
+    code = type(code)(code.system_size)
+    EWD_droplet(Chain(0.1, copy.deepcopy(code)), 2, True, 0)
+    EWD_droplet_general_noise(Chain_xyz(np.full(3, 0.05), copy.deepcopy(code)), 2, True)
+    MCMC(code, 0.1, Nc=2, steps=2, conv_criteria=None)
+
+
+def _run_droplets(session, func, class_args, seed=None, backend='process'):
+    # runs func(*args) for every (class, droplet) pair, args = class_args[eq][k], as independent tasks submitted all
+    # at once, so that the classes run in parallel as well as the droplets. Returns the outputs of each class.
+    # With a seed each task draws from its own stream (seed, eq, k), see rng.py
+    # The tasks run in the workers of the session, or in a pool closed on return if there are several droplets
+    # per class, and in this thread otherwise (also in a worker of a pool, which does not start one of its own).
+    # With backend='thread' (or a thread session) the pool is one of threads sharing the chains of the caller
+    tasks = [(func, None if seed is None else stream_seed(seed, eq, k), args)
+             for eq, droplet_args in enumerate(class_args) for k, args in enumerate(droplet_args)]
+    droplets = max(len(droplet_args) for droplet_args in class_args)
+    if session is not None:
+        outputs = session.pool.starmap(_run_task, tasks, chunksize=1)
+    elif droplets > 1 and backend == 'thread':
+        with ThreadPool(min(len(tasks), cpu_count())) as pool:
+            outputs = pool.starmap(_run_task, tasks, chunksize=1)
+    elif droplets > 1 and not current_process().daemon and threading.current_thread() is threading.main_thread():
+        with Pool(min(len(tasks), cpu_count())) as pool:
+            outputs = pool.starmap(_run_task, tasks, chunksize=1)
+    else:
+        outputs = [_run_task(*task) for task in tasks]
+    bounds = np.cumsum([0] + [len(droplet_args) for droplet_args in class_args])
+    return [outputs[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def _run_task(func, seed, args):
+    if seed is not None:
+        seed_task(seed)
+    return func(*args)
+
+
+def _rain(chain):
+    # Start in high energy state, uniformly random stabilizers applied to the chain
+    chain.code.qubit_matrix = code_lattice(chain.code).apply_stabilizers_uniform(chain.code.qubit_matrix)
+
+
+def MCMC(init_code, p, Nc=None, SEQ=2, TOPS=10, tops_burn=2, eps=0.1, steps=50000000, iters=10, conv_criteria='error_based', session=None, seed=None):
     '''
     Original MCMC Parallel tempering method as descibed in high threshold paper
     Parameters also adapted from that paper.
     steps has an upper limit on 50 000 000, which should not be met during operation
     '''
-    # either 4 or 16 depending on choice of code topology
-    nbr_eq_classes = init_code.nbr_eq_classes
-
+    # run in a warm worker of the session
+    if session is not None:
+        return session.run(MCMC, init_code, p, Nc, SEQ, TOPS, tops_burn, eps, steps, iters, conv_criteria, None, seed)
+    # the ladder draws from the stream of the syndrome
+    if seed is not None:
+        seed_task(stream_seed(seed))
     # If not specified, use size as per paper
     Nc = Nc or init_code.system_size
 
@@ -24,78 +124,18 @@ def MCMC(init_code, p, Nc=None, SEQ=2, TOPS=10, tops_burn=2, eps=0.1, steps=5000
     if tops_burn >= TOPS:
         print('tops_burn has to be smaller than TOPS')
 
-    # initialize variables
-    since_burn = 0
-    resulting_burn_in = 0
-    nbr_errors_bottom_chain = np.zeros(steps)
-
-    # list of class counts after burn in
-    eq = np.zeros([steps, nbr_eq_classes], dtype=np.uint32)
-
-    # used in error_based/majority_based instead of setting tops0 = TOPS
-    conv_start = 0
-    conv_streak = 0
-
-    # Convergence flag
-    convergence_reached = False
-
     # initialize ladder of chains sampled at different temperatures
     ladder = Ladder(p, init_code, Nc, 0.5)
 
-    # Main loop that runs until convergence or max steps (steps) are reached
-    for step in range(steps):
-        # run metropolis on every chain and perform chain swaps
-        ladder.step(iters)
-
-        # Get sample from eq-class of chain in lowest layer of ladder
-        current_eq = ladder.chains[0].code.define_equivalence_class()
-
-        # Start saving stats once burn-in period is over
-        if ladder.tops0 >= tops_burn:
-            since_burn = step - resulting_burn_in
+    # Main loop that runs until convergence or max steps (steps) are reached, in one compiled kernel.
+    # Convergence is checked on the number of errors in the bottom chain
+    result = parallel_tempering(ladder, iters, steps, TOPS, tops_burn, SEQ, eps, conv_criteria)
 
-            eq[since_burn] = eq[since_burn - 1]
-            eq[since_burn][current_eq] += 1
-            nbr_errors_bottom_chain[since_burn] = ladder.chains[0].code.count_errors()
-        else:
-            # number of steps until tops0 = 2
-            resulting_burn_in += 1
-
-        # Check for convergence every 10 samples if burn-in period is over (and conv-crit is set)
-        if conv_criteria == 'error_based' and ladder.tops0 >= TOPS:
-            accept, convergence_reached = conv_crit_error_based_PT(nbr_errors_bottom_chain, since_burn, conv_streak, SEQ, eps)
-            if accept:
-                if convergence_reached:
-                    break
-                conv_streak = ladder.tops0 - conv_start
-            else:
-                conv_streak = 0
-                conv_start = ladder.tops0
-    
     # print warning if loop is exited without convergence
-    else:
-        if conv_criteria == 'error_based':
-            print('\n\nWARNING: MCMC hit max number of steps before convergence:\t', step + 1, '\n\n')
+    if conv_criteria == 'error_based' and not result['converged']:
+        print('\n\nWARNING: MCMC hit max number of steps before convergence:\t', result['step'] + 1, '\n\n')
 
-    return (np.divide(eq[since_burn], since_burn + 1) * 100).astype(np.uint8)
-
-
-def conv_crit_error_based_PT(nbr_errors_bottom_chain, since_burn, tops_accepted, SEQ, eps):
-    '''
-    convergence criteria used in paper and called ''felkriteriet''
-    '''
-    # last nonzero element of nbr_errors_bottom_chain is since_burn. Length of nonzero part is since_burn + 1
-    l = since_burn + 1
-    # Calculate average number of errors in 2nd and 4th quarter
-    Average_Q2 = np.average(nbr_errors_bottom_chain[(l // 4): (l // 2)])
-    Average_Q4 = np.average(nbr_errors_bottom_chain[(3 * l // 4): l])
-
-    # Compare averages
-    error = abs(Average_Q2 - Average_Q4)
-    if error < eps:
-        return True, tops_accepted >= SEQ
-    else:
-        return False, False
+    return (np.divide(result['counts'], result['since_burn'] + 1) * 100).astype(np.uint8)
 
 
 def single_temp(init_code, p, max_iters):
@@ -121,7 +161,7 @@ def single_temp(init_code, p, max_iters):
     for eq in range(nbr_eq_classes):
         for j in range(max_iters):
             chains[eq].update_chain_fast(5)
-            nbr_errors_chain[eq ,j] = chains[eq].code.count_errors()
+            nbr_errors_chain[eq ,j] = chains[eq].count_errors()
             if j == max_iters-1:
                 mean_array[eq] = np.average(nbr_errors_chain[eq ,:j])
 
@@ -150,51 +190,63 @@ def single_temp_alpha(init_code, pz_tilde, alpha, max_iters):
     for eq in range(nbr_eq_classes):
         for j in range(max_iters):
             chains[eq].update_chain_fast(5)
-            nx, ny, nz = chains[eq].code.chain_lengths()
-            n_eff = nz + alpha*(nx + ny)
-            nbr_errors_chain[eq ,j] = n_eff
+            nbr_errors_chain[eq ,j] = chains[eq].n_eff
             if j == max_iters-1:
                 mean_array[eq] = np.average(nbr_errors_chain[eq ,:j])
 
     return mean_array
 
 
-def EWD_droplet(chain, steps, randomize, conv_mult):
-    # All unique chains will be saved in samples
-    samples = {}
+def EWD_droplet(chain, steps, randomize, conv_mult, prune=0, log_weights=None):
+    if randomize:
+        _rain(chain)
 
-    # Convergence variables
-    stop = steps
-    shortest = 2 * chain.code.system_size ** 2
+    # Do the metropolis steps and collect the unique chains, (fingerprints, (x, y, z) lengths, skipped weight)
+    # if conv_mult is set, sampling ends when no new shortest chain is found
+    return chain.droplet(steps, 5, conv_mult, prune, log_weights)
 
-    # Start in high energy state
+
+def EWD_droplet_sketch(chain, steps, randomize, precision, split):
     if randomize:
-        chain.code.qubit_matrix = chain.code.apply_stabilizers_uniform()
-
-    # Do the metropolis steps and add to samples if new chains are found
-    for step in range(int(steps)):
-        chain.update_chain_fast(5)
-        key = hash(chain.code.qubit_matrix.tobytes())
-        if key not in samples:
-            length = chain.code.count_errors()
-            samples[key] = length
-
-            # if new shortest chain found, extend sampling time
-            if conv_mult and length <= shortest:
-                shortest = length
-                stop = step * conv_mult
-        
-        # if no new shortest chain found, end sampling
-        if conv_mult and step >= stop and step * 100 >= steps:
-            break
+        _rain(chain)
 
-    return samples
+    # Do the metropolis steps and count the unique chains in sketches per bucket of lengths, (keys, registers)
+    return chain.droplet_sketch(steps, 5, precision, split)
 
 
-def EWD(init_code, p_error, p_sampling=None, droplets=10, steps=20000, conv_mult=0):
+def EWD(init_code, p_error, p_sampling=None, droplets=10, steps=20000, conv_mult=0, prune=0, sketch=0, session=None, seed=None, backend='process'):
     # set p_sampling equal to p_error by default
     p_sampling = p_sampling or p_error
 
+    # number of unique chains with n errors in each class, reweighted to p_error
+    if prune > 0:
+        N_n, skipped = EWD_N_n(init_code, p_sampling, droplets, steps, conv_mult, prune, p_error, sketch, session, seed,
+                               backend)
+        _warn_skipped(skipped)
+    else:
+        N_n = EWD_N_n(init_code, p_sampling, droplets, steps, conv_mult, sketch=sketch, session=session, seed=seed,
+                      backend=backend)
+    return EWD_distr_N_n(N_n, p_error)
+
+
+def EWD_N_n(init_code, p_sampling, droplets=10, steps=20000, conv_mult=0, prune=0, p_error=None, sketch=0,
+            session=None, seed=None, backend='process'):
+    '''
+    Density of states mode of EWD: N_n has one row (eq, n, count) per class eq and number of errors n that unique
+    chains were found with, count is the number of them. Sparse as only a narrow range of n is populated.
+    Independent of the number of samples in size, and can be reweighted to any p with EWD_distr_N_n.
+    With prune > 0 chains with a weight at p_error (default p_sampling) below prune times that of the shortest
+    chain of the droplet are neither fingerprinted nor counted, and (N_n, skipped) is returned where skipped[eq]
+    bounds the left out part of Z_E of class eq relative to the part that is counted.
+    With sketch > 0 the unique chains are not stored but counted in HyperLogLog sketches with 2**sketch registers
+    per n (sketch.Length_sketches), the counts are then float estimates with relative error 1.04 / sqrt(2**sketch).
+    Neither conv_mult nor prune are used with sketches.
+    Every (class, droplet) pair is sampled as an independent task, in the workers of session (a DecoderSession) if
+    given and otherwise in a pool of their own if droplets > 1, of processes or with backend='thread' of threads that
+    share the chains with the caller (the compiled kernels release the GIL). With a seed (rng.stream_seed) the
+    droplets draw from independent streams and the result does not depend on where they run.
+    '''
+    assert not (sketch and prune), 'prune is not supported with sketches'
     if type(init_code) == list:
         # this is either 4 or 16, depending on what type of code is used.
         nbr_eq_classes = init_code[0].nbr_eq_classes
@@ -215,64 +267,135 @@ def EWD(init_code, p_error, p_sampling=None, droplets=10, steps=20000, conv_mult
         # apply uniform stabilizers, i.e. rain
         randomize = True
 
-    # this is where we save all samples in a dict, to find the unique ones.
-    qubitlist = {}
+    N_n = [None] * nbr_eq_classes
+    skipped = np.zeros(nbr_eq_classes)
+    # weights the pruning tolerance refers to
+    p_error = p_error or p_sampling
+    with np.errstate(divide='ignore'):
+        log_weights = np.full(3, np.log((p_error / 3) / (1 - p_error)))
+
+    if sketch:
+        args = [[(copy.deepcopy(chain), steps, randomize, sketch, False) for _ in range(droplets)] for chain in eq_chains]
+        for eq, output in enumerate(_run_droplets(session, EWD_droplet_sketch, args, seed, backend)):
+            # the sketches of the droplets merge to the sketch of all their chains
+            sketches = Length_sketches(sketch)
+            for res in output:
+                sketches.update(*res)
+            buckets, counts = sketches.estimate()
+            N_n[eq] = _N_n_rows(np.column_stack([np.full(len(buckets), eq), buckets[:, 0]]), counts)
+        return np.concatenate(N_n)
+
+    # all droplets of all classes are sampled at once
+    args = [[(copy.deepcopy(chain), steps, randomize, conv_mult, prune, log_weights) for _ in range(droplets)]
+            for chain in eq_chains]
+    for eq, output in enumerate(_run_droplets(session, EWD_droplet, args, seed, backend)):
+        if droplets == 1:
+            _, lengths, _ = output[0]
+        else:
+            # the same chain can be found by several droplets
+            fingerprints, lengths = unique_chains(np.concatenate([res[0] for res in output]),
+                                                  np.concatenate([res[1] for res in output]))
+
+        N_n[eq] = _N_n_rows(np.column_stack([np.full(len(lengths), eq), lengths.sum(axis=1)]))
+        if prune > 0:
+            skipped[eq] = _skipped_weight(output, lengths, log_weights)
 
-    # Z_E will be saved in eqdistr
-    eqdistr = np.zeros(nbr_eq_classes)
+    N_n = np.concatenate(N_n)
+    return (N_n, skipped) if prune > 0 else N_n
 
-    # error-model
-    beta = -log((p_error / 3) / (1 - p_error))
 
-    if droplets > 1:
-        pool = Pool(droplets)
+def EWD_distr_N_n(N_n, p_error):
+    # Z_E of every class from the (eq, n, count) rows of EWD_N_n, normalized as EWD.
+    # p_error can be an array, then the result has one row per p_error
+    p_error = np.asarray(p_error, dtype=float)
+    beta = -np.log((p_error / 3) / (1 - p_error))
+    eq, n, counts = N_n.T
+    eqdistr = _reweight_N_n(eq, counts, beta.reshape(-1, 1) * n)
+    return eqdistr if p_error.ndim else eqdistr[0]
 
-    for eq in range(nbr_eq_classes):
-        # go to class eq and apply stabilizers
-        chain = eq_chains[eq]
 
-        if droplets == 1:
-            qubitlist = EWD_droplet(copy.deepcopy(chain), steps, randomize, conv_mult)
-        else:
-            args = [(copy.deepcopy(chain), steps, randomize, conv_mult) for _ in range(droplets)]
-            output = pool.starmap_async(EWD_droplet, args).get()
-            for res in output:
-                qubitlist.update(res)
+def EWD_sweep(init_code, p_errors, p_sampling, droplets=10, steps=20000, conv_mult=0, prune=0, sketch=0,
+              session=None, seed=None, backend='process'):
+    '''
+    Samples the syndrome once at p_sampling and returns the EWD class distribution for every p in p_errors,
+    shape (len(p_errors), nbr_eq_classes). Valid since N(n) does not depend on p.
+    The sampling takes the arguments of EWD_N_n, prune refers to the weights at p_sampling.
+    '''
+    if prune > 0:
+        N_n, skipped = EWD_N_n(init_code, p_sampling, droplets, steps, conv_mult, prune, sketch=sketch,
+                               session=session, seed=seed, backend=backend)
+        _warn_skipped(skipped)
+    else:
+        N_n = EWD_N_n(init_code, p_sampling, droplets, steps, conv_mult, sketch=sketch, session=session, seed=seed,
+                      backend=backend)
+    return EWD_distr_N_n(N_n, np.asarray(p_errors, dtype=float).reshape(-1))
 
-        # compute Z_E
-        for key in qubitlist:
-            eqdistr[eq] += exp(-beta * qubitlist[key])
-        qubitlist.clear()
 
-    # Retrun normalized eq_distr
-    return (np.divide(eqdistr, sum(eqdistr)) * 100)
+def _N_n_rows(keys, counts=None):
+    # sparse N(n), one row (*keys, count) per distinct row of keys (class and lengths of a chain or of a bucket)
+    # in increasing order. counts gives the count of every row of keys, otherwise each row is one chain
+    if counts is None:
+        keys, counts = np.unique(keys, axis=0, return_counts=True)
+    else:
+        order = np.lexsort(keys.T[::-1])
+        keys, counts = keys[order], counts[order]
+        keys, counts = keys[counts > 0], counts[counts > 0]
+    return np.column_stack([keys, counts])
+
+
+def _reweight_N_n(eq, counts, energies, onlyshortest=False):
+    # normalized Z_E (in %) of every class for each row of energies, from counts[k] unique chains in class eq[k]
+    # with energy energies[:, k] (-log of the weight of one chain). Every class has chains, at least the one it
+    # starts from. Summed relative to the largest term of each row so that nothing underflows at large codes
+    eq = eq.astype(np.int64)
+    nbr_eq_classes = eq.max() + 1
+    log_terms = np.log(counts) - energies
+    if onlyshortest:
+        for c in range(nbr_eq_classes):
+            in_class = eq == c
+            if np.any(in_class):
+                shortest = energies[:, in_class].min(axis=1, keepdims=True)
+                longer = ~np.isclose(energies[:, in_class], shortest)
+                log_terms[:, in_class] = np.where(longer, -np.inf, log_terms[:, in_class])
+    terms = np.exp(log_terms - log_terms.max(axis=1, keepdims=True))
+    eqdistr = np.stack([terms[:, eq == c].sum(axis=1) for c in range(nbr_eq_classes)], axis=1)
+    return eqdistr / eqdistr.sum(axis=1, keepdims=True) * 100
+
+
+def _skipped_weight(output, lengths, log_weights):
+    # upper bound on the weight of the chains pruned by the droplets in output (fingerprints, lengths, skipped)
+    # relative to the weight of the kept chains (lengths). The skipped weight of each droplet is relative to its
+    # lowest energy chain, which is always kept
+    if len(lengths) == 0:
+        return 0.0
+    top = _log_weight(log_weights, *lengths.T).max()
+    kept = np.exp(_log_weight(log_weights, *lengths.T) - top).sum()
+    pruned = sum(skipped * np.exp(_log_weight(log_weights, *droplet_lengths.T).max() - top)
+                 for _, droplet_lengths, skipped in output if skipped > 0)
+    return pruned / kept
+
+
+def _warn_skipped(skipped):
+    # print warning if the pruned chains can change the class distribution by more than a percent
+    if np.max(skipped) > 0.01:
+        print('\n\nWARNING: EWD pruned chains with up to', np.max(skipped), 'of the weight of a class\n\n')
 
 
 def EWD_droplet_general_noise(chain, steps, randomize):
-    # All unique chains will be saved in samples
-    samples = {}
-
-    # Start in high energy state
     if randomize:
-        chain.code.qubit_matrix = chain.code.apply_stabilizers_uniform()
-
-    # Do the metropolis steps and add to samples if new chains are found
-    for step in range(int(steps)):
-        chain.update_chain_fast(5)
-        # TODO needs to consider noise here (not use fast variant?)
-        key = hash(chain.code.qubit_matrix.tobytes())
-        if key not in samples:
-            lengths = chain.code.count_errors_xyz()
-            samples[key] = lengths
+        _rain(chain)
 
-    return samples
+    # Do the metropolis steps and collect the unique chains, (fingerprints, (x, y, z) lengths).
+    # The lengths are the running counters of the chain, recorded only when a new chain is found
+    fingerprints, lengths, _ = chain.droplet(steps, 5)
+    return fingerprints, lengths
 
 
-def EWD_general_noise(init_code, p_xyz, p_sampling=None, droplets=10, steps=20000, shortest_only=False):
+def EWD_general_noise(init_code, p_xyz, p_sampling=None, droplets=10, steps=20000, shortest_only=False, session=None, seed=None, backend='process'):
     # p_xyz is an array (p_x, p_y, p_z)
-    # set p_sampling equal to sum of p_xyz by default
+    # sample at the noise model (p_x, p_y, p_z) by default, a number p_sampling gives depolarizing sampling
     if p_sampling is None:
-        p_sampling = p_xyz.sum()
+        p_sampling = p_xyz
 
     if type(p_sampling) == np.ndarray:
         chain_class = Chain_xyz
@@ -301,9 +424,6 @@ def EWD_general_noise(init_code, p_xyz, p_sampling=None, droplets=10, steps=2000
         # apply uniform stabilizers, i.e. rain
         randomize = False
 
-    # this is where we save all samples in a dict, to find the unique ones.
-    qubitlist = {}
-
     # Z_E will be saved in eqdistr
     eqdistr = np.zeros(nbr_eq_classes)
 
@@ -314,22 +434,15 @@ def EWD_general_noise(init_code, p_xyz, p_sampling=None, droplets=10, steps=2000
     # error-model
     beta = -np.log((p_xyz) / (1 - sum(p_xyz)))
 
-    if droplets > 1:
-        pool = Pool(droplets)
-
-    for eq in range(nbr_eq_classes):
-        # go to class eq and apply stabilizers
-        chain = eq_chains[eq]
-
+    # all droplets of all classes are sampled at once
+    args = [[(copy.deepcopy(chain), steps, randomize) for _ in range(droplets)] for chain in eq_chains]
+    for eq, output in enumerate(_run_droplets(session, EWD_droplet_general_noise, args, seed, backend)):
         if droplets == 1:
-            qubitlist = EWD_droplet_general_noise(copy.deepcopy(chain), steps, randomize)
+            _, qubit_lengths = output[0]
         else:
-            args = [(copy.deepcopy(chain), steps, randomize) for _ in range(droplets)]
-            output = pool.starmap_async(EWD_droplet_general_noise, args).get()
-            for res in output:
-                qubitlist.update(res)
-
-        qubit_lengths = np.array(list(qubitlist.values()))
+            # the same chain can be found by several droplets
+            _, qubit_lengths = unique_chains(np.concatenate([res[0] for res in output]),
+                                             np.concatenate([res[1] for res in output]))
 
         # beta and the elements of qubit_lenghts are arrays whose dot product corresponds to the chain (log) probability
         weighted_lengths = np.sum(beta * qubit_lengths, axis=1, where=(qubit_lengths > 0))
@@ -341,7 +454,6 @@ def EWD_general_noise(init_code, p_xyz, p_sampling=None, droplets=10, steps=2000
 
         # compute Z_E
         eqdistr[eq] = np.sum(np.exp(-weighted_lengths))
-        qubitlist.clear()
         # deal with infinities
         #if check_finite:
         #    for counts in qubitlist.values():
@@ -358,11 +470,11 @@ def EWD_general_noise(init_code, p_xyz, p_sampling=None, droplets=10, steps=2000
     return (np.divide(eqdistr, sum(eqdistr)) * 100)
 
 
-def EWD_general_noise_shortest(init_code, p_xyz, p_sampling=None, droplets=10, steps=20000):
+def EWD_general_noise_shortest(init_code, p_xyz, p_sampling=None, droplets=10, steps=20000, session=None, seed=None, backend='process'):
     # p_xyz is an array (p_x, p_y, p_z)
-    # set p_sampling equal to sum of p_xyz by default
+    # sample at the noise model (p_x, p_y, p_z) by default, a number p_sampling gives depolarizing sampling
     if p_sampling is None:
-        p_sampling = p_xyz.sum()
+        p_sampling = p_xyz
 
     if type(p_sampling) == np.ndarray:
         chain_class = Chain_xyz
@@ -391,9 +503,6 @@ def EWD_general_noise_shortest(init_code, p_xyz, p_sampling=None, droplets=10, s
         # apply uniform stabilizers, i.e. rain
         randomize = False
 
-    # this is where we save all samples in a dict, to find the unique ones.
-    qubitlist = {}
-
     # Z_E will be saved in eqdistr
     eqdistr = np.zeros(nbr_eq_classes)
     eqdistr_shortest = np.zeros(nbr_eq_classes)
@@ -405,22 +514,15 @@ def EWD_general_noise_shortest(init_code, p_xyz, p_sampling=None, droplets=10, s
     # error-model
     beta = -np.log((p_xyz) / (1 - sum(p_xyz)))
 
-    if droplets > 1:
-        pool = Pool(droplets)
-
-    for eq in range(nbr_eq_classes):
-        # go to class eq and apply stabilizers
-        chain = eq_chains[eq]
-
+    # all droplets of all classes are sampled at once
+    args = [[(copy.deepcopy(chain), steps, randomize) for _ in range(droplets)] for chain in eq_chains]
+    for eq, output in enumerate(_run_droplets(session, EWD_droplet_general_noise, args, seed, backend)):
         if droplets == 1:
-            qubitlist = EWD_droplet_general_noise(copy.deepcopy(chain), steps, randomize)
+            _, qubit_lengths = output[0]
         else:
-            args = [(copy.deepcopy(chain), steps, randomize) for _ in range(droplets)]
-            output = pool.starmap_async(EWD_droplet_general_noise, args).get()
-            for res in output:
-                qubitlist.update(res)
-
-        qubit_lengths = np.array(list(qubitlist.values()))
+            # the same chain can be found by several droplets
+            _, qubit_lengths = unique_chains(np.concatenate([res[0] for res in output]),
+                                             np.concatenate([res[1] for res in output]))
 
         # beta and the elements of qubit_lenghts are arrays whose dot product corresponds to the chain (log) probability
         weighted_lengths = np.sum(beta * qubit_lengths, axis=1, where=(qubit_lengths > 0))
@@ -428,82 +530,39 @@ def EWD_general_noise_shortest(init_code, p_xyz, p_sampling=None, droplets=10, s
         # compute Z_E
         eqdistr[eq] = np.sum(np.exp(-weighted_lengths))
         eqdistr_shortest[eq] = np.sum(np.exp(-weighted_lengths), where=np.isclose(weighted_lengths, np.min(weighted_lengths)))
-        qubitlist.clear()
 
     # Retrun normalized eq_distr
     return (np.divide(eqdistr, sum(eqdistr)) * 100), (np.divide(eqdistr_shortest, sum(eqdistr_shortest)) * 100)
 
 
-def EWD_droplet_alpha(chain, steps, alpha, onlyshortest):
+def EWD_droplet_alpha(chain, steps, alpha, onlyshortest, prune=0, log_weights=None):
 
     #chain.code.qubit_matrix = chain.code.apply_stabilizers_uniform()
-    # All unique chains will be saved in samples
-    all_seen = set()
-    seen_chains = {}
-    shortest = 1000000
-    # Do the metropolis steps and add to samples if new chains are found
-    for _ in range(steps):
-        chain.update_chain_fast(5)
-        key = hash(chain.code.qubit_matrix.tobytes())
-        if key not in all_seen:
-            all_seen.add(key)
-            lengths = chain.code.chain_lengths()
-            eff_len = lengths[2] + alpha * sum(lengths[0:2])
-            if onlyshortest:
-                if eff_len < shortest: # New shortest chain
-                    shortest = eff_len
-                    seen_chains = {}
-                    seen_chains[key] = eff_len
-                elif eff_len == shortest:
-                    seen_chains[key] = eff_len
-            else:
-                seen_chains[key] = eff_len
-    
-    return seen_chains
-
+    # Do the metropolis steps and collect the unique chains with their (x, y, z) lengths
+    fingerprints, lengths, skipped = chain.droplet(steps, 5, 0, prune, log_weights)
 
-def EWD_alpha_N_n(init_code, pz_tilde, alpha, steps, pz_tilde_sampling=None, onlyshortest=True):
+    # keep only the chains with the shortest effective length, the pruned chains are all longer
+    if onlyshortest and len(lengths) > 0:
+        eff_lens = lengths[:, 2] + alpha * (lengths[:, 0] + lengths[:, 1])
+        shortest = eff_lens == eff_lens.min()
+        fingerprints, lengths, skipped = fingerprints[shortest], lengths[shortest], 0.0
 
-    pz_tilde_sampling = pz_tilde_sampling if pz_tilde_sampling is not None else pz_tilde
-
-    if type(init_code) == list:
-        nbr_eq_classes = init_code[0].nbr_eq_classes
-        # make sure one init code is provided for each class
-        assert len(init_code) == nbr_eq_classes, 'if init_code is a list, it has to contain one code for each class'
-        eq_chains = [Chain_alpha(copy.deepcopy(code), pz_tilde_sampling, alpha) for code in init_code]
-
-    else:
-        nbr_eq_classes = init_code.nbr_eq_classes
-        # Create chain with p_sampling, this is allowed since N(n) is independent of p.
-        eq_chains = [None] * nbr_eq_classes
-        for eq in range(nbr_eq_classes):
-            eq_chains[eq] = Chain_alpha(copy.deepcopy(init_code), pz_tilde_sampling, alpha)
-            eq_chains[eq].code.qubit_matrix = eq_chains[eq].code.to_class(eq)
-
-    # Z_E will be saved in eqdistr
-    eqdistr = np.zeros(nbr_eq_classes)
-
-    beta = - np.log(pz_tilde)
-
-    Nobs_n = [{}, {}, {}, {}]
-
-    for eq in range(nbr_eq_classes):
-        # go to class eq and apply stabilizers
-        chain = eq_chains[eq]
-
-        out = EWD_droplet_alpha(chain, steps, alpha, onlyshortest)
-
-        Nobs_n[eq] = out
-
-        # for eff_len in out.values():
-        #     eqdistr[eq] += exp(-beta*eff_len)
-        # out.clear()
+    return fingerprints, lengths, skipped
 
-    return Nobs_n#(np.divide(eqdistr, sum(eqdistr)) * 100)
-
-
-def EWD_alpha(init_code, pz_tilde, alpha, steps, pz_tilde_sampling=None, onlyshortest=True):
 
+def EWD_alpha_N_n(init_code, pz_tilde, alpha, steps, pz_tilde_sampling=None, onlyshortest=True, prune=0, sketch=0,
+                  session=None, seed=None, backend='process'):
+    '''
+    Density of states mode of EWD_alpha: N_n has one row (eq, n_xy, n_z, count) per class eq, number of x and y
+    errors n_xy and number of z errors n_z that unique chains were found with (only those with the shortest
+    effective length if onlyshortest), count is the number of them.
+    Can be reweighted to any pz_tilde and alpha with EWD_alpha_distr_N_n, also used for biased noise.
+    With prune > 0 chains with a weight at (pz_tilde, alpha) below prune times that of the shortest chain are
+    neither fingerprinted nor counted, and (N_n, skipped) is returned as in EWD_N_n.
+    With sketch > 0 N_n is estimated from HyperLogLog sketches per (n_xy, n_z) as in EWD_N_n.
+    The classes are sampled in parallel in the workers of session if given, from streams of seed as in EWD_N_n.
+    '''
+    assert not (sketch and prune), 'prune is not supported with sketches'
     pz_tilde_sampling = pz_tilde_sampling if pz_tilde_sampling is not None else pz_tilde
 
     if type(init_code) == list:
@@ -520,237 +579,234 @@ def EWD_alpha(init_code, pz_tilde, alpha, steps, pz_tilde_sampling=None, onlysho
             eq_chains[eq] = Chain_alpha(copy.deepcopy(init_code), pz_tilde_sampling, alpha)
             eq_chains[eq].code.qubit_matrix = eq_chains[eq].code.to_class(eq)
 
-    # Z_E will be saved in eqdistr
-    eqdistr = np.zeros(nbr_eq_classes)
-
-    beta = - np.log(pz_tilde)
-
-    for eq in range(nbr_eq_classes):
-        # go to class eq and apply stabilizers
-        chain = eq_chains[eq]
-
-        out = EWD_droplet_alpha(chain, steps, alpha, onlyshortest)
-
-        for eff_len in out.values():
-            eqdistr[eq] += exp(-beta*eff_len)
-        out.clear()
-
-    return (np.divide(eqdistr, sum(eqdistr)) * 100)
-
+    N_n = [None] * nbr_eq_classes
+    skipped = np.zeros(nbr_eq_classes)
+    # weights the pruning tolerance refers to
+    with np.errstate(divide='ignore'):
+        log_weights = np.log(pz_tilde) * np.array([alpha, alpha, 1.0])
+
+    if sketch:
+        args = [[(chain, steps, False, sketch, True)] for chain in eq_chains]
+        for eq, output in enumerate(_run_droplets(session, EWD_droplet_sketch, args, seed, backend)):
+            sketches = Length_sketches(sketch, split=True)
+            sketches.update(*output[0])
+            buckets, counts = sketches.estimate()
+            # keep only the buckets with the shortest effective length
+            if onlyshortest:
+                eff_lens = buckets[:, 1] + alpha * buckets[:, 0]
+                buckets, counts = buckets[eff_lens == eff_lens.min()], counts[eff_lens == eff_lens.min()]
+            N_n[eq] = _N_n_rows(np.column_stack([np.full(len(buckets), eq), buckets]), counts)
+        return np.concatenate(N_n)
+
+    # the classes are sampled at once
+    args = [[(chain, steps, alpha, onlyshortest, prune, log_weights)] for chain in eq_chains]
+    for eq, output in enumerate(_run_droplets(session, EWD_droplet_alpha, args, seed, backend)):
+        _, lengths, _ = output[0]
+
+        N_n[eq] = _N_n_rows(np.column_stack([np.full(len(lengths), eq), lengths[:, 0] + lengths[:, 1],
+                                             lengths[:, 2]]))
+        if prune > 0:
+            skipped[eq] = _skipped_weight(output, lengths, log_weights)
+
+    N_n = np.concatenate(N_n)
+    return (N_n, skipped) if prune > 0 else N_n
+
+
+def EWD_alpha_distr_N_n(N_n, pz_tilde, alpha, onlyshortest=False):
+    # Z_E of every class from the (eq, n_xy, n_z, count) rows of EWD_alpha_N_n, normalized as EWD_alpha.
+    # pz_tilde and alpha can be (broadcastable) arrays, then the result has one row per pair.
+    # With onlyshortest only the chains with the shortest effective length at each alpha are counted
+    pz_tilde, alpha = np.broadcast_arrays(np.asarray(pz_tilde, dtype=float), np.asarray(alpha, dtype=float))
+    beta = - np.log(pz_tilde).reshape(-1, 1)
+    eq, n_xy, n_z, counts = N_n.T
+    energies = beta * (alpha.reshape(-1, 1) * n_xy + n_z)
+    eqdistr = _reweight_N_n(eq, counts, energies, onlyshortest)
+    return eqdistr if pz_tilde.ndim else eqdistr[0]
+
+
+def EWD_alpha_sweep(init_code, pz_tildes, alphas, steps, pz_tilde_sampling, alpha_sampling, onlyshortest=True,
+                    prune=0, sketch=0, session=None, seed=None, backend='process'):
+    '''
+    Samples the syndrome once with (pz_tilde_sampling, alpha_sampling) and returns the EWD_alpha class distribution
+    for every pair in the (broadcast) arrays pz_tildes and alphas, shape (n_pairs, nbr_eq_classes).
+    All chains are kept while sampling, the shortest ones are picked for each alpha when onlyshortest.
+    The sampling takes the arguments of EWD_alpha_N_n, prune refers to the weights at the sampling parameters.
+    '''
+    if prune > 0:
+        N_n, skipped = EWD_alpha_N_n(init_code, pz_tilde_sampling, alpha_sampling, steps, onlyshortest=False,
+                                     prune=prune, sketch=sketch, session=session, seed=seed, backend=backend)
+        _warn_skipped(skipped)
+    else:
+        N_n = EWD_alpha_N_n(init_code, pz_tilde_sampling, alpha_sampling, steps, onlyshortest=False, sketch=sketch,
+                            session=session, seed=seed, backend=backend)
+    pz_tildes, alphas = np.broadcast_arrays(np.asarray(pz_tildes, dtype=float), np.asarray(alphas, dtype=float))
+    return EWD_alpha_distr_N_n(N_n, pz_tildes.reshape(-1), alphas.reshape(-1), onlyshortest)
+
+
+def biased_to_alpha(p_error, eta):
+    # (pz_tilde, alpha) of biased noise, p_z = p * eta / (eta + 1) and p_x = p_y = p / (2 * (eta + 1)).
+    # Elementwise on arrays, so an eta sweep can be evaluated with EWD_alpha_distr_N_n
+    p_error = np.asarray(p_error, dtype=float)
+    pz_tilde = p_error * eta / (eta + 1) / (1 - p_error)
+    px_tilde = p_error / (2 * (eta + 1)) / (1 - p_error)
+    return pz_tilde, np.log(px_tilde) / np.log(pz_tilde)
+
+
+def EWD_alpha(init_code, pz_tilde, alpha, steps, pz_tilde_sampling=None, onlyshortest=True, prune=0, sketch=0,
+              session=None, seed=None, backend='process'):
+    if prune > 0:
+        N_n, skipped = EWD_alpha_N_n(init_code, pz_tilde, alpha, steps, pz_tilde_sampling, onlyshortest, prune, sketch,
+                                     session, seed, backend)
+        _warn_skipped(skipped)
+    else:
+        N_n = EWD_alpha_N_n(init_code, pz_tilde, alpha, steps, pz_tilde_sampling, onlyshortest, sketch=sketch,
+                            session=session, seed=seed, backend=backend)
+    return EWD_alpha_distr_N_n(N_n, pz_tilde, alpha)
 
 
-def MCMC_biased(init_code, p, eta=0.5, Nc=None, SEQ=2, TOPS=10, tops_burn=2, eps=0.1, steps=50000000, iters=10, conv_criteria='error_based'):
-    nbr_eq_classes = init_code.nbr_eq_classes
+def decode_many(codes, method, params):
+    '''
+    Decodes the syndromes of a list of codes of the same model and size together. The chains of every syndrome and
+    class are packed into arrays (batch.pack_chains) and advanced in a single compiled call, instead of creating
+    chains and copying codes for every syndrome. Returns an array (len(codes), nbr_eq_classes) of
+    'EWD':       the EWD distributions, params p_error and optional p_sampling, droplets (1), steps (20000), conv_mult
+    'ST':        the single_temp mean lengths, params p_error or (pz_tilde, alpha) for single_temp_alpha, and steps
+    'EWD_alpha': the EWD_alpha distributions, params pz_tilde, alpha, steps and optional pz_tilde_sampling, onlyshortest
+    '''
+    nbr_eq_classes = codes[0].nbr_eq_classes
+    lattice = code_lattice(codes[0])
+    alpha_noise = method == 'EWD_alpha' or (method == 'ST' and 'alpha' in params)
+
+    # one chain gives the acceptance table and weights of all of them
+    if alpha_noise:
+        pz_tilde, alpha = params['pz_tilde'], params['alpha']
+        pz_tilde_sampling = params.get('pz_tilde_sampling') or pz_tilde
+        chain = Chain_alpha(codes[0], pz_tilde_sampling, alpha)
+        energy_weights = np.array([alpha, alpha, 1.0])
+    else:
+        p_sampling = params.get('p_sampling') or params['p_error']
+        chain = Chain(p_sampling, codes[0])
+        energy_weights = np.ones(3)
+
+    if method == 'ST':
+        states, lengths, fingerprints = pack_chains(codes)
+        means = _single_temp_batch(states, lengths, fingerprints, lattice.stab_fingerprints, lattice.stabilizer_table,
+                                   chain.acceptance, int(params['steps']), energy_weights)
+        return means.reshape(len(codes), nbr_eq_classes)
+
+    assert method in ['EWD', 'EWD_alpha'], f'decode_many does not support {method}'
+    # EWD droplets start from uniformly random stabilizers, EWD_alpha from the class of the syndrome
+    droplets = params.get('droplets', 1) if method == 'EWD' else 1
+    states, lengths, fingerprints = pack_chains(codes, droplets, randomize=method == 'EWD')
+    fingerprints, lengths, offsets, _ = _ewd_batch(states, lengths, fingerprints, lattice.stab_fingerprints,
+                                                   lattice.stabilizer_table, chain.acceptance,
+                                                   int(params.get('steps', 20000)), 5,
+                                                   float(params.get('conv_mult', 0)), chain.log_weights, np.inf)
+    # class chain (b * nbr_eq_classes + eq) of every unique chain, in increasing order
+    group = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets)) // droplets
+
+    result = np.zeros((len(codes), nbr_eq_classes))
+    if method == 'EWD':
+        if droplets > 1:
+            # the same chain can be found by several droplets
+            bounds = offsets[::droplets]
+            merged = [unique_chains(fingerprints[start:end], lengths[start:end])[1]
+                      for start, end in zip(bounds[:-1], bounds[1:])]
+            group = np.repeat(np.arange(len(merged)), [len(m) for m in merged])
+            lengths = np.concatenate(merged)
+        # (class chain, n, count) rows of all syndromes, in order of syndrome
+        N_n = _N_n_rows(np.column_stack([group, lengths.sum(axis=1)]))
+        bounds = np.searchsorted(N_n[:, 0], np.arange(len(codes) + 1) * nbr_eq_classes)
+        N_n[:, 0] %= nbr_eq_classes
+        for b, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+            result[b] = EWD_distr_N_n(N_n[start:end], params['p_error'])
+        return result
+
+    n_xy, n_z = lengths[:, 0] + lengths[:, 1], lengths[:, 2]
+    # keep only the chains with the shortest effective length of each class
+    if params.get('onlyshortest', True):
+        eff_lens = n_z + alpha * n_xy
+        shortest = np.full(group.max() + 1, np.inf)
+        np.minimum.at(shortest, group, eff_lens)
+        keep = eff_lens == shortest[group]
+        group, n_xy, n_z = group[keep], n_xy[keep], n_z[keep]
+    bounds = np.searchsorted(group, np.arange(len(codes) + 1) * nbr_eq_classes)
+    for b, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+        N_n = _N_n_rows(np.column_stack([group[start:end] % nbr_eq_classes, n_xy[start:end], n_z[start:end]]))
+        result[b] = EWD_alpha_distr_N_n(N_n, pz_tilde, alpha)
+    return result
+
+
+
+def MCMC_biased(init_code, p, eta=0.5, Nc=None, SEQ=2, TOPS=10, tops_burn=2, eps=0.1, steps=50000000, iters=10, conv_criteria='error_based', session=None, seed=None):
+    # run in a warm worker of the session
+    if session is not None:
+        return session.run(MCMC_biased, init_code, p, eta, Nc, SEQ, TOPS, tops_burn, eps, steps, iters, conv_criteria, None, seed)
+    # the ladder draws from the stream of the syndrome
+    if seed is not None:
+        seed_task(stream_seed(seed))
     Nc = Nc or init_code.system_size
     if tops_burn >= TOPS:
         print('tops_burn has to be smaller than TOPS')
-    # initialize variables
-    since_burn = 0
-    resulting_burn_in = 0
-    nbr_errors_bottom_chain = np.zeros(steps)
-    # list of class counts after burn in
-    eq = np.zeros([steps, nbr_eq_classes], dtype=np.uint32)
-    # used in error_based/majority_based instead of setting tops0 = TOPS
-    conv_start = 0
-    conv_streak = 0
-    # Convergence flag
-    convergence_reached = False
     # initialize ladder of chains sampled at different temperatures
     ladder = Ladder_biased(p, init_code, eta, Nc, 0.5)
     # Main loop that runs until convergence or max steps (steps) are reached
-    for step in range(steps):
-        # run metropolis on every chain and perform chain swaps
-        ladder.step(iters)
-        # Get sample from eq-class of chain in lowest layer of ladder
-        current_eq = ladder.chains[0].code.define_equivalence_class()
-        # Start saving stats once burn-in period is over
-        if ladder.tops0 >= tops_burn:
-            since_burn = step - resulting_burn_in
-            eq[since_burn] = eq[since_burn - 1]
-            eq[since_burn][current_eq] += 1
-            nbr_errors_bottom_chain[since_burn] = ladder.chains[0].code.count_errors()
-        else:
-            # number of steps until tops0 = 2
-            resulting_burn_in += 1
-        # Check for convergence every 10 samples if burn-in period is over (and conv-crit is set)
-        if conv_criteria == 'error_based' and ladder.tops0 >= TOPS:
-            accept, convergence_reached = conv_crit_error_based_PT_biased(nbr_errors_bottom_chain, since_burn, conv_streak, SEQ, eps)
-            if accept:
-                if convergence_reached:
-                    break
-                conv_streak = ladder.tops0 - conv_start
-            else:
-                conv_streak = 0
-                conv_start = ladder.tops0
+    result = parallel_tempering(ladder, iters, steps, TOPS, tops_burn, SEQ, eps, conv_criteria)
     # print warning if loop is exited without convergence
-    else:
-        if conv_criteria == 'error_based':
-            print('\n\nWARNING: MCMC hit max number of steps before convergence:\t', step + 1, '\n\n')
-    return (np.divide(eq[since_burn], since_burn + 1) * 100).astype(np.uint8)
-
-
-# convergence criteria used in paper and called ''felkriteriet''
-def conv_crit_error_based_PT_biased(nbr_errors_bottom_chain, since_burn, tops_accepted, SEQ, eps):
-    # last nonzero element of nbr_errors_bottom_chain is since_burn. Length of nonzero part is since_burn + 1
-    l = since_burn + 1
-    # Calculate average number of errors in 2nd and 4th quarter
-    Average_Q2 = np.average(nbr_errors_bottom_chain[(l // 4): (l // 2)])
-    Average_Q4 = np.average(nbr_errors_bottom_chain[(3 * l // 4): l])
-    # Compare averages
-    error = abs(Average_Q2 - Average_Q4)
-    if error < eps:
-        return True, tops_accepted >= SEQ
-    else:
-        return False, False
-
-
-def MCMC_alpha_with_shortest(init_code, pz_tilde, alpha=1, Nc=None, SEQ=2, TOPS=10, tops_burn=2, eps=0.1, steps=50000000, iters=10, conv_criteria='error_based'):
-    nbr_eq_classes = init_code.nbr_eq_classes
+    if conv_criteria == 'error_based' and not result['converged']:
+        print('\n\nWARNING: MCMC hit max number of steps before convergence:\t', result['step'] + 1, '\n\n')
+    return (np.divide(result['counts'], result['since_burn'] + 1) * 100).astype(np.uint8)
+
+
+def MCMC_alpha_with_shortest(init_code, pz_tilde, alpha=1, Nc=None, SEQ=2, TOPS=10, tops_burn=2, eps=0.1, steps=50000000, iters=10, conv_criteria='error_based', session=None, seed=None):
+    # run in a warm worker of the session
+    if session is not None:
+        return session.run(MCMC_alpha_with_shortest, init_code, pz_tilde, alpha, Nc, SEQ, TOPS, tops_burn, eps, steps, iters, conv_criteria, None, seed)
+    # the ladder draws from the stream of the syndrome
+    if seed is not None:
+        seed_task(stream_seed(seed))
     Nc = Nc or init_code.system_size
     if tops_burn >= TOPS:
         print('tops_burn has to be smaller than TOPS')
-    # initialize variables
-    since_burn = 0
-    resulting_burn_in = 0
-    nbr_errors_bottom_chain = np.zeros(steps)
-    # list of class counts after burn in
-    eq = np.zeros([steps, nbr_eq_classes], dtype=np.uint32)
-    # used in error_based/majority_based instead of setting tops0 = TOPS
-    conv_start = 0
-    conv_streak = 0
-    # Convergence flag
-    convergence_reached = False
     # initialize ladder of chains sampled at different temperatures
     ladder = Ladder_alpha(pz_tilde, init_code, alpha, Nc, 0.5)
-
-    unique_chains = [{}, {}, {}, {}]
-    shortest_n = [0, 0, 0, 0]
-    shortest = [100000, 100000, 100000, 100000]
-
-
-    # Main loop that runs until convergence or max steps (steps) are reached
-    for step in range(steps):
-        # run metropolis on every chain and perform chain swaps
-        ladder.step(iters)
-        # Get sample from eq-class of chain in lowest layer of ladder
-        current_eq = ladder.chains[0].code.define_equivalence_class()
-        # Start saving stats once burn-in period is over
-        if ladder.tops0 >= tops_burn:
-            since_burn = step - resulting_burn_in
-            eq[since_burn] = eq[since_burn - 1]
-            eq[since_burn][current_eq] += 1
-            nbr_errors_bottom_chain[since_burn] = ladder.chains[0].n_eff
-
-            if nbr_errors_bottom_chain[since_burn] < shortest[current_eq]:
-                shortest_n[current_eq] = 1
-                
-                shortest[current_eq] = nbr_errors_bottom_chain[since_burn]
-                unique_chains[current_eq] = {}
-                
-                qubit_hash = hash(ladder.chains[0].code.qubit_matrix.tobytes())
-                if qubit_hash not in unique_chains[current_eq].keys():
-                    unique_chains[current_eq][qubit_hash] = nbr_errors_bottom_chain[since_burn]
-            elif nbr_errors_bottom_chain[since_burn] == shortest[current_eq]:
-                shortest_n[current_eq] += 1
-                
-                qubit_hash = hash(ladder.chains[0].code.qubit_matrix.tobytes())
-                if qubit_hash not in unique_chains[current_eq].keys():
-                    unique_chains[current_eq][qubit_hash] = nbr_errors_bottom_chain[since_burn]
-        else:
-            # number of steps until tops0 = 2
-            resulting_burn_in += 1
-        # Check for convergence every 10 samples if burn-in period is over (and conv-crit is set)
-        if conv_criteria == 'error_based' and ladder.tops0 >= TOPS:
-            accept, convergence_reached = conv_crit_error_based_PT_alpha(nbr_errors_bottom_chain, since_burn, conv_streak, SEQ, eps)
-            if accept:
-                if convergence_reached:
-                    break
-                conv_streak = ladder.tops0 - conv_start
-            else:
-                conv_streak = 0
-                conv_start = ladder.tops0
+    # Main loop that runs until convergence or max steps (steps) are reached, convergence is checked on
+    # n_eff of the bottom chain. Also keeps the shortest n_eff of each class and the unique chains with it
+    result = parallel_tempering(ladder, iters, steps, TOPS, tops_burn, SEQ, eps, conv_criteria,
+                                energy_weights=(alpha, alpha, 1), track_shortest=True)
     # print warning if loop is exited without convergence
-    else:
-        if conv_criteria == 'error_based':
-            print('\n\nWARNING: MCMC hit max number of steps before convergence:\t', step + 1, '\n\n')
-
-    eqdistr = np.zeros(nbr_eq_classes)
+    if conv_criteria == 'error_based' and not result['converged']:
+        print('\n\nWARNING: MCMC hit max number of steps before convergence:\t', result['step'] + 1, '\n\n')
 
     beta = - np.log(pz_tilde)
 
-    for eq_n in range(nbr_eq_classes):
-        for eff_len in unique_chains[eq_n].values():
-            eqdistr[eq_n] += exp(-beta*eff_len)
-
-
-    return (np.divide(eq[since_burn], since_burn + 1) * 100).astype(np.uint8), (np.divide(eqdistr, sum(eqdistr)) * 100), (np.array(shortest_n) / sum(shortest_n) * 100)
+    # every unique shortest chain of a class contributes exp(-beta*shortest)
+    with np.errstate(invalid='ignore'):
+        eqdistr = np.where(result['n_unique'] > 0, result['n_unique'] * np.exp(-beta * result['shortest']), 0)
+    shortest_n = result['shortest_n']
 
+    return (np.divide(result['counts'], result['since_burn'] + 1) * 100).astype(np.uint8), (np.divide(eqdistr, sum(eqdistr)) * 100), (shortest_n / sum(shortest_n) * 100)
 
-def MCMC_alpha(init_code, pz_tilde, alpha=1, Nc=None, SEQ=2, TOPS=10, tops_burn=2, eps=0.1, steps=50000000, iters=10, conv_criteria='error_based'):
-    nbr_eq_classes = init_code.nbr_eq_classes
+def MCMC_alpha(init_code, pz_tilde, alpha=1, Nc=None, SEQ=2, TOPS=10, tops_burn=2, eps=0.1, steps=50000000, iters=10, conv_criteria='error_based', session=None, seed=None):
+    # run in a warm worker of the session
+    if session is not None:
+        return session.run(MCMC_alpha, init_code, pz_tilde, alpha, Nc, SEQ, TOPS, tops_burn, eps, steps, iters, conv_criteria, None, seed)
+    # the ladder draws from the stream of the syndrome
+    if seed is not None:
+        seed_task(stream_seed(seed))
     Nc = Nc or init_code.system_size
     if tops_burn >= TOPS:
         print('tops_burn has to be smaller than TOPS')
-    # initialize variables
-    since_burn = 0
-    resulting_burn_in = 0
-    nbr_errors_bottom_chain = np.zeros(steps)
-    # list of class counts after burn in
-    eq = np.zeros([steps, nbr_eq_classes], dtype=np.uint32)
-    # used in error_based/majority_based instead of setting tops0 = TOPS
-    conv_start = 0
-    conv_streak = 0
-    # Convergence flag
-    convergence_reached = False
     # initialize ladder of chains sampled at different temperatures
     ladder = Ladder_alpha(pz_tilde, init_code, alpha, Nc, 0.5)
-    # Main loop that runs until convergence or max steps (steps) are reached
-    for step in range(steps):
-        # run metropolis on every chain and perform chain swaps
-        ladder.step(iters)
-        # Get sample from eq-class of chain in lowest layer of ladder
-        current_eq = ladder.chains[0].code.define_equivalence_class()
-        # Start saving stats once burn-in period is over
-        if ladder.tops0 >= tops_burn:
-            since_burn = step - resulting_burn_in
-            eq[since_burn] = eq[since_burn - 1]
-            eq[since_burn][current_eq] += 1
-            nx, ny, nz = ladder.chains[0].code.chain_lengths()
-            n_eff = nz + ladder.chains[0].alpha * (nx + ny)
-            nbr_errors_bottom_chain[since_burn] = n_eff
-        else:
-            # number of steps until tops0 = 2
-            resulting_burn_in += 1
-        # Check for convergence every 10 samples if burn-in period is over (and conv-crit is set)
-        if conv_criteria == 'error_based' and ladder.tops0 >= TOPS:
-            accept, convergence_reached = conv_crit_error_based_PT_alpha(nbr_errors_bottom_chain, since_burn, conv_streak, SEQ, eps)
-            if accept:
-                if convergence_reached:
-                    break
-                conv_streak = ladder.tops0 - conv_start
-            else:
-                conv_streak = 0
-                conv_start = ladder.tops0
+    # Main loop that runs until convergence or max steps (steps) are reached, convergence is checked on n_eff
+    result = parallel_tempering(ladder, iters, steps, TOPS, tops_burn, SEQ, eps, conv_criteria,
+                                energy_weights=(alpha, alpha, 1))
+    step = result['step']
     # print warning if loop is exited without convergence
-    else:
-        if conv_criteria == 'error_based':
-            print('\n\nWARNING: MCMC hit max number of steps before convergence:\t', step + 1, '\n\n', flush=True)
-    return (np.divide(eq[since_burn], since_burn + 1) * 100).astype(np.uint8), step*iters*Nc
-
-
-# convergence criteria used in paper and called ''felkriteriet''
-def conv_crit_error_based_PT_alpha(nbr_errors_bottom_chain, since_burn, tops_accepted, SEQ, eps):
-    # last nonzero element of nbr_errors_bottom_chain is since_burn. Length of nonzero part is since_burn + 1
-    l = since_burn + 1
-    # Calculate average number of errors in 2nd and 4th quarter
-    Average_Q2 = np.average(nbr_errors_bottom_chain[(l // 4): (l // 2)])
-    Average_Q4 = np.average(nbr_errors_bottom_chain[(3 * l // 4): l])
-    # Compare averages
-    error = abs(Average_Q2 - Average_Q4)
-    if error < eps:
-        return True, tops_accepted >= SEQ
-    else:
-        return False, False
+    if conv_criteria == 'error_based' and not result['converged']:
+        print('\n\nWARNING: MCMC hit max number of steps before convergence:\t', step + 1, '\n\n', flush=True)
+    return (np.divide(result['counts'], result['since_burn'] + 1) * 100).astype(np.uint8), step*iters*Nc
 
 
 if __name__ == '__main__':
@@ -1,5 +1,6 @@
 import copy
 import os
+from collections import deque
 import numpy as np
 import pandas as pd
 from scipy import optimize
@@ -14,9 +15,12 @@ from src.xyz2_model import xyz_code
 # decoders
 from decoders import MCMC, single_temp, single_temp_alpha, EWD, \
                         EWD_general_noise, EWD_general_noise_shortest, \
-                        EWD_alpha_N_n, EWD_alpha, MCMC_biased, \
-                        MCMC_alpha_with_shortest, MCMC_alpha 
+                        EWD_N_n, EWD_distr_N_n, EWD_alpha_N_n, EWD_alpha_distr_N_n, \
+                        EWD_alpha, biased_to_alpha, MCMC_biased, \
+                        MCMC_alpha_with_shortest, MCMC_alpha, DecoderSession
 from src.mwpm import class_sorted_mwpm, regular_mwpm, enhanced_mwpm
+from src.lattice import lattice_table
+from src.rng import random_seed, stream_seed, seed_task
 
 
 def get_individual_error_rates(params):
@@ -45,8 +49,261 @@ def get_individual_error_rates(params):
     return p_x, p_y, p_z
 
 
+def _random_error(code, p_x, p_y, p_z, rng):
+    # independent x, y and z errors with probabilities p_x, p_y and p_z on every qubit of code, drawn from rng
+    # as in generate_random_error of the models
+    lattice = lattice_table(code)
+    r = rng.random(lattice.n_qubits)
+    paulis = np.select([r < p_z, r < p_z + p_x, r < p_z + p_x + p_y], [3, 1, 2], 0)
+    code.qubit_matrix = lattice.expand(paulis)
+    if hasattr(code, 'syndrome'):
+        code.syndrome()
+
+
+def _generate_point(i, params, session=None):
+    # generates and decodes data point i, returns its qubit_matrix, the decoder output and if the decoder failed
+    print('Starting generation of point nr: ' + str(i + 1), flush=True)
+    # the errors of point i are drawn from the stream (run, i, 0) and the decoders from streams of (run, i, 1),
+    # so the data is the same whichever worker generates the point. The errors come from a generator of their own
+    # and the random start from the kernels, so that points generated by threads do not share a random state
+    point_seed = stream_seed(params['seed'], i, 0)
+    seed_task(point_seed)
+    rng = np.random.default_rng(point_seed)
+    seed = stream_seed(params['seed'], i, 1)
+    p_x, p_y, p_z = get_individual_error_rates(params)
+    failed = False
+
+    # Initiate code
+    if params['code'] == 'toric':
+        assert params['noise'] == 'depolarizing', f'{params["noise"]}-noise is not compatible with "{params["code"]}"-model.'
+        init_code = Toric_code(params['size'])
+        _random_error(init_code, p_x, p_y, p_z, rng)
+    elif params['code'] == 'planar':
+        assert params['noise'] in ['depolarizing', 'alpha'], f'{params["noise"]}-noise is not compatible with "{params["code"]}"-model.'
+        init_code = Planar_code(params['size'])
+        _random_error(init_code, p_x, p_y, p_z, rng)
+    elif params['code'] == 'xzzx':
+        assert params['noise'] in ['depolarizing', 'alpha', 'biased'], f'{params["noise"]}-noise is not compatible with "{params["code"]}"-model.'
+        init_code = xzzx_code(params['size'])
+        _random_error(init_code, p_x, p_y, p_z, rng)
+    elif params['code'] == 'rotated':
+        assert params['noise'] in ['depolarizing', 'alpha', 'biased'], f'{params["noise"]}-noise is not compatible with "{params["code"]}"-model.'
+        init_code = RotSurCode(params['size'])
+        _random_error(init_code, p_x, p_y, p_z, rng)
+    elif params['code'] == 'xyz2':
+        assert params['noise'] in ['depolarizing', 'alpha', 'biased'], f'{params["noise"]}-noise is not compatible with "{params["code"]}"-model.'
+        init_code = xyz_code(params['size'])
+        _random_error(init_code, p_x, p_y, p_z, rng)
+ 
+    # Flatten initial qubit matrix to store in dataframe
+    df_qubit = copy.deepcopy(init_code.qubit_matrix)
+    eq_true = init_code.define_equivalence_class()
+
+    # Create inital error chains for algorithms to start with
+    if params['mwpm_init']: #get mwpm starting points
+        assert params['code'] == 'planar', 'Can only use eMWPM for planar model.'
+        init_code = class_sorted_mwpm(init_code)
+        print('Starting in MWPM state')
+    else: #randomize input matrix, no trace of seed.
+        init_code.qubit_matrix, _ = init_code.apply_random_logical()
+        init_code.qubit_matrix = lattice_table(init_code).apply_stabilizers_uniform(init_code.qubit_matrix)
+        print('Starting in random state')
+
+    # Generate data for DataFrame storage  OBS now using full bincount, change this
+    if params['method'] == "MCMC":
+        if params['noise'] == 'depolarizing':
+            df_eq_distr = MCMC(init_code,
+                               params['p_error'],
+                               Nc=params['Nc'],
+                               SEQ=params['SEQ'],
+                               TOPS=params['TOPS'],
+                               eps=params['eps'],
+                               iters=params['iters'],
+                               conv_criteria=params['conv_criteria'],
+                               session=session, seed=seed)
+            if np.argmax(df_eq_distr) != eq_true:
+                failed = True
+        if params['noise'] == "biased":
+            df_eq_distr = MCMC_biased(init_code,
+                                      params['p_error'],
+                                      eta=params['eta'],
+                                      Nc=params['Nc'],
+                                      SEQ=params['SEQ'],
+                                      TOPS=params['TOPS'],
+                                      eps=params['eps'],
+                                      iters=params['iters'],
+                                      conv_criteria=params['conv_criteria'],
+                                      session=session, seed=seed)
+            if np.argmax(df_eq_distr) != eq_true:
+                failed = True
+        if params['noise'] == "alpha":
+            df_eq_distr = MCMC_alpha(init_code,
+                                    params['p_error'],
+                                    alpha=params['alpha'],
+                                    Nc=params['Nc'],
+                                    SEQ=params['SEQ'],
+                                    TOPS=params['TOPS'],
+                                    eps=params['eps'],
+                                    iters=params['iters'],
+                                    conv_criteria=params['conv_criteria'],
+                                    session=session, seed=seed)
+            if np.argmax(df_eq_distr[0]) != eq_true:
+                failed = True
+    if params['method'] == "MCMC_with_shortest":
+        assert params['noise'] == 'alpha'
+        if params['noise'] == "alpha":
+            df_eq_distr = MCMC_alpha_with_shortest(init_code, params['p_error'], alpha=params['alpha'], session=session, seed=seed)
+            if np.argmax(df_eq_distr[0:4]) != eq_true:
+                failed = True
+    elif params['method'] == "EWD":
+        if params['noise'] == 'depolarizing':
+            assert params['onlyshortest'] == False, "onlyshortest not implemented for deoplarizing"
+            df_eq_distr = EWD(init_code, params['p_error'], params['p_sampling'], steps=params['steps'], droplets=params['droplets'],
+                              session=session, seed=seed)
+            df_eq_distr = np.array(df_eq_distr)
+            if np.argmax(df_eq_distr) != eq_true:
+                failed = True
+        elif params['noise'] == 'alpha':
+            alpha=params['alpha']
+            p_tilde_sampling = params['p_sampling'] / (1 - params['p_sampling'])
+            pz_tilde_sampling = optimize.fsolve(lambda x: x + 2*x**alpha - p_tilde_sampling, 0.5)[0]
+            p_tilde = params['p_error'] / (1 - params['p_error'])
+            pz_tilde = optimize.fsolve(lambda x: x + 2*x**alpha - p_tilde, 0.5)[0]
+            df_eq_distr = EWD_alpha(init_code,
+                                     pz_tilde,
+                                     alpha,
+                                     params['steps'],
+                                     pz_tilde_sampling=pz_tilde_sampling,
+                                     onlyshortest=params['onlyshortest'],
+                                     session=session, seed=seed)
+            df_eq_distr = np.array(df_eq_distr)
+        elif params['noise'] == 'biased':
+            p = params['p_error']
+            pz_tilde = p_z / (1 - p)
+            alpha = log(p_x/(1-p)) / log(p_z/(1-p))
+            p_tilde_sampling = params['p_sampling'] / (1 - params['p_sampling'])
+            pz_tilde_sampling = optimize.fsolve(lambda x: x + 2*x**alpha - p_tilde_sampling, 0.5)[0]
+            df_eq_distr = EWD_alpha(init_code,
+                                     pz_tilde,
+                                     alpha,
+                                     params['steps'],
+                                     pz_tilde_sampling=pz_tilde_sampling,
+                                     onlyshortest=params['onlyshortest'],
+                                     session=session, seed=seed)
+            df_eq_distr = np.array(df_eq_distr)
+        else:
+            raise ValueError(f'''EWD does not support "{params['noise']}" noise''')
+    elif params['method'] == "EWD_N_n":
+        # save the number of unique chains of each length in every class instead of the distribution, as sparse
+        # (eq, lengths, count) rows, can be reweighted to any error rate afterwards
+        if params['noise'] == 'depolarizing':
+            df_eq_distr = EWD_N_n(init_code, params['p_sampling'], steps=params['steps'], droplets=params['droplets'],
+                                  session=session, seed=seed)
+            eq_distr = EWD_distr_N_n(df_eq_distr, params['p_error'])
+        elif params['noise'] in ['alpha', 'biased']:
+            p = params['p_error']
+            if params['noise'] == 'alpha':
+                alpha = params['alpha']
+                p_tilde = p / (1 - p)
+                pz_tilde = optimize.fsolve(lambda x: x + 2*x**alpha - p_tilde, 0.5)[0]
+            else:
+                pz_tilde, alpha = biased_to_alpha(p, params['eta'])
+            p_tilde_sampling = params['p_sampling'] / (1 - params['p_sampling'])
+            pz_tilde_sampling = optimize.fsolve(lambda x: x + 2*x**alpha - p_tilde_sampling, 0.5)[0]
+            df_eq_distr = EWD_alpha_N_n(init_code,
+                                        pz_tilde,
+                                        alpha,
+                                        params['steps'],
+                                        pz_tilde_sampling=pz_tilde_sampling,
+                                        onlyshortest=params['onlyshortest'],
+                                        session=session, seed=seed)
+            eq_distr = EWD_alpha_distr_N_n(df_eq_distr, pz_tilde, alpha)
+        else:
+            raise ValueError(f'''EWD_N_n does not support "{params['noise']}" noise''')
+        if np.argmax(eq_distr) != eq_true:
+            failed = True
+    elif params['method'] == "ST":
+        if params['noise'] == 'depolarizing':
+            df_eq_distr = single_temp(init_code, params['p_error'], params['steps'])
+            df_eq_distr = np.array(df_eq_distr)
+            if np.argmin(df_eq_distr) != eq_true:
+                failed = True
+        elif params['noise'] == 'alpha':
+            p_tilde = params['p_error'] / (1 - params['p_error'])
+            pz_tilde = optimize.fsolve(lambda x: x + 2*x**params['alpha'] - p_tilde, 0.5)[0]
+            df_eq_distr = single_temp_alpha(init_code,
+                                            pz_tilde,
+                                            params['alpha'],
+                                            params['steps'])
+            df_eq_distr = np.array(df_eq_distr)
+            if np.argmin(df_eq_distr) != eq_true:
+                failed = True
+        else:
+            raise ValueError(f'''ST does not support "{params['noise']}" noise''')
+    elif params['method'] == "eMWPM":
+        out = class_sorted_mwpm(copy.deepcopy(init_code))
+        lens = np.zeros((4))
+        for j in range(4):
+            lens[j] = sum(out[j].chain_lengths())
+        choice = np.argmin(lens)
+        df_eq_distr = np.zeros((4)).astype(np.uint8)
+        df_eq_distr[choice] = 100
+        if np.argmax(df_eq_distr) != eq_true:
+            failed = True
+    elif params['method'] == "MWPM":
+        choice = regular_mwpm(copy.deepcopy(init_code))
+        df_eq_distr = np.zeros((4)).astype(np.uint8)
+        df_eq_distr[choice] = 100
+        if np.argmax(df_eq_distr) != eq_true:
+            failed = True
+
+    return df_qubit, df_eq_distr, failed
+
+
+def _uses_session(params):
+    # the decoders that run tasks in parallel in the workers of a session: EWD with several droplets per class.
+    # A ladder (MCMC) is a single task, it runs in this process unless workers or processes are given
+    return params['method'] in ('EWD', 'EWD_N_n') and params.get('droplets', 1) > 1
+
+
+def _generate_points(params, nbr_datapoints, session, workers, cancel=False):
+    # (qubit_matrix, decoder output, failed) of every data point in order. With workers the points are generated in
+    # the workers of the session, at most 2 * workers at a time, and decoded in them without a session of their own.
+    # With cancel the points still in flight when the generator is closed early are stopped with the workers
+    if not workers:
+        for i in range(nbr_datapoints):
+            yield _generate_point(i, params, session)
+        return
+    in_flight = deque()
+    next_point = 0
+    try:
+        while next_point < nbr_datapoints or in_flight:
+            while next_point < nbr_datapoints and len(in_flight) < 2 * workers:
+                in_flight.append(session.pool.apply_async(_generate_point, (next_point, params)))
+                next_point += 1
+            yield in_flight.popleft().get()
+    finally:
+        if cancel and in_flight:
+            session.terminate()
+
+
 # This function generates training data with help of the MCMC algorithm
-def generate(file_path, params, nbr_datapoints=10**6, fixed_errors=None):
+# With workers=N the data points are generated and decoded in parallel by N processes, and written in order
+def generate(file_path, params, nbr_datapoints=10**6, fixed_errors=None, session=None, workers=None):
+    # one session of warm workers for the whole run (params['processes'], default one per cpu), used by the
+    # decoders of every data point, or to generate the points with workers. Only started if something runs in it.
+    # When the run stops early (fixed_errors) the points still in flight in it are cancelled, not decoded for
+    # nothing, while the workers of a session passed in are left running
+    if session is None and (workers or params.get('processes') or _uses_session(params)):
+        with DecoderSession(workers or params.get('processes')) as session:
+            return _generate(file_path, params, nbr_datapoints, fixed_errors, session, workers, True)
+    return _generate(file_path, params, nbr_datapoints, fixed_errors, session, workers, False)
+
+
+def _generate(file_path, params, nbr_datapoints, fixed_errors, session, workers, cancel):
+    # seed of the run, saved with the parameters so that the data can be reproduced
+    if params.get('seed') is None:
+        params = dict(params, seed=random_seed())
 
     # Creates df
     df = pd.DataFrame()
@@ -70,171 +327,12 @@ def generate(file_path, params, nbr_datapoints=10**6, fixed_errors=None):
     # Initiate temporary list with results (to prevent appending to dataframe each loop)
     df_list = []
 
-    p_x, p_y, p_z = get_individual_error_rates(params)
-
-    # Loop to generate data points
-    for i in range(nbr_datapoints):
-        print('Starting generation of point nr: ' + str(i + 1), flush=True)
-
-        # Initiate code
-        if params['code'] == 'toric':
-            assert params['noise'] == 'depolarizing', f'{params["noise"]}-noise is not compatible with "{params["code"]}"-model.'
-            init_code = Toric_code(params['size'])
-            init_code.generate_random_error(params['p_error'])
-        elif params['code'] == 'planar':
-            assert params['noise'] in ['depolarizing', 'alpha'], f'{params["noise"]}-noise is not compatible with "{params["code"]}"-model.'
-            init_code = Planar_code(params['size'])
-            init_code.generate_random_error(p_x=p_x, p_y=p_y, p_z=p_z)
-        elif params['code'] == 'xzzx':
-            assert params['noise'] in ['depolarizing', 'alpha', 'biased'], f'{params["noise"]}-noise is not compatible with "{params["code"]}"-model.'
-            init_code = xzzx_code(params['size'])
-            init_code.generate_random_error(p_x=p_x, p_y=p_y, p_z=p_z)
-        elif params['code'] == 'rotated':
-            assert params['noise'] in ['depolarizing', 'alpha', 'biased'], f'{params["noise"]}-noise is not compatible with "{params["code"]}"-model.'
-            init_code = RotSurCode(params['size'])
-            init_code.generate_random_error(p_x=p_x, p_y=p_y, p_z=p_z)
-        elif params['code'] == 'xyz2':
-            assert params['noise'] in ['depolarizing', 'alpha', 'biased'], f'{params["noise"]}-noise is not compatible with "{params["code"]}"-model.'
-            init_code = xyz_code(params['size'])
-            init_code.generate_random_error(p_x=p_x, p_y=p_y, p_z=p_z)
- 
-        # Flatten initial qubit matrix to store in dataframe
-        df_qubit = copy.deepcopy(init_code.qubit_matrix)
-        eq_true = init_code.define_equivalence_class()
-
-        # Create inital error chains for algorithms to start with
-        if params['mwpm_init']: #get mwpm starting points
-            assert params['code'] == 'planar', 'Can only use eMWPM for planar model.'
-            init_code = class_sorted_mwpm(init_code)
-            print('Starting in MWPM state')
-        else: #randomize input matrix, no trace of seed.
-            init_code.qubit_matrix, _ = init_code.apply_random_logical()
-            init_code.qubit_matrix = init_code.apply_stabilizers_uniform()
-            print('Starting in random state')
-
-        # Generate data for DataFrame storage  OBS now using full bincount, change this
-        if params['method'] == "MCMC":
-            if params['noise'] == 'depolarizing':
-                df_eq_distr = MCMC(init_code,
-                                   params['p_error'],
-                                   Nc=params['Nc'],
-                                   SEQ=params['SEQ'],
-                                   TOPS=params['TOPS'],
-                                   eps=params['eps'],
-                                   iters=params['iters'],
-                                   conv_criteria=params['conv_criteria'])
-                if np.argmax(df_eq_distr) != eq_true:
-                    print('Failed syndrom, total now:', failed_syndroms)
-                    failed_syndroms += 1
-            if params['noise'] == "biased":
-                df_eq_distr = MCMC_biased(init_code,
-                                          params['p_error'],
-                                          eta=params['eta'],
-                                          Nc=params['Nc'],
-                                          SEQ=params['SEQ'],
-                                          TOPS=params['TOPS'],
-                                          eps=params['eps'],
-                                          iters=params['iters'],
-                                          conv_criteria=params['conv_criteria'])
-                if np.argmax(df_eq_distr) != eq_true:
-                    print('Failed syndrom, total now:', failed_syndroms)
-                    failed_syndroms += 1
-            if params['noise'] == "alpha":
-                df_eq_distr = MCMC_alpha(init_code,
-                                        params['p_error'],
-                                        alpha=params['alpha'],
-                                        Nc=params['Nc'],
-                                        SEQ=params['SEQ'],
-                                        TOPS=params['TOPS'],
-                                        eps=params['eps'],
-                                        iters=params['iters'],
-                                        conv_criteria=params['conv_criteria'])
-                if np.argmax(df_eq_distr[0]) != eq_true:
-                    print('Failed syndrom, total now:', failed_syndroms)
-                    failed_syndroms += 1
-        if params['method'] == "MCMC_with_shortest":
-            assert params['noise'] == 'alpha'
-            if params['noise'] == "alpha":
-                df_eq_distr = MCMC_alpha_with_shortest(init_code, params['p_error'], alpha=params['alpha'])
-                if np.argmax(df_eq_distr[0:4]) != eq_true:
-                    print('Failed syndrom, total now:', failed_syndroms)
-                    failed_syndroms += 1
-        elif params['method'] == "EWD":
-            if params['noise'] == 'depolarizing':
-                assert params['onlyshortest'] == False, "onlyshortest not implemented for deoplarizing"
-                df_eq_distr = EWD(init_code, params['p_error'], params['p_sampling'], steps=params['steps'], droplets=params['droplets'])
-                df_eq_distr = np.array(df_eq_distr)
-                if np.argmax(df_eq_distr) != eq_true:
-                    print('Failed syndrom, total now:', failed_syndroms)
-                    failed_syndroms += 1
-            elif params['noise'] == 'alpha':
-                alpha=params['alpha']
-                p_tilde_sampling = params['p_sampling'] / (1 - params['p_sampling'])
-                pz_tilde_sampling = optimize.fsolve(lambda x: x + 2*x**alpha - p_tilde_sampling, 0.5)[0]
-                p_tilde = params['p_error'] / (1 - params['p_error'])
-                pz_tilde = optimize.fsolve(lambda x: x + 2*x**alpha - p_tilde, 0.5)[0]
-                df_eq_distr = EWD_alpha(init_code,
-                                         pz_tilde,
-                                         alpha,
-                                         params['steps'],
-                                         pz_tilde_sampling=pz_tilde_sampling,
-                                         onlyshortest=params['onlyshortest'])
-                df_eq_distr = np.array(df_eq_distr)
-            elif params['noise'] == 'biased':
-                p = params['p_error']
-                pz_tilde = p_z / (1 - p)
-                alpha = log(p_x/(1-p)) / log(p_z/(1-p))
-                p_tilde_sampling = params['p_sampling'] / (1 - params['p_sampling'])
-                pz_tilde_sampling = optimize.fsolve(lambda x: x + 2*x**alpha - p_tilde_sampling, 0.5)[0]
-                df_eq_distr = EWD_alpha(init_code,
-                                         pz_tilde,
-                                         alpha,
-                                         params['steps'],
-                                         pz_tilde_sampling=pz_tilde_sampling,
-                                         onlyshortest=params['onlyshortest'])
-                df_eq_distr = np.array(df_eq_distr)
-            else:
-                raise ValueError(f'''EWD does not support "{params['noise']}" noise''')
-        elif params['method'] == "ST":
-            if params['noise'] == 'depolarizing':
-                df_eq_distr = single_temp(init_code, params['p_error'], params['steps'])
-                df_eq_distr = np.array(df_eq_distr)
-                if np.argmin(df_eq_distr) != eq_true:
-                    print('Failed syndrom, total now:', failed_syndroms)
-                    failed_syndroms += 1
-            elif params['noise'] == 'alpha':
-                p_tilde = params['p_error'] / (1 - params['p_error'])
-                pz_tilde = optimize.fsolve(lambda x: x + 2*x**params['alpha'] - p_tilde, 0.5)[0]
-                df_eq_distr = single_temp_alpha(init_code,
-                                                pz_tilde,
-                                                params['alpha'],
-                                                params['steps'])
-                df_eq_distr = np.array(df_eq_distr)
-                if np.argmin(df_eq_distr) != eq_true:
-                    print('Failed syndrom, total now:', failed_syndroms)
-                    failed_syndroms += 1
-            else:
-                raise ValueError(f'''ST does not support "{params['noise']}" noise''')
-        elif params['method'] == "eMWPM":
-            out = class_sorted_mwpm(copy.deepcopy(init_code))
-            lens = np.zeros((4))
-            for j in range(4):
-                lens[j] = sum(out[j].chain_lengths())
-            choice = np.argmin(lens)
-            df_eq_distr = np.zeros((4)).astype(np.uint8)
-            df_eq_distr[choice] = 100
-            if np.argmax(df_eq_distr) != eq_true:
-                print('Failed syndrom, total now:', failed_syndroms)
-                failed_syndroms += 1
-        elif params['method'] == "MWPM":
-            choice = regular_mwpm(copy.deepcopy(init_code))
-            df_eq_distr = np.zeros((4)).astype(np.uint8)
-            df_eq_distr[choice] = 100
-            if np.argmax(df_eq_distr) != eq_true:
-                print('Failed syndrom, total now:', failed_syndroms)
-                failed_syndroms += 1
-
-        # Generate data for DataFrame storage  OBS now using full bincount, change this
+    # Loop to generate data points, in this process or sharded over the workers
+    points = _generate_points(params, nbr_datapoints, session, workers, cancel)
+    for i, (df_qubit, df_eq_distr, failed) in enumerate(points):
+        if failed:
+            print('Failed syndrom, total now:', failed_syndroms)
+            failed_syndroms += 1
 
         # Create indices for generated data
         names = ['data_nr', 'type']
@@ -268,6 +366,9 @@ def generate(file_path, params, nbr_datapoints=10**6, fixed_errors=None):
             print('Desired amount of failed syndroms achieved, stopping data generation.')
             break
 
+    # stops the workers from taking new points if the loop ended early, and cancels the points in flight
+    points.close()
+
     # Adds any remaining data from temporary list to data file when run is over
     if len(df_list) > 0:
         df = df.append(df_list)
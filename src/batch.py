@@ -0,0 +1,89 @@
+import numpy as np
+from numba import njit
+
+from src.fingerprint import zobrist_keys, _fingerprint
+from src.lattice import lattice_table, _update_chain_fast, _ewd_droplet
+
+# Chains of many syndromes advanced together in one compiled call, used by decoders.decode_many.
+# Chain c is row c of states (a flattened qubit_matrix), lengths (x, y, z) and fingerprints, the rows of a
+# syndrome are consecutive with copies rows per class.
+
+
+def pack_chains(codes, copies=1, randomize=False):
+    '''
+    (states, lengths, fingerprints) of copies chains in every class of each of the codes, which all have to be of
+    the same model and size. Chain (b * nbr_eq_classes + eq) * copies + k starts in class eq of codes[b], from
+    uniformly random stabilizers applied to it if randomize (as the EWD droplets).
+    '''
+    lattice = lattice_table(codes[0])
+    nbr_eq_classes = codes[0].nbr_eq_classes
+    states = np.zeros((len(codes) * nbr_eq_classes * copies, lattice.n_cells), dtype=np.uint8)
+    scratch = type(codes[0])(codes[0].system_size)
+    row = 0
+    for code in codes:
+        assert lattice_table(code) is lattice, 'all codes have to be of the same model and size'
+        for eq in range(nbr_eq_classes):
+            scratch.qubit_matrix = code.to_class(eq)
+            for _ in range(copies):
+                states[row] = (scratch.apply_stabilizers_uniform() if randomize else scratch.qubit_matrix).reshape(-1)
+                row += 1
+    lengths, fingerprints = _chain_init(states, zobrist_keys(lattice.shape))
+    return states, lengths, fingerprints
+
+
+@njit(cache=True)
+def _chain_init(states, keys):
+    lengths = np.zeros((states.shape[0], 3), dtype=np.int64)
+    fingerprints = np.zeros((states.shape[0], 2), dtype=np.uint64)
+    for c in range(states.shape[0]):
+        for q in range(states.shape[1]):
+            if states[c, q] != 0:
+                lengths[c, states[c, q] - 1] += 1
+        fingerprints[c] = _fingerprint(states[c], keys)
+    return lengths, fingerprints
+
+
+@njit(cache=True, nogil=True)
+def _ewd_batch(states, lengths, fingerprints, stab_fingerprints, stabilizer_table, acceptance, steps, iters,
+               conv_mult, log_weights, max_gap):
+    # a lattice._ewd_droplet on every chain. The unique chains of chain c are rows offsets[c]:offsets[c + 1]
+    # of the returned fingerprints and lengths, skipped[c] is the weight pruned by it
+    n_chains = states.shape[0]
+    offsets = np.zeros(n_chains + 1, dtype=np.int64)
+    skipped = np.zeros(n_chains)
+    unique_fingerprints = np.zeros((1024, 2), dtype=np.uint64)
+    unique_lengths = np.zeros((1024, 3), dtype=np.int64)
+    for c in range(n_chains):
+        chain_fingerprints, chain_lengths, skipped[c] = _ewd_droplet(states[c], lengths[c], fingerprints[c],
+                                                                     stab_fingerprints, stabilizer_table, acceptance,
+                                                                     steps, iters, conv_mult, log_weights, max_gap)
+        start = offsets[c]
+        end = start + chain_lengths.shape[0]
+        if end > unique_lengths.shape[0]:
+            capacity = max(end, 2 * unique_lengths.shape[0])
+            grown_fingerprints = np.zeros((capacity, 2), dtype=np.uint64)
+            grown_lengths = np.zeros((capacity, 3), dtype=np.int64)
+            grown_fingerprints[:start] = unique_fingerprints[:start]
+            grown_lengths[:start] = unique_lengths[:start]
+            unique_fingerprints, unique_lengths = grown_fingerprints, grown_lengths
+        unique_fingerprints[start:end] = chain_fingerprints
+        unique_lengths[start:end] = chain_lengths
+        offsets[c + 1] = end
+    return unique_fingerprints[:offsets[n_chains]], unique_lengths[:offsets[n_chains]], offsets, skipped
+
+
+@njit(cache=True, nogil=True)
+def _single_temp_batch(states, lengths, fingerprints, stab_fingerprints, stabilizer_table, acceptance, max_iters,
+                       energy_weights):
+    # mean energy (energy_weights dot (n_x, n_y, n_z)) of every chain over max_iters - 1 rounds of 5 steps,
+    # as decoders.single_temp
+    means = np.zeros(states.shape[0])
+    for c in range(states.shape[0]):
+        total = 0.0
+        for j in range(max_iters - 1):
+            _update_chain_fast(states[c], lengths[c], fingerprints[c], stab_fingerprints, stabilizer_table,
+                               acceptance, 5)
+            total += energy_weights[0] * lengths[c, 0] + energy_weights[1] * lengths[c, 1] + \
+                energy_weights[2] * lengths[c, 2]
+        means[c] = total / max(max_iters - 1, 1)
+    return means
@@ -0,0 +1,164 @@
+import numpy as np
+from numba import njit
+
+# Zobrist fingerprints of error chains
+# Every qubit q gets two random 128 bit keys K0[q], K1[q] (stored as two uint64 words) and the
+# fingerprint of a chain is the xor over all qubits of key(q, pauli) = b0 * K0[q] ^ b1 * K1[q],
+# where (b1, b0) are the bits of the pauli (1 = x, 2 = y, 3 = z). Since the keys are linear in the
+# pauli, applying an operator changes the fingerprint by the xor of key(q, op) over its support only,
+# independent of the current state of the qubits.
+
+# fixed seed, fingerprints have to agree between processes (droplets) to merge unique chains
+_ZOBRIST_SEED = 20211202
+
+_keys_cache = {}
+
+
+def zobrist_keys(shape):
+    # keys[q, pauli, word] for every cell q of a flattened qubit_matrix of the given shape
+    shape = tuple(shape)
+    if shape not in _keys_cache:
+        n_cells = int(np.prod(shape))
+        rng = np.random.default_rng([_ZOBRIST_SEED, *shape])
+        k0 = rng.integers(0, 2**64, size=(n_cells, 2), dtype=np.uint64, endpoint=False)
+        k1 = rng.integers(0, 2**64, size=(n_cells, 2), dtype=np.uint64, endpoint=False)
+        keys = np.zeros((n_cells, 4, 2), dtype=np.uint64)
+        keys[:, 1] = k0
+        keys[:, 2] = k1
+        keys[:, 3] = k0 ^ k1
+        _keys_cache[shape] = keys
+    return _keys_cache[shape]
+
+
+def fingerprint_key(fp):
+    # 128 bit python integer of a fingerprint, used as key for dicts and sets of unique chains
+    return (int(fp[0]) << 64) | int(fp[1])
+
+
+@njit(cache=True)
+def _fingerprint(qubits, keys):
+    fp = np.zeros(2, dtype=np.uint64)
+    for q in range(qubits.shape[0]):
+        fp[0] ^= keys[q, qubits[q], 0]
+        fp[1] ^= keys[q, qubits[q], 1]
+    return fp
+
+
+class Fingerprint_set():
+    '''
+    Open addressing hash set of fingerprints, with a row of values (e.g. the (x, y, z) lengths) for every chain.
+    Slots are found by linear probing from the low bits of the second fingerprint word, which are already
+    uniformly random, and the table doubles when it gets half full. Keys are stored xor _SET_SALT so that
+    an all zero row can mark an empty slot (the chain without errors has fingerprint 0). Used as storage for
+    unique chains, 16 + 8 * width bytes per slot instead of the python objects of a dict.
+    '''
+    def __init__(self, width=3, dtype=np.int64, capacity=1024):
+        capacity = _set_capacity(capacity)
+        self.keys = np.zeros((capacity, 2), dtype=np.uint64)
+        self.values = np.zeros((capacity, width), dtype=dtype)
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    # adds the chains that are not in the set yet, values of chains already in the set are kept
+    def update(self, fingerprints, values):
+        values = np.asarray(values, dtype=self.values.dtype).reshape(len(fingerprints), -1)
+        self.keys, self.values, self.count = _set_update(self.keys, self.values, self.count,
+                                                         np.ascontiguousarray(fingerprints, dtype=np.uint64), values)
+
+    def merge(self, other):
+        self.update(*other.items())
+
+    # (fingerprints, values) of all chains in the set, as compact arrays
+    def items(self):
+        return _set_items(self.keys, self.values, self.count)
+
+
+def unique_chains(fingerprints, values):
+    # keeps one row per fingerprint, used to merge the unique chains found by several droplets
+    chains = Fingerprint_set(values.shape[1], values.dtype, 2 * len(fingerprints))
+    chains.update(fingerprints, values)
+    return chains.items()
+
+
+def _set_capacity(n):
+    # smallest power of two >= n
+    capacity = 16
+    while capacity < n:
+        capacity *= 2
+    return capacity
+
+
+_SET_SALT = np.random.default_rng(_ZOBRIST_SEED + 1).integers(1, 2**64, size=2, dtype=np.uint64, endpoint=False)
+
+
+# kernels on the arrays of a Fingerprint_set, also used directly by the droplet and tempering kernels:
+#   i = _set_slot(keys, fp0, fp1)
+#   if _set_empty(keys, i):
+#       keys, values, i = _set_reserve(keys, values, count, fp0, fp1)
+#       _set_store(keys, i, fp0, fp1) ...
+@njit(cache=True)
+def _set_slot(keys, fp0, fp1):
+    # slot holding (fp0, fp1), or the empty slot where it should be inserted
+    k0 = fp0 ^ _SET_SALT[0]
+    k1 = fp1 ^ _SET_SALT[1]
+    mask = keys.shape[0] - 1
+    i = np.int64(fp1 & np.uint64(mask))
+    while (keys[i, 0] != k0 or keys[i, 1] != k1) and (keys[i, 0] != 0 or keys[i, 1] != 0):
+        i = (i + 1) & mask
+    return i
+
+
+@njit(cache=True)
+def _set_empty(keys, i):
+    return keys[i, 0] == 0 and keys[i, 1] == 0
+
+
+@njit(cache=True)
+def _set_store(keys, i, fp0, fp1):
+    keys[i, 0] = fp0 ^ _SET_SALT[0]
+    keys[i, 1] = fp1 ^ _SET_SALT[1]
+
+
+@njit(cache=True)
+def _set_reserve(keys, values, count, fp0, fp1):
+    # doubles the table if one more chain would make it more than half full, returns the slot for (fp0, fp1)
+    if 2 * (count + 1) > keys.shape[0]:
+        capacity = 2 * keys.shape[0]
+        new_keys = np.zeros((capacity, 2), dtype=keys.dtype)
+        new_values = np.zeros((capacity, values.shape[1]), dtype=values.dtype)
+        for i in range(keys.shape[0]):
+            if not _set_empty(keys, i):
+                j = _set_slot(new_keys, keys[i, 0] ^ _SET_SALT[0], keys[i, 1] ^ _SET_SALT[1])
+                new_keys[j] = keys[i]
+                new_values[j] = values[i]
+        keys = new_keys
+        values = new_values
+    return keys, values, _set_slot(keys, fp0, fp1)
+
+
+@njit(cache=True)
+def _set_update(keys, values, count, fingerprints, new_values):
+    for k in range(fingerprints.shape[0]):
+        i = _set_slot(keys, fingerprints[k, 0], fingerprints[k, 1])
+        if _set_empty(keys, i):
+            keys, values, i = _set_reserve(keys, values, count, fingerprints[k, 0], fingerprints[k, 1])
+            _set_store(keys, i, fingerprints[k, 0], fingerprints[k, 1])
+            values[i] = new_values[k]
+            count += 1
+    return keys, values, count
+
+
+@njit(cache=True)
+def _set_items(keys, values, count):
+    fingerprints = np.empty((count, 2), dtype=keys.dtype)
+    chain_values = np.empty((count, values.shape[1]), dtype=values.dtype)
+    k = 0
+    for i in range(keys.shape[0]):
+        if not _set_empty(keys, i):
+            fingerprints[k, 0] = keys[i, 0] ^ _SET_SALT[0]
+            fingerprints[k, 1] = keys[i, 1] ^ _SET_SALT[1]
+            chain_values[k] = values[i]
+            k += 1
+    return fingerprints, chain_values
@@ -0,0 +1,343 @@
+import numpy as np
+from math import exp
+from random import random
+from numba import njit
+
+from src.fingerprint import zobrist_keys, _set_slot, _set_empty, _set_store, _set_reserve, _set_items
+
+
+class Lattice():
+    '''
+    Flat description of a code model of a given size, built once by probing the compiled functions of the model.
+    Qubits are indexed by their position q in qubit_matrix.ravel(), paulis are encoded as in the models.
+    Operator supports are stored as (n_ops, max_weight) arrays of qubits and paulis, padded with
+    identities on qubit 0 so that the kernels can loop over a fixed width without branching.
+    Qubits also have a compact index 0..n_qubits-1 over the cells that hold a qubit (not the padding of the planar
+    code), with the same tables in compact indices; compact and expand convert between the two layouts.
+    '''
+    def __init__(self, code):
+        probe = type(code)(code.system_size)
+        self.system_size = code.system_size
+        self.nbr_eq_classes = code.nbr_eq_classes
+        self.shape = probe.qubit_matrix.shape
+        self.n_cells = probe.qubit_matrix.size
+
+        # stabilizer supports, groups without sites (e.g. the half stabilizers of the smallest codes) are left out
+        groups = [(np.array(sites, dtype=np.int64).reshape(-1, 3), prob) for sites, prob in probe.stabilizer_sites()]
+        groups = [(sites, prob) for sites, prob in groups if len(sites) > 0]
+        self.stab_sites = np.concatenate([sites for sites, _ in groups])
+        supports = [probe.apply_stabilizer(row, col, operator)[0] for row, col, operator in self.stab_sites]
+        self.stab_qubits, self.stab_paulis, self.stab_weight = _support_table(supports)
+        self.max_weight = self.stab_qubits.shape[1]
+        # cells of qubit_matrix that hold a qubit, every qubit is in the support of a stabilizer.
+        # Compact qubit i is cell qubit_cells[i], cell_qubits is the inverse (-1 for cells without a qubit)
+        self.qubit_cells = np.unique(self.stab_qubits[self.stab_paulis != 0])
+        self.n_qubits = len(self.qubit_cells)
+        self.cell_qubits = np.full(self.n_cells, -1, dtype=np.int64)
+        self.cell_qubits[self.qubit_cells] = np.arange(self.n_qubits)
+        self.compact_stab_qubits = self._compact_support(self.stab_qubits, self.stab_paulis)
+
+        # probability of proposing each stabilizer, as in _random_stabilizer of the model (renormalised over the
+        # groups left), sampled with the alias method so that a draw costs one random number and no search
+        self.stab_prob = np.concatenate([np.full(len(sites), prob / len(sites)) for sites, prob in groups])
+        self.stab_prob /= self.stab_prob.sum()
+        self.stab_cutoff, self.stab_alias = _alias_table(self.stab_prob)
+
+        # logical generators: one representative for each independent bit of the equivalence class,
+        # picked with as low weight as possible. Applying each with probability 1/2 gives a uniform class
+        candidates = sorted(range(1, self.nbr_eq_classes), key=lambda eq: np.count_nonzero(probe.to_class(eq)))
+        reachable = {0}
+        logicals = []
+        logical_classes = []
+        for eq in candidates:
+            if eq not in reachable:
+                logicals.append(probe.to_class(eq))
+                logical_classes.append(eq)
+                reachable |= {r ^ eq for r in reachable}
+        self.logical_qubits, self.logical_paulis, self.logical_weight = _support_table(logicals)
+        # applying generator k changes the class of a chain by xor with logical_classes[k]
+        self.logical_classes = np.array(logical_classes, dtype=np.int64)
+        self.compact_logical_qubits = self._compact_support(self.logical_qubits, self.logical_paulis)
+
+        # the equivalence class is linear in the errors: it is the xor of the contributions
+        # of an x error (eq_x) and a z error (eq_z) on every qubit, y being x and z
+        self.eq_x = np.zeros(self.n_cells, dtype=np.int64)
+        self.eq_z = np.zeros(self.n_cells, dtype=np.int64)
+        flat = probe.qubit_matrix.reshape(-1)
+        for q in range(self.n_cells):
+            flat[q] = 1
+            self.eq_x[q] = probe.define_equivalence_class()
+            flat[q] = 3
+            self.eq_z[q] = probe.define_equivalence_class()
+            flat[q] = 0
+
+        self._stab_fingerprints = None
+        self._logical_fingerprints = None
+        self._qubit_keys = None
+
+    # arrays needed by the kernels to draw and apply random stabilizers
+    @property
+    def stabilizer_table(self):
+        return self.stab_qubits, self.stab_paulis, self.stab_cutoff, self.stab_alias
+
+    # arrays needed by the kernels to apply random logicals
+    @property
+    def logical_table(self):
+        return self.logical_qubits, self.logical_paulis
+
+    # the same tables for compact states
+    @property
+    def compact_stabilizer_table(self):
+        return self.compact_stab_qubits, self.stab_paulis, self.stab_cutoff, self.stab_alias
+
+    @property
+    def compact_logical_table(self):
+        return self.compact_logical_qubits, self.logical_paulis
+
+    # compact state (n_qubits,) of a qubit_matrix, or of the last axis of an array of flattened qubit_matrices
+    def compact(self, qubit_matrix):
+        qubit_matrix = np.asarray(qubit_matrix)
+        if qubit_matrix.shape == self.shape:
+            qubit_matrix = qubit_matrix.reshape(-1)
+        return qubit_matrix[..., self.qubit_cells]
+
+    # qubit_matrix of a compact state, with zeros in the cells without a qubit (for the models, plots and MWPM)
+    def expand(self, qubits):
+        qubit_matrix = np.zeros(self.n_cells, dtype=np.uint8)
+        qubit_matrix[self.qubit_cells] = qubits
+        return qubit_matrix.reshape(self.shape)
+
+    # copy of a qubit_matrix with every stabilizer of the table applied with probability 1/2, a uniformly random
+    # element of the stabilizer group times the errors. Drawn from the random state of the compiled kernels
+    def apply_stabilizers_uniform(self, qubit_matrix):
+        qubits = np.array(qubit_matrix, dtype=np.uint8).reshape(-1)
+        _apply_stabilizers_uniform(qubits, self.stab_qubits, self.stab_paulis)
+        return qubits.reshape(self.shape)
+
+    def _compact_support(self, op_qubits, op_paulis):
+        # padding entries (identities) stay on qubit 0
+        return np.where(op_paulis != 0, self.cell_qubits[op_qubits], 0)
+
+    # change of the zobrist fingerprint when each stabilizer is applied
+    @property
+    def stab_fingerprints(self):
+        if self._stab_fingerprints is None:
+            self._stab_fingerprints = _operator_fingerprints(self.shape, self.stab_qubits, self.stab_paulis)
+        return self._stab_fingerprints
+
+    # zobrist keys of the compact qubits, fingerprints of compact states leave out the cells without a qubit
+    @property
+    def qubit_keys(self):
+        if self._qubit_keys is None:
+            self._qubit_keys = np.ascontiguousarray(zobrist_keys(self.shape)[self.qubit_cells])
+        return self._qubit_keys
+
+    # change of the zobrist fingerprint when each logical generator is applied
+    @property
+    def logical_fingerprints(self):
+        if self._logical_fingerprints is None:
+            self._logical_fingerprints = _operator_fingerprints(self.shape, self.logical_qubits, self.logical_paulis)
+        return self._logical_fingerprints
+
+
+def _support_table(matrices):
+    # (qubits, paulis, weight) arrays of the nonzero entries of each matrix
+    supports = [np.flatnonzero(matrix) for matrix in matrices]
+    max_weight = max(len(qubits) for qubits in supports)
+    op_qubits = np.zeros((len(matrices), max_weight), dtype=np.int64)
+    op_paulis = np.zeros((len(matrices), max_weight), dtype=np.uint8)
+    op_weight = np.zeros(len(matrices), dtype=np.int64)
+    for k, (matrix, qubits) in enumerate(zip(matrices, supports)):
+        op_weight[k] = len(qubits)
+        op_qubits[k, :len(qubits)] = qubits
+        op_paulis[k, :len(qubits)] = matrix.ravel()[qubits]
+    return op_qubits, op_paulis, op_weight
+
+
+def _operator_fingerprints(shape, op_qubits, op_paulis):
+    # padding entries are identities, key(q, 0) is zero
+    keys = zobrist_keys(shape)
+    fps = np.zeros((op_qubits.shape[0], 2), dtype=np.uint64)
+    for k in range(op_qubits.shape[0]):
+        for i in range(op_qubits.shape[1]):
+            fps[k] ^= keys[op_qubits[k, i], op_paulis[k, i]]
+    return fps
+
+
+def _alias_table(prob):
+    # Walker's alias method: draw k uniformly, keep it if the fractional part is below cutoff[k], else take alias[k]
+    n = len(prob)
+    scaled = np.asarray(prob, dtype=np.float64) * n / np.sum(prob)
+    cutoff = np.ones(n)
+    alias = np.arange(n, dtype=np.int64)
+    small = [k for k in range(n) if scaled[k] < 1]
+    large = [k for k in range(n) if scaled[k] >= 1]
+    while small and large:
+        s = small.pop()
+        l = large.pop()
+        cutoff[s] = scaled[s]
+        alias[s] = l
+        scaled[l] -= 1 - scaled[s]
+        if scaled[l] < 1:
+            small.append(l)
+        else:
+            large.append(l)
+    return cutoff, alias
+
+
+_lattice_cache = {}
+
+
+def lattice_table(code):
+    # one shared Lattice per (code model, size)
+    key = (type(code), code.system_size)
+    if key not in _lattice_cache:
+        _lattice_cache[key] = Lattice(code)
+    return _lattice_cache[key]
+
+
+def acceptance_table(weight, max_weight):
+    # metropolis acceptance probability min(1, weight(dx, dy, dz)) of a move that changes the number of
+    # (x, y, z) errors by (dx, dy, dz), stored at [dx + max_weight, dy + max_weight, dz + max_weight]
+    d = np.arange(-max_weight, max_weight + 1)
+    dx, dy, dz = np.meshgrid(d, d, d, indexing='ij')
+    with np.errstate(divide='ignore'):
+        table = weight(dx.astype(np.float64), dy.astype(np.float64), dz.astype(np.float64))
+    return np.ascontiguousarray(np.minimum(table, 1.0))
+
+
+def _log_weight(log_weights, dx, dy, dz):
+    # log of the relative weight of a change (dx, dy, dz) in the number of errors, 0 * log(0) taken as 0
+    with np.errstate(invalid='ignore'):
+        return sum(np.where(d != 0, w * d, 0.0) for w, d in zip(log_weights, (dx, dy, dz)))
+
+
+@njit(cache=True)
+def _chain_energy(lengths, log_weights):
+    # minus the log weight of a chain with lengths (x, y, z) errors, 0 * log(0) taken as 0
+    energy = 0.0
+    for k in range(3):
+        if lengths[k] != 0:
+            energy -= log_weights[k] * lengths[k]
+    return energy
+
+
+@njit(cache=True)
+def _random_stabilizer_index(stab_cutoff, stab_alias):
+    r = random() * stab_cutoff.shape[0]
+    k = int(r)
+    if r - k >= stab_cutoff[k]:
+        k = stab_alias[k]
+    return k
+
+
+# kernels on a flattened qubit_matrix (qubit_matrix.reshape(-1), a view, so commits change the matrix)
+@njit(cache=True)
+def _propose_operator(qubits, k, op_qubits, op_paulis):
+    # change in the number of (x, y, z) errors if operator k of the table was applied, qubits is not changed
+    dx = dy = dz = 0
+    for i in range(op_qubits.shape[1]):
+        old_qubit = qubits[op_qubits[k, i]]
+        new_qubit = old_qubit ^ op_paulis[k, i]
+        dx += int(new_qubit == 1) - int(old_qubit == 1)
+        dy += int(new_qubit == 2) - int(old_qubit == 2)
+        dz += int(new_qubit == 3) - int(old_qubit == 3)
+    return dx, dy, dz
+
+
+@njit(cache=True)
+def _commit_operator(qubits, k, op_qubits, op_paulis):
+    for i in range(op_qubits.shape[1]):
+        qubits[op_qubits[k, i]] ^= op_paulis[k, i]
+
+
+@njit(cache=True, nogil=True)
+def _apply_stabilizers_uniform(qubits, stab_qubits, stab_paulis):
+    for k in range(stab_qubits.shape[0]):
+        if random() < 0.5:
+            _commit_operator(qubits, k, stab_qubits, stab_paulis)
+
+
+@njit(cache=True, nogil=True)
+def _update_chain_fast(qubits, lengths, fingerprint, stab_fingerprints, stabilizer_table, acceptance, iters):
+    # metropolis updates of a flattened qubit_matrix with the acceptance probabilities from acceptance_table
+    stab_qubits, stab_paulis, stab_cutoff, stab_alias = stabilizer_table
+    n = acceptance.shape[0]
+    w = (n - 1) // 2
+    offset = (w * n + w) * n + w
+    acceptance_flat = acceptance.reshape(-1)
+    for _ in range(iters):
+        s = _random_stabilizer_index(stab_cutoff, stab_alias)
+        dx, dy, dz = _propose_operator(qubits, s, stab_qubits, stab_paulis)
+
+        # moves that don't increase the energy are always accepted, no need to draw a random number
+        p = acceptance_flat[offset + (dx * n + dy) * n + dz]
+        if p >= 1.0 or random() < p:
+            _commit_operator(qubits, s, stab_qubits, stab_paulis)
+            lengths[0] += dx
+            lengths[1] += dy
+            lengths[2] += dz
+            fingerprint[0] ^= stab_fingerprints[s, 0]
+            fingerprint[1] ^= stab_fingerprints[s, 1]
+
+
+@njit(cache=True, nogil=True)
+def _ewd_droplet(qubits, lengths, fingerprint, stab_fingerprints, stabilizer_table, acceptance, steps, iters, conv_mult, log_weights, max_gap):
+    # runs steps rounds of iters metropolis updates and records every unique chain seen after a round
+    droplet = _droplet_state(steps)
+    for step in range(steps):
+        _update_chain_fast(qubits, lengths, fingerprint, stab_fingerprints, stabilizer_table, acceptance, iters)
+        droplet, done = _droplet_record(droplet, lengths, fingerprint, log_weights, max_gap, conv_mult, step, steps)
+        if done:
+            break
+    return _droplet_items(droplet)
+
+
+# The bookkeeping of a droplet, shared by the kernels of all code representations: the open addressing set of the
+# unique chains with their lengths (see fingerprint.Fingerprint_set), the shortest length and the step sampling stops
+# at for conv_mult, and the lowest energy and skipped weight for the pruning
+@njit(cache=True)
+def _droplet_state(steps):
+    keys = np.zeros((1024, 2), dtype=np.uint64)
+    unique_lengths = np.zeros((1024, 3), dtype=np.int64)
+    return keys, unique_lengths, 0, np.iinfo(np.int64).max, float(steps), np.inf, 0.0
+
+
+@njit(cache=True)
+def _droplet_record(droplet, lengths, fingerprint, log_weights, max_gap, conv_mult, step, steps):
+    # records the chain after round step, returns the new state and if sampling is done.
+    # With conv_mult > 0 sampling stops once no new shortest chain has been found for conv_mult times
+    # the number of steps it took to find the current shortest (but not before 1% of steps)
+    keys, unique_lengths, n, shortest, stop, shortest_energy, skipped = droplet
+    # chains with a weight exp(-energy) below exp(-max_gap) times that of the lowest energy chain so far are
+    # not stored. skipped is the summed weight of the visits to them relative to the lowest energy chain
+    energy = _chain_energy(lengths, log_weights)
+    if energy < shortest_energy:
+        skipped *= exp(energy - shortest_energy)
+        shortest_energy = energy
+    if energy - shortest_energy > max_gap:
+        skipped += exp(shortest_energy - energy)
+    else:
+        i = _set_slot(keys, fingerprint[0], fingerprint[1])
+        if _set_empty(keys, i):
+            keys, unique_lengths, i = _set_reserve(keys, unique_lengths, n, fingerprint[0], fingerprint[1])
+            _set_store(keys, i, fingerprint[0], fingerprint[1])
+            unique_lengths[i] = lengths
+            n += 1
+
+            # if new shortest chain found, extend sampling time
+            length = lengths[0] + lengths[1] + lengths[2]
+            if conv_mult > 0 and length <= shortest:
+                shortest = length
+                stop = float(step * conv_mult)
+
+    done = conv_mult > 0 and step >= stop and step * 100 >= steps
+    return (keys, unique_lengths, n, shortest, stop, shortest_energy, skipped), done
+
+
+@njit(cache=True)
+def _droplet_items(droplet):
+    # (fingerprints, lengths) of the unique chains and the skipped weight
+    keys, unique_lengths, n, _, _, _, skipped = droplet
+    fingerprints, chain_lengths = _set_items(keys, unique_lengths, n)
+    return fingerprints, chain_lengths, skipped
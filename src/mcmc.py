@@ -1,22 +1,163 @@
 import numpy as np
 import random as rand
-import copy
+from math import exp
+
+from src.lattice import acceptance_table, _log_weight, _update_chain_fast, _ewd_droplet
+from src.fingerprint import fingerprint_key
+from src.packed_model import Packed_code, code_state, code_lattice, code_fingerprint, _update_chain_fast_packed, _ewd_droplet_packed
+from src.parallel_tempering import Replicas
+from src.sketch import _sketch_droplet, _sketch_droplet_packed
+from src.sparse_model import Sparse_code, _update_chain_fast_sparse, _ewd_droplet_sparse
+
+
+class Chain_base:
+    '''
+    State and fast sampling of a chain of errors on code, shared by the chains of each noise model, which only
+    define the log of the weight of one x, y and z error (log_weights) and the weight of a change (dx, dy, dz) in
+    the number of errors, from which the acceptance table of the kernels is built.
+    '''
+    def __init__(self, code, log_weights, weight):
+        self.code = code
+        self.p_logical = 0
+        self.flag = 0
 
-from numba import njit
+        # running number of (x, y, z) errors in self.code.qubit_matrix, updated by every accepted move
+        self.lengths = np.zeros(3, dtype=np.int64)
+        self._lengths_matrix = None
+        self.sync_lengths()
+
+        # log of the weight of one x, y and z error, used for swaps in compiled ladders
+        self.log_weights = log_weights
+
+        # acceptance probability of every possible change (dx, dy, dz) in the number of errors
+        self.acceptance = acceptance_table(weight, code_lattice(code).max_weight)
+
+        # 128 bit zobrist fingerprint of self.code.qubit_matrix, updated by the fast kernels
+        self._fingerprint = np.zeros(2, dtype=np.uint64)
+        self._fingerprint_matrix = None
+
+    # recount the errors if self.code.qubit_matrix has been replaced from outside of the chain
+    def sync_lengths(self):
+        if self._lengths_matrix is not code_state(self.code):
+            self.lengths[:] = self.code.chain_lengths()
+            self._lengths_matrix = code_state(self.code)
+
+    # recompute the fingerprint if self.code.qubit_matrix has been replaced since it was last updated
+    def sync_fingerprint(self):
+        if self._fingerprint_matrix is not code_state(self.code):
+            self._fingerprint[:] = code_fingerprint(self.code)
+            self._fingerprint_matrix = code_state(self.code)
+
+    # hashable fingerprint of the current chain, O(1) after fast updates
+    @property
+    def fingerprint(self):
+        self.sync_fingerprint()
+        return fingerprint_key(self._fingerprint)
+
+    def chain_lengths(self):
+        self.sync_lengths()
+        return self.lengths[0], self.lengths[1], self.lengths[2]
+
+    def count_errors(self):
+        self.sync_lengths()
+        return self.lengths.sum()
+
+    def _accept(self, new_matrix, dx, dy, dz):
+        self.sync_lengths()
+        self.code.qubit_matrix = new_matrix
+        self._lengths_matrix = code_state(self.code)
+        self.lengths += (dx, dy, dz)
 
-from src.xzzx_model import xzzx_code, _apply_random_stabilizer as apply_stabilizer_fast_xzzx
-from src.rotated_surface_model import RotSurCode, _apply_random_stabilizer as apply_stabilizer_fast_rotated
-from src.planar_model import Planar_code, _apply_random_stabilizer as apply_stabilizer_fast_planar, _count_errors_xyz
-from src.toric_model import Toric_code, _apply_random_stabilizer as apply_stabilizer_fast_toric
+    # runs iters number of steps of the metroplois-hastings algorithm
+    def update_chain(self, iters):
+        for _ in range(iters):
+            if self.p_logical != 0 and rand.random() < self.p_logical:
+                new_matrix, (dx, dy, dz) = self.code.apply_random_logical()
+            else:
+                new_matrix, (dx, dy, dz) = self.code.apply_random_stabilizer()
 
+            # acceptance ratio is the product of the weights of the changes in the number of errors
+            log_p = _log_weight(self.log_weights, dx, dy, dz)
+            if log_p >= 0 or rand.random() < exp(log_p):
+                self._accept(new_matrix, dx, dy, dz)
 
-class Chain:
-    def __init__(self, p, code):
+    def _sync_fast(self):
+        if not isinstance(self.code, (Packed_code, Sparse_code)) and not self.code.qubit_matrix.flags.c_contiguous:
+            self.code.qubit_matrix = np.ascontiguousarray(self.code.qubit_matrix)
+        self.sync_lengths()
+        self.sync_fingerprint()
+
+    # replaces the code by one with the same errors, e.g. a kernel result, lengths and fingerprint stay valid
+    def _replace_code(self, code):
         self.code = code
+        self._lengths_matrix = code_state(code)
+        self._fingerprint_matrix = code_state(code)
+
+    # the fast kernels update self.code.qubit_matrix, self.lengths and the fingerprint in place
+    def update_chain_fast(self, iters):
+        self._sync_fast()
+        lattice = code_lattice(self.code)
+        if isinstance(self.code, Packed_code):
+            _update_chain_fast_packed(self.code.planes, self.lengths, self._fingerprint, lattice.stab_fingerprints,
+                                      lattice.stabilizer_table, self.acceptance, iters)
+        elif isinstance(self.code, Sparse_code):
+            # switches to the dense model if the support grows past max_support
+            state = _update_chain_fast_sparse(self.code.slots, self.code.paulis, self.code.count, self.lengths,
+                                              self._fingerprint, lattice.stab_fingerprints, lattice.stabilizer_table,
+                                              self.acceptance, iters)
+            self._replace_code(self.code.replace_state(*state))
+        else:
+            _update_chain_fast(self.code.qubit_matrix.reshape(-1), self.lengths, self._fingerprint, lattice.stab_fingerprints,
+                               lattice.stabilizer_table, self.acceptance, iters)
+
+    # runs steps rounds of update_chain_fast(iters) in one compiled kernel and returns the fingerprints
+    # (n, 2) and (x, y, z) lengths (n, 3) of the unique chains seen after each round.
+    # With prune > 0 chains with a weight (by log_weights, default the sampling weights) below prune times that of
+    # the lowest energy chain found are not stored, skipped is the summed weight of the visits to them relative
+    # to the lowest energy chain (an upper bound on the weight left out)
+    def droplet(self, steps, iters=5, conv_mult=0, prune=0, log_weights=None):
+        self._sync_fast()
+        lattice = code_lattice(self.code)
+        log_weights = self.log_weights if log_weights is None else np.asarray(log_weights, dtype=np.float64)
+        max_gap = -np.log(prune) if prune > 0 else np.inf
+        args = (lattice.stab_fingerprints, lattice.stabilizer_table, self.acceptance, int(steps), iters,
+                float(conv_mult), log_weights, float(max_gap))
+        if isinstance(self.code, Packed_code):
+            return _ewd_droplet_packed(self.code.planes, self.lengths, self._fingerprint, *args)
+        elif isinstance(self.code, Sparse_code):
+            fingerprints, lengths, skipped, *state = _ewd_droplet_sparse(self.code.slots, self.code.paulis,
+                                                                         self.code.count, self.code.max_support,
+                                                                         lattice.n_cells, self.lengths,
+                                                                         self._fingerprint, *args)
+            self._replace_code(self.code.replace_state(*state))
+            return fingerprints, lengths, skipped
+        else:
+            return _ewd_droplet(self.code.qubit_matrix.reshape(-1), self.lengths, self._fingerprint, *args)
+
+    # as droplet, but the chains are counted in HyperLogLog sketches per bucket of lengths (sketch.Length_sketches)
+    # instead of being stored, returns the (keys, registers) arrays of the sketches
+    def droplet_sketch(self, steps, iters=5, precision=12, split=False):
+        self._sync_fast()
+        # sketches are meant for chains far too many to store, sampled on the dense model
+        if isinstance(self.code, Sparse_code):
+            self._replace_code(self.code.dense_code())
+        lattice = code_lattice(self.code)
+        args = (lattice.stab_fingerprints, lattice.stabilizer_table, self.acceptance, int(steps), iters,
+                int(precision), bool(split))
+        if isinstance(self.code, Packed_code):
+            return _sketch_droplet_packed(self.code.planes, self.lengths, self._fingerprint, *args)
+        else:
+            return _sketch_droplet(self.code.qubit_matrix.reshape(-1), self.lengths, self._fingerprint, *args)
+
+
+
+class Chain(Chain_base):
+    def __init__(self, p, code):
         self.p = p
-        self.p_logical = 0
-        self.flag = 0
         self.factor = ((self.p / 3.0) / (1.0 - self.p))  # rename me 
+        with np.errstate(divide='ignore'):
+            log_weights = np.full(3, np.log(self.factor))
+        super().__init__(code, log_weights, lambda dx, dy, dz: self.factor ** (dx + dy + dz))
 
     # runs iters number of steps of the metroplois-hastings algorithm
     def update_chain(self, iters):
@@ -33,11 +174,11 @@ class Chain:
                 # Avoid calculating r if possible. If self.p is 0.75 r = 1 and we accept all changes
                 # If the new qubit matrix has equal or fewer errors, r >= 1 and we also accept all changes
                 if self.p >= 0.75 or qubit_errors_change <= 0:
-                    self.code.qubit_matrix = new_matrix
+                    self._accept(new_matrix, dx, dy, dz)
                     continue
                 # acceptence ratio
                 if rand.random() < self.factor ** qubit_errors_change:
-                    self.code.qubit_matrix = new_matrix
+                    self._accept(new_matrix, dx, dy, dz)
 
         else:
             for _ in range(iters):
@@ -47,19 +188,19 @@ class Chain:
 
                 # acceptence ratio
                 if rand.random() < self.factor ** qubit_errors_change:
-                    self.code.qubit_matrix = new_matrix
+                    self._accept(new_matrix, dx, dy, dz)
 
-    def update_chain_fast(self, iters):
-        if isinstance(self.code, xzzx_code):
-            self.code.qubit_matrix = _update_chain_fast_xzzx(self.code.qubit_matrix, self.factor, iters)
-        elif isinstance(self.code, RotSurCode):
-            self.code.qubit_matrix = _update_chain_fast_rotated(self.code.qubit_matrix, self.factor, iters)
-        elif isinstance(self.code, Planar_code):
-            self.code.qubit_matrix = _update_chain_fast_planar(self.code.qubit_matrix, self.factor, iters)
-        elif isinstance(self.code, Toric_code):
-            self.code.qubit_matrix = _update_chain_fast_toric(self.code.qubit_matrix, self.factor, iters)
-        else:
-            raise ValueError("Fast chain updates not available for this code")
+
+class Chain_xyz(Chain_base):
+    '''
+    Chain sampled with independent weights for x, y and z errors, p_xyz is an array (p_x, p_y, p_z).
+    '''
+    def __init__(self, p_xyz, code):
+        self.p_xyz = np.asarray(p_xyz, dtype=np.float64)
+        self.factors = self.p_xyz / (1.0 - self.p_xyz.sum())
+        with np.errstate(divide='ignore'):
+            log_weights = np.log(self.factors)
+        super().__init__(code, log_weights, lambda dx, dy, dz: np.exp(_log_weight(log_weights, dx, dy, dz)))
 
 
 class Ladder:
@@ -81,113 +222,15 @@ class Ladder:
         p_ladder = np.linspace(p_bottom, p_top, Nc)
         self.p_ladder = p_ladder
 
-        # list of relative probabilities
-        self.p_diff = (p_ladder[:-1] * (1 - p_ladder[1:])) / (p_ladder[1:] * (1 - p_ladder[:-1]))
+        # log of the weight of one x, y and z error in each chain of increasing p
+        with np.errstate(divide='ignore'):
+            log_weights = np.log((p_ladder / 3) / (1 - p_ladder))
 
-        # list of Chains of increasing p
-        self.chains = [Chain(p, copy.deepcopy(init_code)) for p in p_ladder]
-
-        # special properties of top chain
-        self.chains[-1].flag = 1
-        self.chains[-1].p_logical = p_logical
+        # states of the chains, swapped by index
+        self.replicas = Replicas(init_code, np.repeat(log_weights[:, None], 3, axis=1), p_logical)
 
         # count of chains that have "fallen all the way down"
         self.tops0 = 0
 
-    def update_ladder(self, iters):
-        for chain in self.chains:
-            chain.update_chain(iters)
-
-    # returns true if flip should be performed
-    def r_flip(self, ind_lo):
-        # chain lengths
-        ne_lo = self.chains[ind_lo].code.count_errors()
-        ne_hi = self.chains[ind_lo + 1].code.count_errors()
-        # relative probabilities between chains (except exponent)
-        rel_p = self.p_diff[ind_lo]
-        return _r_flip(ne_lo, ne_hi, rel_p)
-
     def step(self, iters):
-        self.update_ladder(iters)
-        for i in reversed(range(self.Nc - 1)):
-            if self.r_flip(i):
-                self.chains[i].code, self.chains[i + 1].code = self.chains[i + 1].code, self.chains[i].code
-                self.chains[i].flag, self.chains[i + 1].flag = self.chains[i + 1].flag, self.chains[i].flag
-        self.chains[-1].flag = 1
-        if self.chains[0].flag == 1:
-            self.tops0 += 1
-            self.chains[0].flag = 0
-
-
-# class Chain_xyz:
-#     def __init__(self, p_xyz, code):
-#         self.code = code
-#         self.p_xyz = p_xyz
-#         self.factors = self.p_xyz / (1.0 - self.p_xyz.sum())  # rename me
-#         self.qubit_errors = code.count_errors_xyz()
-
-#     def update_chain_fast(self, iters):
-#         self.code.qubit_matrix, self.qubit_errors = _update_chain_fast_xyz(self.code.qubit_matrix, self.qubit_errors, self.factors, iters)
-
-
-@njit('(int64, int64, float64)')
-def _r_flip(ne_lo, ne_hi, rel_p):
-    if ne_hi < ne_lo:
-        return True
-    else:
-        return rand.random() < rel_p ** (ne_hi - ne_lo)
-
-
-@njit(cache=True)
-def _update_chain_fast_xzzx(qubit_matrix, factor, iters):
-    for _ in range(iters):
-        new_matrix, (dx, dy, dz) = apply_stabilizer_fast_xzzx(qubit_matrix)
-
-        # acceptence ratio
-        if rand.random() < factor ** (dx + dy + dz):
-            qubit_matrix = new_matrix
-    return qubit_matrix
-
-@njit(cache=True)
-def _update_chain_fast_rotated(qubit_matrix, factor, iters):
-    for _ in range(iters):
-        new_matrix, (dx, dy, dz) = apply_stabilizer_fast_rotated(qubit_matrix)
-
-        # acceptence ratio
-        if rand.random() < factor ** (dx + dy + dz):
-            qubit_matrix = new_matrix
-    return qubit_matrix
-
-@njit(cache=True)
-def _update_chain_fast_planar(qubit_matrix, factor, iters):
-    for _ in range(iters):
-        new_matrix, (dx, dy, dz) = apply_stabilizer_fast_planar(qubit_matrix)
-
-        # acceptence ratio
-        if rand.random() < factor ** (dx + dy + dz):
-            qubit_matrix = new_matrix
-    return qubit_matrix
-
-@njit(cache=True)
-def _update_chain_fast_toric(qubit_matrix, factor, iters):
-    for _ in range(iters):
-        new_matrix, (dx, dy, dz) = apply_stabilizer_fast_toric(qubit_matrix)
-
-        # acceptence ratio
-        if rand.random() < factor ** (dx + dy + dz):
-            qubit_matrix = new_matrix
-    return qubit_matrix
-
-
-# @njit(cache=True)
-# def _update_chain_fast_xyz(qubit_matrix, qubit_errors, factors, iters):
-#     for _ in range(iters):
-#         new_matrix, _ = _apply_random_stabilizer(qubit_matrix)
-#         qubit_errors_new = _count_errors_xyz(new_matrix)
-#         qubit_errors_change = qubit_errors_new - qubit_errors
-
-#         # acceptence ratio
-#         if rand.random() < (factors ** qubit_errors_change).prod():
-#             qubit_matrix = new_matrix
-#             qubit_errors = qubit_errors_new
-#     return qubit_matrix, qubit_errors
+        self.tops0 = self.replicas.step(iters, self.tops0)
@@ -1,23 +1,24 @@
 import numpy as np
 import random as rand
-import copy
 
-from numba import njit
+from src.mcmc import Chain_base
+from src.parallel_tempering import Replicas
 
-from src.xzzx_model import xzzx_code, _apply_random_stabilizer as apply_stabilizer_fast_xzzx
-from src.rotated_surface_model import RotSurCode, _apply_random_stabilizer as apply_stabilizer_fast_rotated
-from src.planar_model import Planar_code, _apply_random_stabilizer as apply_stabilizer_fast_planar
-from src.toric_model import Toric_code, _apply_random_stabilizer as apply_stabilizer_fast_toric
-from src.xyz2_model import xyz_code, _apply_random_stabilizer as apply_stabilizer_fast_xyzxyz
 
-class Chain_alpha:
+class Chain_alpha(Chain_base):
     def __init__(self, code, pz_tilde, alpha):
-        self.code = code
         self.pz_tilde = pz_tilde
         self.alpha = alpha
-        self.p_logical = 0
-        self.flag = 0
-    
+        with np.errstate(divide='ignore'):
+            log_weights = np.log(self.pz_tilde) * np.array([self.alpha, self.alpha, 1.0])
+        super().__init__(code, log_weights, lambda dx, dy, dz: self.pz_tilde**(dz + self.alpha*(dx + dy)))
+
+    # effective chain length n_z + alpha * (n_x + n_y)
+    @property
+    def n_eff(self):
+        nx, ny, nz = self.chain_lengths()
+        return nz + self.alpha * (nx + ny)
+
     # runs iters number of steps of the metroplois-hastings algorithm
     def update_chain(self, iters):
 
@@ -30,28 +31,15 @@ class Chain_alpha:
                     new_matrix, (dx, dy, dz) = self.code.apply_random_stabilizer()
                 
                 if rand.random() < self.pz_tilde**(dz + self.alpha*(dx + dy)):
-                    self.code.qubit_matrix = new_matrix
+                    self._accept(new_matrix, dx, dy, dz)
 
         else:
             for _ in range(iters):
                 new_matrix, (dx, dy, dz) = self.code.apply_random_stabilizer()
 
                 if rand.random() < self.pz_tilde**(dz + self.alpha*(dx + dy)):
-                    self.code.qubit_matrix = new_matrix
-
-    def update_chain_fast(self, iters):
-        if isinstance(self.code, xzzx_code):
-            self.code.qubit_matrix = _update_chain_fast_xzzx(self.code.qubit_matrix, self.pz_tilde, self.alpha, iters)
-        elif isinstance(self.code, RotSurCode):
-            self.code.qubit_matrix = _update_chain_fast_rotated(self.code.qubit_matrix, self.pz_tilde, self.alpha, iters)
-        elif isinstance(self.code, Planar_code):
-            self.code.qubit_matrix = _update_chain_fast_planar(self.code.qubit_matrix, self.pz_tilde, self.alpha, iters)
-        elif isinstance(self.code, Toric_code):
-            self.code.qubit_matrix = _update_chain_fast_toric(self.code.qubit_matrix, self.pz_tilde, self.alpha, iters)
-        elif isinstance(self.code, xyz_code):
-            self.code.qubit_matrix = _update_chain_fast_xyzxyz(self.code.qubit_matrix, self.pz_tilde, self.alpha, iters)
-        else:
-            raise ValueError("Fast chain updates not available for this code")
+                    self._accept(new_matrix, dx, dy, dz)
+
 
 class Ladder_alpha:
     def __init__(self, pz_tilde_bottom, init_code, alpha, Nc, p_logical=0):
@@ -76,96 +64,15 @@ class Ladder_alpha:
         pz_tilde_ladder = np.linspace(pz_tilde_bottom, pz_tilde_top, Nc)
         self.pz_tilde_ladder = pz_tilde_ladder
 
-        # list of relative probabilities
-        self.pz_tilde_diff = (pz_tilde_ladder[:-1] * (1 - pz_tilde_ladder[1:])) / (pz_tilde_ladder[1:] * (1 - pz_tilde_ladder[:-1]))
-        # list of Chains of increasing p
-        self.chains = [Chain_alpha(copy.deepcopy(init_code) ,pz_tilde, alpha) for pz_tilde in pz_tilde_ladder]
+        # log of the weight of one x, y and z error in each chain of increasing pz_tilde
+        with np.errstate(divide='ignore'):
+            log_weights = np.log(pz_tilde_ladder)[:, None] * np.array([alpha, alpha, 1.0])
 
-        # special properties of top chain
-        self.chains[-1].flag = 1
-        self.chains[-1].p_logical = p_logical
+        # states of the chains, swapped by index
+        self.replicas = Replicas(init_code, log_weights, p_logical)
 
         # count of chains that have "fallen all the way down"
         self.tops0 = 0
 
-    def update_ladder(self, iters):
-        for chain in self.chains:
-            chain.update_chain(iters)
-
-    # returns true if flip should be performed
-    def r_flip(self, ind_lo):
-        # chain lengths
-        pz_tilde_low = self.chains[ind_lo].pz_tilde
-        pz_tilde_high = self.chains[ind_lo+1].pz_tilde
-        nx, ny, nz = self.chains[ind_lo].code.chain_lengths()
-        n_eff_low = nz + self.chains[ind_lo].alpha * (nx + ny)
-        nx, ny, nz = self.chains[ind_lo+1].code.chain_lengths()
-        n_eff_high = nz + self.chains[ind_lo+1].alpha * (nx + ny)
-        return rand.random() < (pz_tilde_low/pz_tilde_high)**(n_eff_high-n_eff_low)
-
     def step(self, iters):
-        self.update_ladder(iters)
-        for i in reversed(range(self.Nc - 1)):
-            if self.r_flip(i):
-                self.chains[i].code, self.chains[i + 1].code = self.chains[i + 1].code, self.chains[i].code
-                self.chains[i].flag, self.chains[i + 1].flag = self.chains[i + 1].flag, self.chains[i].flag
-        self.chains[-1].flag = 1
-        if self.chains[0].flag == 1:
-            self.tops0 += 1
-            self.chains[0].flag = 0
-
-
-@njit(cache=True)
-def _update_chain_fast_xzzx(qubit_matrix, pz_tilde, alpha, iters):
-
-    for _ in range(iters):
-        new_matrix, (dx, dy, dz) = apply_stabilizer_fast_xzzx(qubit_matrix)
-        
-        p = pz_tilde**(dz + alpha*(dx + dy))
-        if p > 1 or rand.random() < p:
-            qubit_matrix = new_matrix
-    return qubit_matrix
-
-@njit(cache=True)
-def _update_chain_fast_rotated(qubit_matrix, pz_tilde, alpha, iters):
-
-    for _ in range(iters):
-        new_matrix, (dx, dy, dz) = apply_stabilizer_fast_rotated(qubit_matrix)
-
-        p = pz_tilde**(dz + alpha*(dx + dy))
-        if p > 1 or rand.random() < p:
-            qubit_matrix = new_matrix
-    return qubit_matrix
-
-@njit(cache=True)
-def _update_chain_fast_planar(qubit_matrix, pz_tilde, alpha, iters):
-
-    for _ in range(iters):
-        new_matrix, (dx, dy, dz) = apply_stabilizer_fast_planar(qubit_matrix)
-
-        p = pz_tilde**(dz + alpha*(dx + dy))
-        if p > 1 or rand.random() < p:
-            qubit_matrix = new_matrix
-    return qubit_matrix
-
-@njit(cache=True)
-def _update_chain_fast_toric(qubit_matrix, pz_tilde, alpha, iters):
-
-    for _ in range(iters):
-        new_matrix, (dx, dy, dz) = apply_stabilizer_fast_toric(qubit_matrix)
-        
-        p = pz_tilde**(dz + alpha*(dx + dy))
-        if p > 1 or rand.random() < p:
-            qubit_matrix = new_matrix
-    return qubit_matrix
-
-@njit(cache=True)
-def _update_chain_fast_xyzxyz(qubit_matrix, pz_tilde, alpha, iters):
-
-    for _ in range(iters):
-        new_matrix, (dx, dy, dz) = apply_stabilizer_fast_xyzxyz(qubit_matrix)
-        
-        p = pz_tilde**(dz + alpha*(dx + dy))
-        if p > 1 or rand.random() < p:
-            qubit_matrix = new_matrix
-    return qubit_matrix
+        self.tops0 = self.replicas.step(iters, self.tops0)
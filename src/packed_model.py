@@ -0,0 +1,256 @@
+import numpy as np
+from random import random
+from numba import njit
+
+from src.fingerprint import _fingerprint
+from src.lattice import lattice_table, _random_stabilizer_index, _droplet_state, _droplet_record, _droplet_items
+
+# constants for bit manipulation, uint64 to keep numba from promoting to float
+_ONE = np.uint64(1)
+_M1 = np.uint64(0x5555555555555555)
+_M2 = np.uint64(0x3333333333333333)
+_M4 = np.uint64(0x0f0f0f0f0f0f0f0f)
+_H01 = np.uint64(0x0101010101010101)
+
+
+class Packed_code():
+    '''
+    Bit-plane representation of any of the code models. planes[0] holds the x-parts and planes[1] the z-parts
+    of the errors, packed into uint64 words: qubit q (position in qubit_matrix.ravel()) is bit q % 64 of word q // 64.
+    x is (1, 0), y is (1, 1) and z is (0, 1).
+    '''
+    def __init__(self, code):
+        self.code_class = type(code)
+        self.system_size = code.system_size
+        self.nbr_eq_classes = code.nbr_eq_classes
+        self.lattice = lattice_table(code)
+        self.eq_masks = _class_masks(self.lattice)
+        self.planes = pack(code.qubit_matrix)
+
+    # array replaced whenever the errors are, see code_state
+    @property
+    def state(self):
+        return self.planes
+
+    # dense view of the errors, as used by the code models
+    @property
+    def qubit_matrix(self):
+        return _unpack(self.planes, self.lattice.n_cells).reshape(self.lattice.shape)
+
+    @qubit_matrix.setter
+    def qubit_matrix(self, qubit_matrix):
+        self.planes = pack(qubit_matrix)
+
+    # dense code model with the same errors, used for everything that is not performance critical
+    def dense_code(self):
+        code = self.code_class(self.system_size)
+        code.qubit_matrix = self.qubit_matrix
+        return code
+
+    def chain_lengths(self):
+        return _chain_lengths(self.planes)
+
+    def count_errors(self):
+        return _count_errors(self.planes)
+
+    def define_equivalence_class(self):
+        return _define_equivalence_class(self.planes, self.eq_masks)
+
+    # like the dense models these return a new dense qubit_matrix and the change in the number of (x, y, z) errors
+    def apply_stabilizer(self, index: int):
+        result_planes = np.copy(self.planes)
+        n_eq = _propose_operator(self.planes, index, self.lattice.stab_qubits, self.lattice.stab_paulis)
+        _commit_operator(result_planes, index, self.lattice.stab_qubits, self.lattice.stab_paulis)
+        return _unpack(result_planes, self.lattice.n_cells).reshape(self.lattice.shape), n_eq
+
+    def apply_random_stabilizer(self):
+        index = _random_stabilizer_index(self.lattice.stab_cutoff, self.lattice.stab_alias)
+        return self.apply_stabilizer(index)
+
+    def apply_random_logical(self):
+        result_planes = np.copy(self.planes)
+        n_eq = _apply_random_logical(result_planes, *self.lattice.logical_table)
+        return _unpack(result_planes, self.lattice.n_cells).reshape(self.lattice.shape), n_eq
+
+    # uniform stabilizers and class changes are applied through the dense model
+
+    def apply_stabilizers_uniform(self, p=0.5):
+        return self.dense_code().apply_stabilizers_uniform(p)
+
+    def to_class(self, eq):
+        return self.dense_code().to_class(eq)
+
+
+# array holding the errors of a code, used by the chains to detect when the errors have been replaced.
+# Packed_code and sparse_model.Sparse_code have their own state and lattice
+def code_state(code):
+    return code.state if hasattr(code, 'state') else code.qubit_matrix
+
+
+def code_lattice(code):
+    return code.lattice if hasattr(code, 'lattice') else lattice_table(code)
+
+
+# zobrist fingerprint of the errors of a code, computed on the support if the code can do that
+# and otherwise on the cells that hold a qubit
+def code_fingerprint(code):
+    if hasattr(code, 'fingerprint'):
+        return code.fingerprint()
+    lattice = code_lattice(code)
+    return _fingerprint(lattice.compact(code.qubit_matrix), lattice.qubit_keys)
+
+
+def pack(qubit_matrix):
+    return _pack(np.ascontiguousarray(qubit_matrix).reshape(-1))
+
+
+def _class_masks(lattice):
+    # masks[0, b] (masks[1, b]) has the qubits where an x (z) error flips bit b of the equivalence class
+    nbr_bits = int(np.log2(lattice.nbr_eq_classes))
+    n_words = (lattice.n_cells + 63) // 64
+    masks = np.zeros((2, nbr_bits, n_words), dtype=np.uint64)
+    for b in range(nbr_bits):
+        masks[0, b] = pack(((lattice.eq_x >> b) & 1).astype(np.uint8))[0]
+        masks[1, b] = pack((((lattice.eq_z >> b) & 1) * 3).astype(np.uint8))[1]
+    return masks
+
+
+@njit(cache=True)
+def _pack(qubits):
+    n_words = (qubits.shape[0] + 63) // 64
+    planes = np.zeros((2, n_words), dtype=np.uint64)
+    for q in range(qubits.shape[0]):
+        bit = _ONE << np.uint64(q & 63)
+        if qubits[q] == 1 or qubits[q] == 2:
+            planes[0, q >> 6] |= bit
+        if qubits[q] == 2 or qubits[q] == 3:
+            planes[1, q >> 6] |= bit
+    return planes
+
+
+@njit(cache=True)
+def _unpack(planes, n_cells):
+    qubits = np.zeros(n_cells, dtype=np.uint8)
+    for q in range(n_cells):
+        qubits[q] = _get_qubit(planes, q)
+    return qubits
+
+
+@njit(cache=True)
+def _get_qubit(planes, q):
+    shift = np.uint64(q & 63)
+    x = (planes[0, q >> 6] >> shift) & _ONE
+    z = (planes[1, q >> 6] >> shift) & _ONE
+    # x -> 1, z -> 3, x and z -> 2
+    return np.uint8(x ^ (z * np.uint64(3)))
+
+
+@njit(cache=True)
+def _popcount(w):
+    w = w - ((w >> _ONE) & _M1)
+    w = (w & _M2) + ((w >> np.uint64(2)) & _M2)
+    w = (w + (w >> np.uint64(4))) & _M4
+    return (w * _H01) >> np.uint64(56)
+
+
+@njit(cache=True)
+def _count_errors(planes):
+    n = 0
+    for w in range(planes.shape[1]):
+        n += _popcount(planes[0, w] | planes[1, w])
+    return n
+
+
+@njit(cache=True)
+def _chain_lengths(planes):
+    nx = ny = nz = 0
+    for w in range(planes.shape[1]):
+        x = planes[0, w]
+        z = planes[1, w]
+        nx += _popcount(x & ~z)
+        ny += _popcount(x & z)
+        nz += _popcount(~x & z)
+    return nx, ny, nz
+
+
+@njit(cache=True)
+def _define_equivalence_class(planes, masks):
+    eq = 0
+    for b in range(masks.shape[1]):
+        parity = 0
+        for w in range(planes.shape[1]):
+            parity += _popcount(planes[0, w] & masks[0, b, w]) + _popcount(planes[1, w] & masks[1, b, w])
+        eq |= (parity & 1) << b
+    return eq
+
+
+@njit(cache=True)
+def _propose_operator(planes, k, op_qubits, op_paulis):
+    # change in the number of (x, y, z) errors if operator k of the table was applied, planes is not changed
+    dx = dy = dz = 0
+    for i in range(op_qubits.shape[1]):
+        old_qubit = _get_qubit(planes, op_qubits[k, i])
+        new_qubit = old_qubit ^ op_paulis[k, i]
+        dx += int(new_qubit == 1) - int(old_qubit == 1)
+        dy += int(new_qubit == 2) - int(old_qubit == 2)
+        dz += int(new_qubit == 3) - int(old_qubit == 3)
+    return dx, dy, dz
+
+
+@njit(cache=True)
+def _commit_operator(planes, k, op_qubits, op_paulis):
+    # applies operator k of the table to planes in place
+    for i in range(op_qubits.shape[1]):
+        q = op_qubits[k, i]
+        op = np.uint64(op_paulis[k, i])
+        bit = np.uint64(q & 63)
+        planes[0, q >> 6] ^= ((op ^ (op >> _ONE)) & _ONE) << bit
+        planes[1, q >> 6] ^= (op >> _ONE) << bit
+
+
+@njit(cache=True)
+def _apply_random_logical(planes, logical_qubits, logical_paulis):
+    # applies every logical generator with probability 1/2 to planes in place
+    dx = dy = dz = 0
+    for k in range(logical_qubits.shape[0]):
+        if random() < 0.5:
+            ddx, ddy, ddz = _propose_operator(planes, k, logical_qubits, logical_paulis)
+            _commit_operator(planes, k, logical_qubits, logical_paulis)
+            dx += ddx
+            dy += ddy
+            dz += ddz
+    return dx, dy, dz
+
+
+@njit(cache=True, nogil=True)
+def _update_chain_fast_packed(planes, lengths, fingerprint, stab_fingerprints, stabilizer_table, acceptance, iters):
+    # metropolis updates with the acceptance probabilities from lattice.acceptance_table
+    stab_qubits, stab_paulis, stab_cutoff, stab_alias = stabilizer_table
+    n = acceptance.shape[0]
+    w = (n - 1) // 2
+    offset = (w * n + w) * n + w
+    acceptance_flat = acceptance.reshape(-1)
+    for _ in range(iters):
+        s = _random_stabilizer_index(stab_cutoff, stab_alias)
+        dx, dy, dz = _propose_operator(planes, s, stab_qubits, stab_paulis)
+
+        p = acceptance_flat[offset + (dx * n + dy) * n + dz]
+        if p >= 1.0 or random() < p:
+            _commit_operator(planes, s, stab_qubits, stab_paulis)
+            lengths[0] += dx
+            lengths[1] += dy
+            lengths[2] += dz
+            fingerprint[0] ^= stab_fingerprints[s, 0]
+            fingerprint[1] ^= stab_fingerprints[s, 1]
+
+
+@njit(cache=True, nogil=True)
+def _ewd_droplet_packed(planes, lengths, fingerprint, stab_fingerprints, stabilizer_table, acceptance, steps, iters, conv_mult, log_weights, max_gap):
+    # same as lattice._ewd_droplet
+    droplet = _droplet_state(steps)
+    for step in range(steps):
+        _update_chain_fast_packed(planes, lengths, fingerprint, stab_fingerprints, stabilizer_table, acceptance, iters)
+        droplet, done = _droplet_record(droplet, lengths, fingerprint, log_weights, max_gap, conv_mult, step, steps)
+        if done:
+            break
+    return _droplet_items(droplet)
@@ -0,0 +1,295 @@
+import numpy as np
+from math import exp
+from random import random
+from numba import njit
+
+from src.fingerprint import _fingerprint, _set_slot, _set_empty, _set_store, _set_reserve
+from src.lattice import acceptance_table, _log_weight, _random_stabilizer_index, _propose_operator, _commit_operator
+from src.packed_model import code_lattice
+
+
+class Replicas:
+    '''
+    The chains of a parallel tempering ladder as arrays, without a code object per chain. Replica r holds the
+    errors states[r] (compact, see lattice.Lattice), its (x, y, z) lengths, fingerprint, class and flag, and
+    replica[t] is the replica at temperature t (0 is the bottom chain), so swaps only permute replica.
+    Temperature t is sampled with acceptance[t], from log_weights[t] (log of the weight of one x, y and z error),
+    and the top chain also samples logicals with p_logical.
+    '''
+    def __init__(self, init_code, log_weights, p_logical=0):
+        self.lattice = code_lattice(init_code)
+        self.log_weights = np.array(log_weights, dtype=np.float64)
+        self.Nc = self.log_weights.shape[0]
+
+        qubits = self.lattice.compact(init_code.qubit_matrix).astype(np.uint8)
+        self.states = np.tile(qubits, (self.Nc, 1))
+        self.lengths = np.tile(np.array(init_code.chain_lengths(), dtype=np.int64), (self.Nc, 1))
+        self.classes = np.full(self.Nc, init_code.define_equivalence_class(), dtype=np.int64)
+        self.fingerprints = np.tile(_fingerprint(qubits, self.lattice.qubit_keys), (self.Nc, 1))
+        self.replica = np.arange(self.Nc)
+
+        # the top chain starts flagged
+        self.flags = np.zeros(self.Nc, dtype=np.int64)
+        self.flags[-1] = 1
+
+        self.acceptance = np.stack([acceptance_table(lambda dx, dy, dz, lw=lw: np.exp(_log_weight(lw, dx, dy, dz)),
+                                                     self.lattice.max_weight) for lw in self.log_weights])
+        self.p_logical = float(p_logical)
+
+    # errors of the chain at temperature t
+    def qubit_matrix(self, t):
+        return self.lattice.expand(self.states[self.replica[t]])
+
+    def chain_lengths(self, t):
+        return tuple(self.lengths[self.replica[t]])
+
+    def flag(self, t):
+        return int(self.flags[self.replica[t]])
+
+    # iters metropolis steps on every chain and swaps from the top of the ladder, returns the new tops0
+    def step(self, iters, tops0):
+        lattice = self.lattice
+        return _ladder_step(self.states, self.lengths, self.classes, self.fingerprints, self.flags, self.replica,
+                            self.acceptance, self.log_weights, lattice.compact_stabilizer_table,
+                            lattice.stab_fingerprints, lattice.compact_logical_table, lattice.logical_classes,
+                            lattice.logical_fingerprints,
+                            self.p_logical, tops0, int(iters))
+
+
+def parallel_tempering(ladder, iters, steps, TOPS, tops_burn, SEQ, eps, conv_criteria='error_based',
+                       energy_weights=(1, 1, 1), track_shortest=False):
+    '''
+    Runs the main loop of MCMC, MCMC_alpha and MCMC_biased in a single compiled kernel: iters metropolis steps
+    on every chain, swaps from the top of the ladder, burn-in tracking, class counting of the bottom chain and
+    the error based convergence criteria on its energy (energy_weights dot (n_x, n_y, n_z)).
+    Returns a dict with the class counts after burn in, since_burn, the last step and if convergence was reached.
+    With track_shortest the lowest energy of the bottom chain per class, the number of times it was sampled
+    and the number of unique chains with that energy are also returned.
+    '''
+    replicas = ladder.replicas
+    lattice = replicas.lattice
+    result = _parallel_tempering(replicas.states, replicas.lengths, replicas.classes, replicas.fingerprints,
+                                 replicas.flags, replicas.replica, replicas.acceptance, replicas.log_weights,
+                                 lattice.compact_stabilizer_table, lattice.stab_fingerprints,
+                                 lattice.compact_logical_table,
+                                 lattice.logical_classes, lattice.logical_fingerprints, replicas.p_logical,
+                                 lattice.nbr_eq_classes, ladder.tops0, int(iters), int(steps), TOPS, tops_burn, SEQ,
+                                 float(eps), conv_criteria == 'error_based',
+                                 np.asarray(energy_weights, dtype=np.float64), track_shortest)
+    counts, since_burn, step, converged, tops0, shortest, shortest_n, n_unique = result
+    ladder.tops0 = tops0
+    out = {'counts': counts, 'since_burn': since_burn, 'step': step, 'converged': converged}
+    if track_shortest:
+        out.update(shortest=shortest, shortest_n=shortest_n, n_unique=n_unique)
+    return out
+
+
+@njit(cache=True, nogil=True)
+def _parallel_tempering(states, lengths, classes, fingerprints, flags, replica, acceptance, log_weights,
+                        stabilizer_table, stab_fingerprints, logical_table, logical_classes, logical_fingerprints,
+                        p_logical, nbr_eq_classes, tops0, iters, steps, TOPS, tops_burn, SEQ, eps, error_based,
+                        energy_weights, track_shortest):
+    counts = np.zeros(nbr_eq_classes, dtype=np.int64)
+    since_burn = 0
+    resulting_burn_in = 0
+    conv_start = 0
+    conv_streak = 0
+    converged = False
+
+    # lowest energy of the bottom chain in each class, times sampled, and the unique chains with that energy.
+    # The set of seen chains holds generation * nbr_eq_classes + class for each fingerprint,
+    # a new shortest energy starts a new generation
+    shortest = np.full(nbr_eq_classes, np.inf)
+    shortest_n = np.zeros(nbr_eq_classes, dtype=np.int64)
+    n_unique = np.zeros(nbr_eq_classes, dtype=np.int64)
+    generation = np.zeros(nbr_eq_classes, dtype=np.int64)
+    seen_keys = np.zeros((16, 2), dtype=np.uint64)
+    seen_values = np.zeros((16, 1), dtype=np.int64)
+    n_seen = 0
+
+    # error based convergence criteria on the (x, y, z) lengths of the bottom chain after burn in: sums over the
+    # 2nd quarter [q1, q2) and the 4th quarter [q3, l) of the samples, moved along as l grows. Only the samples
+    # from q1 on are ever needed again, they are kept in history (history[0] is sample history_start)
+    history = np.zeros((1024, 3), dtype=np.int32)
+    history_start = 0
+    q1 = q2 = q3 = 0
+    sum_2nd = np.zeros(3, dtype=np.int64)
+    sum_4th = np.zeros(3, dtype=np.int64)
+
+    step = 0
+    for step in range(steps):
+        # metropolis steps on every chain and swaps
+        tops0 = _ladder_step(states, lengths, classes, fingerprints, flags, replica, acceptance, log_weights,
+                             stabilizer_table, stab_fingerprints, logical_table, logical_classes, logical_fingerprints,
+                             p_logical, tops0, iters)
+
+        # sample of the bottom chain
+        bottom = replica[0]
+        current_eq = classes[bottom]
+        if tops0 >= tops_burn:
+            since_burn = step - resulting_burn_in
+            counts[current_eq] += 1
+            energy = (energy_weights[0] * lengths[bottom, 0] + energy_weights[1] * lengths[bottom, 1]
+                      + energy_weights[2] * lengths[bottom, 2])
+
+            if error_based:
+                if since_burn - history_start == history.shape[0]:
+                    history, history_start = _compact_history(history, history_start, q1)
+                history[since_burn - history_start] = lengths[bottom]
+                l = since_burn + 1
+                sum_4th += lengths[bottom]
+                while q3 < 3 * l // 4:
+                    sum_4th -= history[q3 - history_start]
+                    q3 += 1
+                while q2 < l // 2:
+                    sum_2nd += history[q2 - history_start]
+                    q2 += 1
+                while q1 < l // 4:
+                    sum_2nd -= history[q1 - history_start]
+                    q1 += 1
+
+            if track_shortest and energy <= shortest[current_eq]:
+                if energy < shortest[current_eq]:
+                    shortest[current_eq] = energy
+                    shortest_n[current_eq] = 0
+                    n_unique[current_eq] = 0
+                    generation[current_eq] += 1
+                shortest_n[current_eq] += 1
+                value = generation[current_eq] * nbr_eq_classes + current_eq
+                fp0 = fingerprints[bottom, 0]
+                fp1 = fingerprints[bottom, 1]
+                i = _set_slot(seen_keys, fp0, fp1)
+                if _set_empty(seen_keys, i):
+                    seen_keys, seen_values, i = _set_reserve(seen_keys, seen_values, n_seen, fp0, fp1)
+                    _set_store(seen_keys, i, fp0, fp1)
+                    seen_values[i, 0] = -1
+                    n_seen += 1
+                if seen_values[i, 0] != value:
+                    seen_values[i, 0] = value
+                    n_unique[current_eq] += 1
+        else:
+            # number of steps until tops0 = tops_burn
+            resulting_burn_in += 1
+
+        # error based convergence criteria: compare the average energy in the 2nd and 4th quarter
+        if error_based and tops0 >= TOPS:
+            l = since_burn + 1
+            accept = False
+            if q2 > q1:
+                mean_2nd = 0.0
+                mean_4th = 0.0
+                for k in range(3):
+                    mean_2nd += energy_weights[k] * sum_2nd[k]
+                    mean_4th += energy_weights[k] * sum_4th[k]
+                error = abs(mean_2nd / (q2 - q1) - mean_4th / (l - q3))
+                accept = error < eps
+            if accept:
+                if conv_streak >= SEQ:
+                    converged = True
+                    break
+                conv_streak = tops0 - conv_start
+            else:
+                conv_streak = 0
+                conv_start = tops0
+
+    return counts, since_burn, step, converged, tops0, shortest, shortest_n, n_unique
+
+
+@njit(cache=True, nogil=True)
+def _ladder_step(states, lengths, classes, fingerprints, flags, replica, acceptance, log_weights, stabilizer_table,
+                 stab_fingerprints, logical_table, logical_classes, logical_fingerprints, p_logical, tops0, iters):
+    stab_qubits, stab_paulis, stab_cutoff, stab_alias = stabilizer_table
+    logical_qubits, logical_paulis = logical_table
+    Nc = states.shape[0]
+    n = acceptance.shape[1]
+    w = (n - 1) // 2
+    offset = (w * n + w) * n + w
+
+    # metropolis steps on every chain
+    for t in range(Nc):
+        r = replica[t]
+        qubits = states[r]
+        acceptance_flat = acceptance[t].reshape(-1)
+        for _ in range(iters):
+            # the top chain also samples logicals
+            if t == Nc - 1 and p_logical > 0 and random() < p_logical:
+                _logical_move(qubits, lengths[r], fingerprints[r], classes, r, log_weights[t],
+                              logical_qubits, logical_paulis, logical_classes, logical_fingerprints)
+                continue
+            s = _random_stabilizer_index(stab_cutoff, stab_alias)
+            dx, dy, dz = _propose_operator(qubits, s, stab_qubits, stab_paulis)
+            p = acceptance_flat[offset + (dx * n + dy) * n + dz]
+            if p >= 1.0 or random() < p:
+                _commit_operator(qubits, s, stab_qubits, stab_paulis)
+                lengths[r, 0] += dx
+                lengths[r, 1] += dy
+                lengths[r, 2] += dz
+                fingerprints[r, 0] ^= stab_fingerprints[s, 0]
+                fingerprints[r, 1] ^= stab_fingerprints[s, 1]
+
+    # swaps, from the top of the ladder
+    for t in range(Nc - 2, -1, -1):
+        lo = replica[t]
+        hi = replica[t + 1]
+        log_r = 0.0
+        for k in range(3):
+            if lengths[hi, k] != lengths[lo, k]:
+                log_r += (log_weights[t, k] - log_weights[t + 1, k]) * (lengths[hi, k] - lengths[lo, k])
+        if log_r >= 0 or random() < exp(log_r):
+            replica[t] = hi
+            replica[t + 1] = lo
+    flags[replica[Nc - 1]] = 1
+    if flags[replica[0]] == 1:
+        tops0 += 1
+        flags[replica[0]] = 0
+
+    return tops0
+
+
+@njit(cache=True)
+def _logical_move(qubits, lengths, fingerprint, classes, r, log_weights, logical_qubits, logical_paulis,
+                  logical_classes, logical_fingerprints):
+    # applies every logical generator with probability 1/2 and undoes it if the move is rejected
+    chosen = 0
+    dx = dy = dz = 0
+    for k in range(logical_qubits.shape[0]):
+        if random() < 0.5:
+            chosen |= 1 << k
+            ddx, ddy, ddz = _propose_operator(qubits, k, logical_qubits, logical_paulis)
+            _commit_operator(qubits, k, logical_qubits, logical_paulis)
+            dx += ddx
+            dy += ddy
+            dz += ddz
+    log_p = 0.0
+    if dx != 0:
+        log_p += log_weights[0] * dx
+    if dy != 0:
+        log_p += log_weights[1] * dy
+    if dz != 0:
+        log_p += log_weights[2] * dz
+    if log_p >= 0 or random() < exp(log_p):
+        lengths[0] += dx
+        lengths[1] += dy
+        lengths[2] += dz
+        for k in range(logical_qubits.shape[0]):
+            if chosen & (1 << k):
+                classes[r] ^= logical_classes[k]
+                fingerprint[0] ^= logical_fingerprints[k, 0]
+                fingerprint[1] ^= logical_fingerprints[k, 1]
+    else:
+        for k in range(logical_qubits.shape[0]):
+            if chosen & (1 << k):
+                _commit_operator(qubits, k, logical_qubits, logical_paulis)
+
+
+@njit(cache=True)
+def _compact_history(history, history_start, first_needed):
+    # drops the samples before first_needed from a full history, doubles it if that frees less than half
+    drop = first_needed - history_start
+    if 2 * drop >= history.shape[0]:
+        kept = history.shape[0] - drop
+        history[:kept] = history[drop:].copy()
+        return history, first_needed
+    larger = np.zeros((2 * history.shape[0], 3), dtype=history.dtype)
+    larger[:history.shape[0]] = history
+    return larger, history_start
@@ -77,6 +77,9 @@ class Planar_code():
     def apply_stabilizers_uniform(self, p=0.5):
         return _apply_stabilizers_uniform(self.qubit_matrix, p)
 
+    def stabilizer_sites(self):
+        return _stabilizer_sites(self.system_size)
+
     def define_equivalence_class(self):
         return _define_equivalence_class(self.qubit_matrix)
 
@@ -241,70 +244,86 @@ def _apply_random_logical(qubit_matrix):
     return _apply_logical(qubit_matrix, op, X_pos, Z_pos)
 
 
-@njit('(uint8[:,:,:], int64, int64, int64)')
-def _apply_stabilizer(qubit_matrix, row: int, col: int, operator: int):
-    # gives the resulting qubit error matrix from applying (row, col, operator) stabilizer
-    # doesn't update input qubit_matrix
-    size = qubit_matrix.shape[1]
-
+@njit('(int64, int64, int64, int64)')
+def _stabilizer_support(size, row, col, operator):
+    # (layer, row, col) of the qubits acted on by the (row, col, operator) stabilizer
+    # padded to length 4, the first element is the number of qubits in the support
     if operator == 1:
         # Special cases depending on where the stabilizer lives (square/triangle - in the middle/on the boundary)
         if col == 0:
-            qubit_matrix_layers = np.array([0, 0, 1])
-            rows = np.array([row, row + 1, row])
-            cols = np.array([0, 0, 0])
+            return 3, (0, 0, 1, 0), (row, row + 1, row, 0), (0, 0, 0, 0)
         elif col == size - 1:
-            qubit_matrix_layers = np.array([0, 0, 1])
-            rows = np.array([row, row + 1, row])
-            cols = np.array([col, col, col - 1])
+            return 3, (0, 0, 1, 0), (row, row + 1, row, 0), (col, col, col - 1, 0)
         else:
-            qubit_matrix_layers = np.array([0, 0, 1, 1])
-            rows = np.array([row, row + 1, row, row])
-            cols = np.array([col, col, col, col - 1])
-
-    elif operator == 3:
+            return 4, (0, 0, 1, 1), (row, row + 1, row, row), (col, col, col, col - 1)
+    else:
         # Special cases depending on where the stabilizer lives (square/triangle - in the middle/on the boundary)
         if row == 0:
-            qubit_matrix_layers = np.array([0, 0, 1])
-            rows = np.array([0, 0, 0])
-            cols = np.array([col, col + 1, col])
+            return 3, (0, 0, 1, 0), (0, 0, 0, 0), (col, col + 1, col, 0)
         elif row == size - 1:
-            qubit_matrix_layers = np.array([0, 0, 1])
-            rows = np.array([row, row, row - 1])
-            cols = np.array([col, col + 1, col])
+            return 3, (0, 0, 1, 0), (row, row, row - 1, 0), (col, col + 1, col, 0)
         else:
-            qubit_matrix_layers = np.array([0, 0, 1, 1])
-            rows = np.array([row, row, row, row - 1])
-            cols = np.array([col, col + 1, col, col]) 
+            return 4, (0, 0, 1, 1), (row, row, row, row - 1), (col, col + 1, col, col)
 
-    # Have to make copy, else original matrix is changed
-    result_qubit_matrix = np.copy(qubit_matrix)
 
-    # List to store how errors redestribute when stabilizer is applied
-    n_eq = [0, 0, 0, 0]
+@njit('(uint8[:,:,:], int64, int64, int64)')
+def _propose_stabilizer(qubit_matrix, row: int, col: int, operator: int):
+    # change in the number of (x, y, z) errors if the stabilizer was applied
+    # only reads the qubits in the support, qubit_matrix is not changed
+    n, layers, rows, cols = _stabilizer_support(qubit_matrix.shape[1], row, col, operator)
+    dx = dy = dz = 0
+    for i in range(n):
+        old_qubit = qubit_matrix[layers[i], rows[i], cols[i]]
+        new_qubit = old_qubit ^ operator
+        dx += int(new_qubit == 1) - int(old_qubit == 1)
+        dy += int(new_qubit == 2) - int(old_qubit == 2)
+        dz += int(new_qubit == 3) - int(old_qubit == 3)
+    return dx, dy, dz
 
-    for i in range(len(qubit_matrix_layers)):
-        old_qubit = qubit_matrix[qubit_matrix_layers[i], rows[i], cols[i]]
-        new_qubit = operator ^ old_qubit
-        result_qubit_matrix[qubit_matrix_layers[i], rows[i], cols[i]] = new_qubit
 
-        n_eq[old_qubit] -= 1
-        n_eq[new_qubit] += 1
+@njit('(uint8[:,:,:], int64, int64, int64)')
+def _commit_stabilizer(qubit_matrix, row: int, col: int, operator: int):
+    # applies the stabilizer to qubit_matrix in place
+    n, layers, rows, cols = _stabilizer_support(qubit_matrix.shape[1], row, col, operator)
+    for i in range(n):
+        qubit_matrix[layers[i], rows[i], cols[i]] ^= operator
 
-    return result_qubit_matrix, (n_eq[1], n_eq[2], n_eq[3])
 
+@njit('(uint8[:,:,:], int64, int64, int64)')
+def _apply_stabilizer(qubit_matrix, row: int, col: int, operator: int):
+    # gives the resulting qubit error matrix from applying (row, col, operator) stabilizer
+    # doesn't update input qubit_matrix
+    # Have to make copy, else original matrix is changed
+    result_qubit_matrix = np.copy(qubit_matrix)
+    n_eq = _propose_stabilizer(qubit_matrix, row, col, operator)
+    _commit_stabilizer(result_qubit_matrix, row, col, operator)
+    return result_qubit_matrix, n_eq
 
-@njit('(uint8[:,:,:],)')
-def _apply_random_stabilizer(qubit_matrix):
-    size = qubit_matrix.shape[1]
+
+@njit('(int64,)')
+def _random_stabilizer(size):
+    # draws (row, col, operator) of a uniformly random stabilizer
     short_side = int((size - 1) * random())
     long_side = int(size * random())
     if rand.random() < 0.5:
         # operator = 1 = x
-        return _apply_stabilizer(qubit_matrix, short_side, long_side, 1)
+        return short_side, long_side, 1
     else:
         # operator = 3 = z
-        return _apply_stabilizer(qubit_matrix, long_side, short_side, 3)
+        return long_side, short_side, 3
+
+
+@njit('(uint8[:,:,:],)')
+def _apply_random_stabilizer(qubit_matrix):
+    row, col, operator = _random_stabilizer(qubit_matrix.shape[1])
+    return _apply_stabilizer(qubit_matrix, row, col, operator)
+
+
+def _stabilizer_sites(size):
+    # (row, col, operator) of every stabilizer, in groups with the probability _random_stabilizer picks each group
+    x_sites = [(row, col, 1) for row in range(size - 1) for col in range(size)]
+    z_sites = [(row, col, 3) for row in range(size) for col in range(size - 1)]
+    return [(np.array(x_sites), 0.5), (np.array(z_sites), 0.5)]
 
 
 def _apply_stabilizers_uniform(qubit_matrix, p=0.5):
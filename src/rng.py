@@ -0,0 +1,64 @@
+import numpy as np
+import random as rand
+import threading
+from numba import njit
+
+# Counter based random streams. The stream of (run, syndrome, class, droplet, ...) is a 64 bit seed hashed from the
+# run seed and the counters with splitmix64, so every task of a run draws the same numbers whatever process it runs
+# in and in whatever order. Seeding a stream sets all generators the decoders use: np.random (error generators and
+# models), random (python chains) and the random and np.random states of the compiled kernels, which are separate.
+
+_MASK = (1 << 64) - 1
+_GAMMA = 0x9E3779B97F4A7C15
+
+
+def random_seed():
+    # fresh 64 bit run seed from the entropy of the os
+    return int(np.random.SeedSequence().generate_state(1, np.uint64)[0])
+
+
+def stream_seed(run, *counters):
+    # seed of the stream (run, *counters), each counter is absorbed by one round of splitmix64
+    z = _splitmix64(run & _MASK)
+    for counter in counters:
+        z = _splitmix64(z ^ counter)
+    return z
+
+
+def seed_stream(seed):
+    seed_host(seed)
+    seed_kernels(seed)
+
+
+# seeds the stream of a task: all generators in the main thread of a process, and only those of the compiled kernels
+# in other threads (e.g. of a thread pool), np.random and random belong to the main thread. Tasks that may run in
+# threads draw only from the kernels once seeded, or from a np.random.Generator of the seed of their own
+def seed_task(seed):
+    if threading.current_thread() is threading.main_thread():
+        seed_stream(seed)
+    else:
+        seed_kernels(seed)
+
+
+# the generators of the interpreter, shared by all threads
+def seed_host(seed):
+    np.random.seed([seed & 0xFFFFFFFF, seed >> 32])
+    rand.seed(seed)
+
+
+# the generators of the compiled kernels, which have a state per thread: only that of the calling thread is seeded
+def seed_kernels(seed):
+    _seed_kernels((seed ^ (seed >> 32)) & 0xFFFFFFFF)
+
+
+def _splitmix64(z):
+    z = (z + _GAMMA) & _MASK
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & _MASK
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & _MASK
+    return z ^ (z >> 31)
+
+
+@njit(cache=True)
+def _seed_kernels(seed):
+    np.random.seed(seed)
+    rand.seed(seed)
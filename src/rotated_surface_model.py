@@ -91,6 +91,9 @@ class RotSurCode():
     def apply_stabilizers_uniform(self, p=0.5):
         return _apply_stabilizers_uniform(self.qubit_matrix, p)
 
+    def stabilizer_sites(self):
+        return _stabilizer_sites(self.system_size)
+
     def define_equivalence_class(self):
         return _define_equivalence_class(self.qubit_matrix)
     
@@ -295,68 +298,75 @@ def _apply_random_logical(qubit_matrix):
     return _apply_logical(qubit_matrix, op, X_pos, Z_pos)
 
 
-@njit('(uint8[:,:], int64, int64, int64)')
-def _apply_stabilizer(qubit_matrix, row: int, col: int, operator: int):
-
-    size = qubit_matrix.shape[0]
-    result_qubit_matrix = np.copy(qubit_matrix)
-
-    # List to store how errors redestribute when stabilizer is applied
-    n_eq = [0, 0, 0, 0]
-    
-    op = 0
-
+@njit('(int64, int64, int64, int64)')
+def _stabilizer_support(size, row, col, operator):
+    # (row, col, pauli) of the qubits acted on by the (row, col, operator) stabilizer
+    # padded to length 4, the first element is the number of qubits in the support
     if operator == 1:  # full
-        qarray = [[0 + row, 0 + col], [0 + row, 1 + col], [1 + row, 0 + col], [1 + row, 1 + col]]
-        if row % 2 == 0:
-            if col % 2 == 0:
-                op = 1
-            else:
-                op = 3
-        else:
-            if col % 2 == 0:
-                op = 3
-            else:
-                op = 1
-    elif operator == 3:  # half
-        if col == 0:
+        if row % 2 == col % 2:
             op = 1
-            qarray = [[0, row*2 + 1], [0, row*2 + 2]]
-        elif col == 1:
-            op = 3
-            qarray = [[row*2 + 1, size - 1], [row*2 + 2, size - 1]]
-        elif col == 2:
-            op = 1
-            qarray = [[size - 1, row*2], [size - 1, row*2 + 1]]
-        elif col == 3:
+        else:
             op = 3
-            qarray = [[row*2, 0], [row*2 + 1, 0]]
+        return 4, (row, row, row + 1, row + 1), (col, col + 1, col, col + 1), (op, op, op, op)
+    elif col == 0:  # half
+        return 2, (0, 0, 0, 0), (row*2 + 1, row*2 + 2, 0, 0), (1, 1, 0, 0)
+    elif col == 1:
+        return 2, (row*2 + 1, row*2 + 2, 0, 0), (size - 1, size - 1, 0, 0), (3, 3, 0, 0)
+    elif col == 2:
+        return 2, (size - 1, size - 1, 0, 0), (row*2, row*2 + 1, 0, 0), (1, 1, 0, 0)
+    else:
+        return 2, (row*2, row*2 + 1, 0, 0), (0, 0, 0, 0), (3, 3, 0, 0)
 
-    for i in qarray:
-        old_qubit = result_qubit_matrix[i[0], i[1]]
-        new_qubit = op ^ old_qubit
-        result_qubit_matrix[i[0], i[1]] = new_qubit
-        
-        n_eq[old_qubit] -= 1
-        n_eq[new_qubit] += 1
 
-    return result_qubit_matrix, (n_eq[1], n_eq[2], n_eq[3])
+@njit('(uint8[:,:], int64, int64, int64)')
+def _propose_stabilizer(qubit_matrix, row: int, col: int, operator: int):
+    # change in the number of (x, y, z) errors if the stabilizer was applied
+    # only reads the qubits in the support, qubit_matrix is not changed
+    n, rows, cols, opr = _stabilizer_support(qubit_matrix.shape[0], row, col, operator)
+    dx = dy = dz = 0
+    for i in range(n):
+        old_qubit = qubit_matrix[rows[i], cols[i]]
+        new_qubit = opr[i] ^ old_qubit
+        dx += int(new_qubit == 1) - int(old_qubit == 1)
+        dy += int(new_qubit == 2) - int(old_qubit == 2)
+        dz += int(new_qubit == 3) - int(old_qubit == 3)
+    return dx, dy, dz
 
 
-@njit('(uint8[:,:],)')
-def _apply_random_stabilizer(qubit_matrix):
-    size = qubit_matrix.shape[0]
-    rows = int((size-1)*random())
-    cols = int((size-1)*random())
-    rows2 = int(((size - 1)/2) * random())
-    cols2 = int(4 * random())
+@njit('(uint8[:,:], int64, int64, int64)')
+def _commit_stabilizer(qubit_matrix, row: int, col: int, operator: int):
+    # applies the stabilizer to qubit_matrix in place
+    n, rows, cols, opr = _stabilizer_support(qubit_matrix.shape[0], row, col, operator)
+    for i in range(n):
+        qubit_matrix[rows[i], cols[i]] ^= opr[i]
+
+
+@njit('(uint8[:,:], int64, int64, int64)')
+def _apply_stabilizer(qubit_matrix, row: int, col: int, operator: int):
+    # gives the resulting qubit error matrix from applying (row, col, operator) stabilizer
+    # doesn't update input qubit_matrix
+    result_qubit_matrix = np.copy(qubit_matrix)
+    n_eq = _propose_stabilizer(qubit_matrix, row, col, operator)
+    _commit_stabilizer(result_qubit_matrix, row, col, operator)
+    return result_qubit_matrix, n_eq
+
+
+@njit('(int64,)')
+def _random_stabilizer(size):
+    # draws (row, col, operator) of a uniformly random stabilizer
     phalf = (size**2 - (size-1)**2 - 1)/(size**2-1)
     if rand.random() > phalf:
         # operator = 1 = full stabilizer
-        return _apply_stabilizer(qubit_matrix, rows, cols, 1)
+        return int((size-1)*random()), int((size-1)*random()), 1
     else:
         # operator = 3 = half stabilizer
-        return _apply_stabilizer(qubit_matrix, rows2, cols2, 3)
+        return int(((size - 1)/2) * random()), int(4 * random()), 3
+
+
+@njit('(uint8[:,:],)')
+def _apply_random_stabilizer(qubit_matrix):
+    row, col, operator = _random_stabilizer(qubit_matrix.shape[0])
+    return _apply_stabilizer(qubit_matrix, row, col, operator)
 
 
 @njit('(uint8[:,:],)')
@@ -380,6 +390,14 @@ def _define_equivalence_class(qubit_matrix):
             return 2
 
 
+def _stabilizer_sites(size):
+    # (row, col, operator) of every stabilizer, in groups with the probability _random_stabilizer picks each group
+    phalf = (size**2 - (size-1)**2 - 1)/(size**2-1)
+    full_sites = [(row, col, 1) for row in range(size - 1) for col in range(size - 1)]
+    half_sites = [(row, col, 3) for row in range(int((size - 1)/2)) for col in range(4)]
+    return [(np.array(full_sites), 1 - phalf), (np.array(half_sites), phalf)]
+
+
 def _apply_stabilizers_uniform(qubit_matrix, p=0.5):
     size = qubit_matrix.shape[0]
     result_qubit_matrix = np.copy(qubit_matrix)
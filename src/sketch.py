@@ -0,0 +1,142 @@
+import numpy as np
+from numba import njit
+
+from src.fingerprint import _set_capacity, _set_slot, _set_empty, _set_store, _set_reserve, _set_items
+from src.lattice import _update_chain_fast
+from src.packed_model import _update_chain_fast_packed
+
+# HyperLogLog sketches of the number of unique chains in buckets of error counts.
+# Every chain is hashed from its fingerprint to a 64 bit word, whose top precision bits select one of
+# m = 2**precision registers. The register keeps the largest rank (position of the first one bit) seen in the
+# remaining bits. The number of unique chains is estimated from the registers with a relative standard error
+# of 1.04 / sqrt(m) in m bytes, however many chains there are. Registers merge by maximum, so the sketches of
+# droplets run in different processes can be combined.
+
+_MIX = np.array([0xBF58476D1CE4E5B9, 0x94D049BB133111EB, 0x9E3779B97F4A7C15], dtype=np.uint64)
+
+
+class Length_sketches():
+    '''
+    HyperLogLog distinct counts of the unique chains in each bucket of error counts, (n_x + n_y, n_z) with split
+    and (n, 0) otherwise. The buckets are kept in a set with the fingerprint.Fingerprint_set kernels, with the
+    registers of a bucket as its row of values. Used by EWD when the unique chains are too many to store.
+    '''
+    def __init__(self, precision=12, split=False, capacity=64):
+        capacity = _set_capacity(capacity)
+        self.precision = precision
+        self.split = split
+        self.keys = np.zeros((capacity, 2), dtype=np.uint64)
+        self.registers = np.zeros((capacity, 1 << precision), dtype=np.uint8)
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    # relative standard error of the estimated number of chains in a bucket
+    @property
+    def relative_error(self):
+        return 1.04 / np.sqrt(1 << self.precision)
+
+    # merges the (keys, registers) arrays of sketches with the same precision, e.g. returned by a droplet
+    def update(self, keys, registers):
+        assert registers.shape[1] == self.registers.shape[1], 'sketches have to have the same precision'
+        self.keys, self.registers, self.count = _sketch_update(self.keys, self.registers, self.count,
+                                                               np.ascontiguousarray(keys, dtype=np.uint64),
+                                                               np.ascontiguousarray(registers, dtype=np.uint8))
+
+    def merge(self, other):
+        self.update(*other.items())
+
+    # (keys, registers) of all buckets, as compact arrays
+    def items(self):
+        return _set_items(self.keys, self.registers, self.count)
+
+    # buckets (k, 2) and the estimated number of unique chains in each of them (k,)
+    def estimate(self):
+        keys, registers = self.items()
+        buckets = np.stack([keys[:, 0] >> np.uint64(32), keys[:, 0] & np.uint64(0xFFFFFFFF)], axis=1)
+        return buckets.astype(np.int64), _hll_estimate(registers)
+
+
+def _hll_estimate(registers):
+    # HyperLogLog estimate of every row of registers, by linear counting of the empty registers for small counts
+    m = registers.shape[1]
+    alpha = 0.7213 / (1 + 1.079 / m)
+    raw = alpha * m * m / np.exp2(-registers.astype(np.float64)).sum(axis=1)
+    zeros = np.count_nonzero(registers == 0, axis=1)
+    linear = m * np.log(m / np.maximum(zeros, 1))
+    return np.where((raw <= 2.5 * m) & (zeros > 0), linear, raw)
+
+
+@njit(cache=True)
+def _mix64(z):
+    # splitmix64 finalizer, the fingerprints are linear in the errors and are mixed before use as a hash
+    z = (z ^ (z >> np.uint64(30))) * _MIX[0]
+    z = (z ^ (z >> np.uint64(27))) * _MIX[1]
+    return z ^ (z >> np.uint64(31))
+
+
+@njit(cache=True)
+def _sketch_add(keys, registers, count, lengths, fingerprint, split):
+    # adds the chain with (x, y, z) lengths and fingerprint to the sketch of its bucket
+    if split:
+        bucket = (np.uint64(lengths[0] + lengths[1]) << np.uint64(32)) | np.uint64(lengths[2])
+    else:
+        bucket = np.uint64(lengths[0] + lengths[1] + lengths[2]) << np.uint64(32)
+    # second key word spreads consecutive buckets over the slots
+    spread = bucket * _MIX[2]
+    i = _set_slot(keys, bucket, spread)
+    if _set_empty(keys, i):
+        keys, registers, i = _set_reserve(keys, registers, count, bucket, spread)
+        _set_store(keys, i, bucket, spread)
+        count += 1
+
+    precision = np.uint64(np.log2(registers.shape[1]))
+    h = _mix64(fingerprint[0] ^ _mix64(fingerprint[1]))
+    r = np.int64(h >> (np.uint64(64) - precision))
+    rest = h << precision
+    rank = 1
+    while rank <= 64 - np.int64(precision) and rest < np.uint64(0x8000000000000000):
+        rest = rest << np.uint64(1)
+        rank += 1
+    if rank > registers[i, r]:
+        registers[i, r] = rank
+    return keys, registers, count
+
+
+@njit(cache=True)
+def _sketch_update(keys, registers, count, new_keys, new_registers):
+    for k in range(new_keys.shape[0]):
+        i = _set_slot(keys, new_keys[k, 0], new_keys[k, 1])
+        if _set_empty(keys, i):
+            keys, registers, i = _set_reserve(keys, registers, count, new_keys[k, 0], new_keys[k, 1])
+            _set_store(keys, i, new_keys[k, 0], new_keys[k, 1])
+            count += 1
+        for r in range(registers.shape[1]):
+            registers[i, r] = max(registers[i, r], new_registers[k, r])
+    return keys, registers, count
+
+
+@njit(cache=True, nogil=True)
+def _sketch_droplet(qubits, lengths, fingerprint, stab_fingerprints, stabilizer_table, acceptance, steps, iters,
+                    precision, split):
+    # as lattice._ewd_droplet, but every chain seen after a round goes into the sketch of its bucket
+    keys = np.zeros((64, 2), dtype=np.uint64)
+    registers = np.zeros((64, 1 << precision), dtype=np.uint8)
+    count = 0
+    for step in range(steps):
+        _update_chain_fast(qubits, lengths, fingerprint, stab_fingerprints, stabilizer_table, acceptance, iters)
+        keys, registers, count = _sketch_add(keys, registers, count, lengths, fingerprint, split)
+    return _set_items(keys, registers, count)
+
+
+@njit(cache=True, nogil=True)
+def _sketch_droplet_packed(planes, lengths, fingerprint, stab_fingerprints, stabilizer_table, acceptance, steps,
+                           iters, precision, split):
+    keys = np.zeros((64, 2), dtype=np.uint64)
+    registers = np.zeros((64, 1 << precision), dtype=np.uint8)
+    count = 0
+    for step in range(steps):
+        _update_chain_fast_packed(planes, lengths, fingerprint, stab_fingerprints, stabilizer_table, acceptance, iters)
+        keys, registers, count = _sketch_add(keys, registers, count, lengths, fingerprint, split)
+    return _set_items(keys, registers, count)
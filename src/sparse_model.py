@@ -0,0 +1,313 @@
+import numpy as np
+from random import random
+from numba import njit
+
+from src.fingerprint import zobrist_keys
+from src.lattice import lattice_table, _random_stabilizer_index, _droplet_state, _droplet_record, _droplet_items, _update_chain_fast
+
+
+class Sparse_code():
+    '''
+    Sparse representation of any of the code models, for chains with few errors. The support of the errors is
+    an open addressing table of (qubit, pauli) entries: slots[i] is a qubit (position in qubit_matrix.ravel(), -1 if
+    the slot is empty) and paulis[i] its error, found by linear probing from qubit & (capacity - 1). Applying an
+    operator, counting the errors, the class and the fingerprint then cost the size of the support, not of the lattice.
+    Past max_support errors the dense models are faster, and the chains switch to them.
+    '''
+    def __init__(self, code, max_support=None):
+        self.code_class = type(code)
+        self.system_size = code.system_size
+        self.nbr_eq_classes = code.nbr_eq_classes
+        self.lattice = lattice_table(code)
+        self.max_support = max_support or max(16, self.lattice.n_cells // 8)
+        self.qubit_matrix = code.qubit_matrix
+
+    # array replaced whenever the errors are, see packed_model.code_state
+    @property
+    def state(self):
+        return self.slots
+
+    # dense view of the errors, as used by the code models
+    @property
+    def qubit_matrix(self):
+        return _sparse_to_dense(self.slots, self.paulis, self.lattice.n_cells).reshape(self.lattice.shape)
+
+    @qubit_matrix.setter
+    def qubit_matrix(self, qubit_matrix):
+        self.slots, self.paulis, self.count = _dense_to_sparse(np.ascontiguousarray(qubit_matrix).reshape(-1))
+
+    # dense code model with the same errors (or the errors of a flattened qubit_matrix qubits)
+    def dense_code(self, qubits=None):
+        code = self.code_class(self.system_size)
+        code.qubit_matrix = self.qubit_matrix if qubits is None else qubits.reshape(self.lattice.shape)
+        return code
+
+    # the code holding the state returned by a kernel: this code with the new support, or a dense code if the
+    # kernel switched to the dense flattened qubit_matrix qubits or the support has grown past max_support
+    def replace_state(self, slots, paulis, count, qubits=None):
+        if qubits is not None and qubits.shape[0] > 0:
+            return self.dense_code(qubits)
+        self.slots, self.paulis, self.count = slots, paulis, count
+        if count > self.max_support:
+            return self.dense_code()
+        return self
+
+    def chain_lengths(self):
+        return _sparse_lengths(self.slots, self.paulis)
+
+    def count_errors(self):
+        return self.count
+
+    def define_equivalence_class(self):
+        return _sparse_class(self.slots, self.paulis, self.lattice.eq_x, self.lattice.eq_z)
+
+    def fingerprint(self):
+        return _sparse_fingerprint(self.slots, self.paulis, zobrist_keys(self.lattice.shape))
+
+    # like the dense models these return a new dense qubit_matrix and the change in the number of (x, y, z) errors
+    def apply_stabilizer(self, index: int):
+        stab_qubits, stab_paulis = self.lattice.stab_qubits, self.lattice.stab_paulis
+        n_eq = _propose_operator(self.slots, self.paulis, index, stab_qubits, stab_paulis)
+        slots, paulis, _ = _commit_operator(self.slots.copy(), self.paulis.copy(), self.count, index,
+                                            stab_qubits, stab_paulis)
+        return _sparse_to_dense(slots, paulis, self.lattice.n_cells).reshape(self.lattice.shape), n_eq
+
+    def apply_random_stabilizer(self):
+        index = _random_stabilizer_index(self.lattice.stab_cutoff, self.lattice.stab_alias)
+        return self.apply_stabilizer(index)
+
+    def apply_random_logical(self):
+        slots, paulis, _, n_eq = _apply_random_logical(self.slots.copy(), self.paulis.copy(), self.count,
+                                                       *self.lattice.logical_table)
+        return _sparse_to_dense(slots, paulis, self.lattice.n_cells).reshape(self.lattice.shape), n_eq
+
+    # uniform stabilizers and class changes are applied through the dense model
+
+    def apply_stabilizers_uniform(self, p=0.5):
+        return self.dense_code().apply_stabilizers_uniform(p)
+
+    def to_class(self, eq):
+        return self.dense_code().to_class(eq)
+
+
+@njit(cache=True)
+def _sparse_capacity(count):
+    # table at most half full
+    capacity = 16
+    while capacity < 2 * count:
+        capacity *= 2
+    return capacity
+
+
+@njit(cache=True)
+def _dense_to_sparse(qubits):
+    count = 0
+    for q in range(qubits.shape[0]):
+        if qubits[q] != 0:
+            count += 1
+    slots = np.full(_sparse_capacity(count + 1), -1, dtype=np.int64)
+    paulis = np.zeros(slots.shape[0], dtype=np.uint8)
+    for q in range(qubits.shape[0]):
+        if qubits[q] != 0:
+            i = _sparse_slot(slots, q)
+            slots[i] = q
+            paulis[i] = qubits[q]
+    return slots, paulis, count
+
+
+@njit(cache=True)
+def _sparse_to_dense(slots, paulis, n_cells):
+    qubits = np.zeros(n_cells, dtype=np.uint8)
+    for i in range(slots.shape[0]):
+        if slots[i] >= 0:
+            qubits[slots[i]] = paulis[i]
+    return qubits
+
+
+@njit(cache=True)
+def _sparse_slot(slots, q):
+    # slot holding qubit q, or the empty slot where it should be inserted
+    mask = slots.shape[0] - 1
+    i = q & mask
+    while slots[i] != q and slots[i] != -1:
+        i = (i + 1) & mask
+    return i
+
+
+@njit(cache=True)
+def _sparse_get(slots, paulis, q):
+    i = _sparse_slot(slots, q)
+    if slots[i] == q:
+        return paulis[i]
+    return np.uint8(0)
+
+
+@njit(cache=True)
+def _sparse_delete(slots, paulis, i):
+    # empties slot i and shifts back the entries after it that would no longer be found (no tombstones)
+    mask = slots.shape[0] - 1
+    j = i
+    while True:
+        j = (j + 1) & mask
+        if slots[j] == -1:
+            break
+        home = slots[j] & mask
+        # the entry in j can fill i unless its home slot lies cyclically in (i, j]
+        if (i < j and (home <= i or home > j)) or (j < i and home <= i and home > j):
+            slots[i] = slots[j]
+            paulis[i] = paulis[j]
+            i = j
+    slots[i] = -1
+    paulis[i] = 0
+
+
+@njit(cache=True)
+def _sparse_xor(slots, paulis, count, q, op):
+    # applies pauli op to qubit q, the entry is removed when the qubit is left without error
+    i = _sparse_slot(slots, q)
+    if slots[i] == q:
+        paulis[i] ^= op
+        if paulis[i] == 0:
+            _sparse_delete(slots, paulis, i)
+            count -= 1
+    elif op != 0:
+        if 2 * (count + 1) > slots.shape[0]:
+            new_slots = np.full(2 * slots.shape[0], -1, dtype=np.int64)
+            new_paulis = np.zeros(new_slots.shape[0], dtype=np.uint8)
+            for k in range(slots.shape[0]):
+                if slots[k] >= 0:
+                    j = _sparse_slot(new_slots, slots[k])
+                    new_slots[j] = slots[k]
+                    new_paulis[j] = paulis[k]
+            slots = new_slots
+            paulis = new_paulis
+            i = _sparse_slot(slots, q)
+        slots[i] = q
+        paulis[i] = op
+        count += 1
+    return slots, paulis, count
+
+
+@njit(cache=True)
+def _sparse_lengths(slots, paulis):
+    nx = ny = nz = 0
+    for i in range(slots.shape[0]):
+        if slots[i] >= 0:
+            nx += paulis[i] == 1
+            ny += paulis[i] == 2
+            nz += paulis[i] == 3
+    return nx, ny, nz
+
+
+@njit(cache=True)
+def _sparse_class(slots, paulis, eq_x, eq_z):
+    # the class is the xor of the contributions of the x and z parts of every error (see lattice.Lattice)
+    eq = 0
+    for i in range(slots.shape[0]):
+        if slots[i] >= 0:
+            if paulis[i] == 1 or paulis[i] == 2:
+                eq ^= eq_x[slots[i]]
+            if paulis[i] == 2 or paulis[i] == 3:
+                eq ^= eq_z[slots[i]]
+    return eq
+
+
+@njit(cache=True)
+def _sparse_fingerprint(slots, paulis, keys):
+    fp = np.zeros(2, dtype=np.uint64)
+    for i in range(slots.shape[0]):
+        if slots[i] >= 0:
+            fp[0] ^= keys[slots[i], paulis[i], 0]
+            fp[1] ^= keys[slots[i], paulis[i], 1]
+    return fp
+
+
+@njit(cache=True)
+def _propose_operator(slots, paulis, k, op_qubits, op_paulis):
+    # change in the number of (x, y, z) errors if operator k of the table was applied, the support is not changed
+    dx = dy = dz = 0
+    for i in range(op_qubits.shape[1]):
+        old_qubit = _sparse_get(slots, paulis, op_qubits[k, i])
+        new_qubit = old_qubit ^ op_paulis[k, i]
+        dx += int(new_qubit == 1) - int(old_qubit == 1)
+        dy += int(new_qubit == 2) - int(old_qubit == 2)
+        dz += int(new_qubit == 3) - int(old_qubit == 3)
+    return dx, dy, dz
+
+
+@njit(cache=True)
+def _commit_operator(slots, paulis, count, k, op_qubits, op_paulis):
+    # applies operator k of the table to the support, padding entries are identities and change nothing
+    for i in range(op_qubits.shape[1]):
+        slots, paulis, count = _sparse_xor(slots, paulis, count, op_qubits[k, i], op_paulis[k, i])
+    return slots, paulis, count
+
+
+@njit(cache=True)
+def _apply_random_logical(slots, paulis, count, logical_qubits, logical_paulis):
+    # applies every logical generator with probability 1/2
+    dx = dy = dz = 0
+    for k in range(logical_qubits.shape[0]):
+        if random() < 0.5:
+            ddx, ddy, ddz = _propose_operator(slots, paulis, k, logical_qubits, logical_paulis)
+            slots, paulis, count = _commit_operator(slots, paulis, count, k, logical_qubits, logical_paulis)
+            dx += ddx
+            dy += ddy
+            dz += ddz
+    return slots, paulis, count, (dx, dy, dz)
+
+
+@njit(cache=True, nogil=True)
+def _update_chain_fast_sparse(slots, paulis, count, lengths, fingerprint, stab_fingerprints, stabilizer_table,
+                              acceptance, iters):
+    # metropolis updates with the acceptance probabilities from lattice.acceptance_table
+    stab_qubits, stab_paulis, stab_cutoff, stab_alias = stabilizer_table
+    n = acceptance.shape[0]
+    w = (n - 1) // 2
+    offset = (w * n + w) * n + w
+    acceptance_flat = acceptance.reshape(-1)
+    for _ in range(iters):
+        s = _random_stabilizer_index(stab_cutoff, stab_alias)
+        dx, dy, dz = _propose_operator(slots, paulis, s, stab_qubits, stab_paulis)
+
+        p = acceptance_flat[offset + (dx * n + dy) * n + dz]
+        if p >= 1.0 or random() < p:
+            slots, paulis, count = _commit_operator(slots, paulis, count, s, stab_qubits, stab_paulis)
+            lengths[0] += dx
+            lengths[1] += dy
+            lengths[2] += dz
+            fingerprint[0] ^= stab_fingerprints[s, 0]
+            fingerprint[1] ^= stab_fingerprints[s, 1]
+    return slots, paulis, count
+
+
+@njit(cache=True, nogil=True)
+def _ewd_droplet_sparse(slots, paulis, count, max_support, n_cells, lengths, fingerprint, stab_fingerprints,
+                        stabilizer_table, acceptance, steps, iters, conv_mult, log_weights, max_gap):
+    # same as lattice._ewd_droplet on a sparse support. Sampling moves to a dense qubit_matrix when the support
+    # grows past max_support and back when it falls below half of that, qubits is returned empty if the
+    # final state is sparse
+    qubits = np.zeros(0, dtype=np.uint8)
+    dense = False
+    droplet = _droplet_state(steps)
+    for step in range(steps):
+        if dense:
+            _update_chain_fast(qubits, lengths, fingerprint, stab_fingerprints, stabilizer_table, acceptance, iters)
+            if 2 * (lengths[0] + lengths[1] + lengths[2]) < max_support:
+                slots, paulis, count = _dense_to_sparse(qubits)
+                dense = False
+        else:
+            slots, paulis, count = _update_chain_fast_sparse(slots, paulis, count, lengths, fingerprint,
+                                                             stab_fingerprints, stabilizer_table, acceptance, iters)
+            if count > max_support:
+                qubits = _sparse_to_dense(slots, paulis, n_cells)
+                dense = True
+
+        droplet, done = _droplet_record(droplet, lengths, fingerprint, log_weights, max_gap, conv_mult, step, steps)
+        if done:
+            break
+
+    if not dense:
+        qubits = np.zeros(0, dtype=np.uint8)
+    fingerprints, chain_lengths, skipped = _droplet_items(droplet)
+    return fingerprints, chain_lengths, skipped, slots, paulis, count, qubits
@@ -63,6 +63,9 @@ class Toric_code():
     def apply_stabilizers_uniform(self, p=0.5):
         return _apply_stabilizers_uniform(self.qubit_matrix, p)
 
+    def stabilizer_sites(self):
+        return _stabilizer_sites(self.system_size)
+
     def define_equivalence_class(self):
         return _define_equivalence_class(self.qubit_matrix)
 
@@ -247,7 +250,7 @@ def _apply_random_logical(qubit_matrix):
 
     # ok to not copy, since apply_logical doesnt change input
     result_qubit_matrix = qubit_matrix
-    result_error_change = 0
+    dx = dy = dz = 0
 
     for layer, op in enumerate(operators):
         if op == 1 or op == 2:
@@ -259,56 +262,80 @@ def _apply_random_logical(qubit_matrix):
         else:
             Z_pos = 0
 
-        result_qubit_matrix, error_change = _apply_logical(result_qubit_matrix, op, layer, X_pos, Z_pos)
-        result_error_change += error_change[0] + error_change[1] + error_change[2]
+        result_qubit_matrix, (ddx, ddy, ddz) = _apply_logical(result_qubit_matrix, op, layer, X_pos, Z_pos)
+        dx += ddx
+        dy += ddy
+        dz += ddz
 
-    return result_qubit_matrix, result_error_change
+    return result_qubit_matrix, (dx, dy, dz)
 
 
-@njit('(uint8[:,:,:], int64, int64, int64)')
-def _apply_stabilizer(qubit_matrix, row: int, col: int, operator: int):
-    # gives the resulting qubit error matrix from applying (row, col, operator) stabilizer
-    # doesn't update input qubit_matrix
-    size = qubit_matrix.shape[1]
+@njit('(int64, int64, int64, int64)')
+def _stabilizer_support(size, row, col, operator):
+    # (layer, row, col) of the four qubits acted on by the (row, col, operator) stabilizer
     if operator == 1:
-        qubit_matrix_layers = np.array([1, 1, 0, 0])
-        rows = np.array([row, row, row, (row - 1) % size])
-        cols = np.array([col, (col - 1) % size, col, col])
+        return (1, 1, 0, 0), (row, row, row, (row - 1) % size), (col, (col - 1) % size, col, col)
+    else:
+        return (1, 0, 0, 1), (row, row, row, (row + 1) % size), (col, col, (col + 1) % size, col)
 
-    elif operator == 3:
-        qubit_matrix_layers = np.array([1, 0, 0, 1])
-        rows = np.array([row, row, row, (row + 1) % size])
-        cols = np.array([col, col, (col + 1) % size, col])
-
-    # Have to make copy, else original matrix is changed
-    result_qubit_matrix = np.copy(qubit_matrix)
-    
-    # List to store how errors redestribute when stabilizer is applied
-    n_eq = [0, 0, 0, 0]
 
+@njit('(uint8[:,:,:], int64, int64, int64)')
+def _propose_stabilizer(qubit_matrix, row: int, col: int, operator: int):
+    # change in the number of (x, y, z) errors if the stabilizer was applied
+    # only reads the qubits in the support, qubit_matrix is not changed
+    layers, rows, cols = _stabilizer_support(qubit_matrix.shape[1], row, col, operator)
+    dx = dy = dz = 0
     for i in range(4):
-        old_qubit = qubit_matrix[qubit_matrix_layers[i], rows[i], cols[i]]
+        old_qubit = qubit_matrix[layers[i], rows[i], cols[i]]
         new_qubit = old_qubit ^ operator
-        result_qubit_matrix[qubit_matrix_layers[i], rows[i], cols[i]] = new_qubit
+        dx += int(new_qubit == 1) - int(old_qubit == 1)
+        dy += int(new_qubit == 2) - int(old_qubit == 2)
+        dz += int(new_qubit == 3) - int(old_qubit == 3)
+    return dx, dy, dz
 
-        n_eq[old_qubit] -= 1
-        n_eq[new_qubit] += 1
 
-    return result_qubit_matrix, (n_eq[1], n_eq[2], n_eq[3])
+@njit('(uint8[:,:,:], int64, int64, int64)')
+def _commit_stabilizer(qubit_matrix, row: int, col: int, operator: int):
+    # applies the stabilizer to qubit_matrix in place
+    layers, rows, cols = _stabilizer_support(qubit_matrix.shape[1], row, col, operator)
+    for i in range(4):
+        qubit_matrix[layers[i], rows[i], cols[i]] ^= operator
 
 
-@njit('(uint8[:,:,:],)')
-def _apply_random_stabilizer(qubit_matrix):
+@njit('(uint8[:,:,:], int64, int64, int64)')
+def _apply_stabilizer(qubit_matrix, row: int, col: int, operator: int):
+    # gives the resulting qubit error matrix from applying (row, col, operator) stabilizer
+    # doesn't update input qubit_matrix
+    # Have to make copy, else original matrix is changed
+    result_qubit_matrix = np.copy(qubit_matrix)
+    n_eq = _propose_stabilizer(qubit_matrix, row, col, operator)
+    _commit_stabilizer(result_qubit_matrix, row, col, operator)
+    return result_qubit_matrix, n_eq
+
+
+@njit('(int64,)')
+def _random_stabilizer(size):
     # select random coordinates where to apply operator
-    size = qubit_matrix.shape[1]
     row = int(random() * size)
     col = int(random() * size)
     operator = int(random() * 2)  # we only care about X and Z, and Y is represented by 2. Therefore:
     if operator == 0:
         operator = 3
+    return row, col, operator
+
+
+@njit('(uint8[:,:,:],)')
+def _apply_random_stabilizer(qubit_matrix):
+    row, col, operator = _random_stabilizer(qubit_matrix.shape[1])
     return _apply_stabilizer(qubit_matrix, row, col, operator)
 
 
+def _stabilizer_sites(size):
+    # (row, col, operator) of every stabilizer, in groups with the probability _random_stabilizer picks each group
+    sites = [(row, col, operator) for operator in (1, 3) for row in range(size) for col in range(size)]
+    return [(np.array(sites), 1.0)]
+
+
 def _apply_stabilizers_uniform(qubit_matrix, p=0.5):
     size = qubit_matrix.shape[1]
     result_qubit_matrix = np.copy(qubit_matrix)
@@ -53,6 +53,9 @@ class xyz_code():
     def apply_stabilizers_uniform(self, p=0.5):
         return _apply_stabilizers_uniform(self.qubit_matrix, p)
 
+    def stabilizer_sites(self):
+        return _stabilizer_sites(self.system_size)
+
     def to_class(self, eq):
         eq_class = self.define_equivalence_class()
         op = eq_class ^ eq
@@ -163,104 +166,86 @@ def _apply_logical(qubit_matrix, operator: int, X_pos=0, Z_pos=0):
     return result_qubit_matrix, (n_eq[1], n_eq[2], n_eq[3])
 
 
-@njit('(uint8[:,:], int64, int64, int64)')
-def _apply_stabilizer(qubit_matrix, row: int, col: int, operator: int):
-
-    size = qubit_matrix.shape[1]
-    result_qubit_matrix = np.copy(qubit_matrix)
-    n_eq = [0, 0, 0, 0]
-
+@njit('(int64, int64, int64, int64)')
+def _stabilizer_support(size, row, col, operator):
+    # (row, col, pauli) of the qubits acted on by the (row, col, operator) stabilizer
+    # padded to length 6, the first element is the number of qubits in the support
     if operator == 1:
-        qarray = [[2*row, col], [2*row + 1, col + 1], [2*row + 2, col + 1], [2*row + 3, col + 1], [2*row + 2, col], [2*row + 1, col]]
-        opr = [2, 3, 1, 2, 3, 1]
-        j = 0
-        for i in qarray:
-            old_qubit = result_qubit_matrix[i[0], i[1]]
-            new_qubit = opr[j] ^ old_qubit
-            j += 1
-            result_qubit_matrix[i[0], i[1]] = new_qubit
-            n_eq[old_qubit] -= 1
-            n_eq[new_qubit] += 1
-    if operator == 2:
+        return 6, (2*row, 2*row + 1, 2*row + 2, 2*row + 3, 2*row + 2, 2*row + 1), \
+            (col, col + 1, col + 1, col + 1, col, col), (2, 3, 1, 2, 3, 1)
+    elif operator == 2:
         if col == 0:
-            qarray = [[0, 2*row + 1], [1, 2*row + 2], [0, 2*row + 2]]
-            opr = [3, 2, 1]
-            j = 0
-            for i in qarray:
-                old_qubit = result_qubit_matrix[i[0], i[1]]
-                new_qubit = opr[j] ^ old_qubit
-                j += 1
-                result_qubit_matrix[i[0], i[1]] = new_qubit
-                n_eq[old_qubit] -= 1
-                n_eq[new_qubit] += 1
+            return 3, (0, 1, 0, 0, 0, 0), (2*row + 1, 2*row + 2, 2*row + 2, 0, 0, 0), (3, 2, 1, 0, 0, 0)
         elif col == 1:
-            qarray = [[4*row + 2, size - 1], [4*row + 3, size - 1], [4*row + 4, size - 1]]
-            opr = [2, 1, 3]
-            j = 0
-            for i in qarray:
-                old_qubit = result_qubit_matrix[i[0], i[1]]
-                new_qubit = opr[j] ^ old_qubit
-                j += 1
-                result_qubit_matrix[i[0], i[1]] = new_qubit
-                n_eq[old_qubit] -= 1
-                n_eq[new_qubit] += 1
+            return 3, (4*row + 2, 4*row + 3, 4*row + 4, 0, 0, 0), (size - 1, size - 1, size - 1, 0, 0, 0), (2, 1, 3, 0, 0, 0)
         elif col == 2:
-            qarray = [[2*size - 1, 2*row], [2*size - 2, 2*row], [2*size - 1, 2*row + 1]]
-            opr = [1, 2, 3]
-            j = 0
-            for i in qarray:
-                old_qubit = result_qubit_matrix[i[0], i[1]]
-                new_qubit = opr[j] ^ old_qubit
-                j += 1
-                result_qubit_matrix[i[0], i[1]] = new_qubit
-                n_eq[old_qubit] -= 1
-                n_eq[new_qubit] += 1
-        elif col == 3:
-            qarray = [[4*row + 1, 0], [4*row + 2, 0], [4*row + 3, 0]]
-            opr = [3, 1, 2]
-            j = 0
-            for i in qarray:
-                old_qubit = result_qubit_matrix[i[0], i[1]]
-                new_qubit = opr[j] ^ old_qubit
-                j += 1
-                result_qubit_matrix[i[0], i[1]] = new_qubit
-                n_eq[old_qubit] -= 1
-                n_eq[new_qubit] += 1
-    if operator == 3:
-        qarray = [[2*row, col], [1 + 2*row, col]]
-        opr = [3, 3]
-        j = 0
-        for i in qarray:
-            old_qubit = result_qubit_matrix[i[0], i[1]]
-            new_qubit = opr[j] ^ old_qubit
-            j += 1
-            result_qubit_matrix[i[0], i[1]] = new_qubit
-            n_eq[old_qubit] -= 1
-            n_eq[new_qubit] += 1
+            return 3, (2*size - 1, 2*size - 2, 2*size - 1, 0, 0, 0), (2*row, 2*row, 2*row + 1, 0, 0, 0), (1, 2, 3, 0, 0, 0)
+        else:
+            return 3, (4*row + 1, 4*row + 2, 4*row + 3, 0, 0, 0), (0, 0, 0, 0, 0, 0), (3, 1, 2, 0, 0, 0)
+    else:
+        return 2, (2*row, 1 + 2*row, 0, 0, 0, 0), (col, col, 0, 0, 0, 0), (3, 3, 0, 0, 0, 0)
 
-    return result_qubit_matrix, (n_eq[1], n_eq[2], n_eq[3])
 
+@njit('(uint8[:,:], int64, int64, int64)')
+def _propose_stabilizer(qubit_matrix, row: int, col: int, operator: int):
+    # change in the number of (x, y, z) errors if the stabilizer was applied
+    # only reads the qubits in the support, qubit_matrix is not changed
+    n, rows, cols, opr = _stabilizer_support(qubit_matrix.shape[1], row, col, operator)
+    dx = dy = dz = 0
+    for i in range(n):
+        old_qubit = qubit_matrix[rows[i], cols[i]]
+        new_qubit = opr[i] ^ old_qubit
+        dx += int(new_qubit == 1) - int(old_qubit == 1)
+        dy += int(new_qubit == 2) - int(old_qubit == 2)
+        dz += int(new_qubit == 3) - int(old_qubit == 3)
+    return dx, dy, dz
 
-@njit('(uint8[:,:],)')
-def _apply_random_stabilizer(qubit_matrix):
-    size = qubit_matrix.shape[1]
-    rows1 = int((size-1)*random())
-    cols1 = int((size-1)*random())
-    rows2 = int(((size - 1)/2) * random())
-    cols2 = int(4 * random())
-    rows3 = int(size * random())
-    cols3 = int(size * random())
+
+@njit('(uint8[:,:], int64, int64, int64)')
+def _commit_stabilizer(qubit_matrix, row: int, col: int, operator: int):
+    # applies the stabilizer to qubit_matrix in place
+    n, rows, cols, opr = _stabilizer_support(qubit_matrix.shape[1], row, col, operator)
+    for i in range(n):
+        qubit_matrix[rows[i], cols[i]] ^= opr[i]
+
+
+@njit('(uint8[:,:], int64, int64, int64)')
+def _apply_stabilizer(qubit_matrix, row: int, col: int, operator: int):
+    result_qubit_matrix = np.copy(qubit_matrix)
+    n_eq = _propose_stabilizer(qubit_matrix, row, col, operator)
+    _commit_stabilizer(result_qubit_matrix, row, col, operator)
+    return result_qubit_matrix, n_eq
+
+
+@njit('(int64,)')
+def _random_stabilizer(size):
+    # draws (row, col, operator) of a random stabilizer
     phalf = (size**2 - (size-1)**2 - 1)/(size**2-1)
     if rand.random() > 0.5:
         if rand.random() > phalf:
             # operator = 1 = full (xyzxyz) stabilizer
-            return _apply_stabilizer(qubit_matrix, rows1, cols1, 1)
+            return int((size-1)*random()), int((size-1)*random()), 1
         else:
             # operator = 2 = half (xyz) stabilizer
-            return _apply_stabilizer(qubit_matrix, rows2, cols2, 2)
+            return int(((size - 1)/2) * random()), int(4 * random()), 2
     else:
         # operator = 3 = (zz) stabilizer
-        return _apply_stabilizer(qubit_matrix, rows3, cols3, 3)
+        return int(size * random()), int(size * random()), 3
+
+
+@njit('(uint8[:,:],)')
+def _apply_random_stabilizer(qubit_matrix):
+    row, col, operator = _random_stabilizer(qubit_matrix.shape[1])
+    return _apply_stabilizer(qubit_matrix, row, col, operator)
+
+
+def _stabilizer_sites(size):
+    # (row, col, operator) of every stabilizer, in groups with the probability _random_stabilizer picks each group
+    phalf = (size**2 - (size-1)**2 - 1)/(size**2-1)
+    full_sites = [(row, col, 1) for row in range(size - 1) for col in range(size - 1)]
+    half_sites = [(row, col, 2) for row in range(int((size - 1)/2)) for col in range(4)]
+    link_sites = [(row, col, 3) for row in range(size) for col in range(size)]
+    return [(np.array(full_sites), 0.5 * (1 - phalf)), (np.array(half_sites), 0.5 * phalf), (np.array(link_sites), 0.5)]
 
 
 def _apply_stabilizers_uniform(qubit_matrix, p=0.5):
@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+
+from decoders import DecoderSession
+from generate_data import _generate_points
+
+
+PARAMS = {'code': 'planar', 'size': 5, 'noise': 'depolarizing', 'p_error': 0.1, 'eta': 0.5, 'alpha': 1,
+          'p_sampling': 0.1, 'droplets': 2, 'mwpm_init': False, 'onlyshortest': False, 'steps': 500,
+          'conv_criteria': 'error_based', 'SEQ': 2, 'TOPS': 10, 'eps': 0.01, 'iters': 10, 'Nc': None, 'seed': 7}
+
+
+def _points(params, session=None, workers=None):
+    return list(_generate_points(params, 4, session, workers))
+
+
+def _assert_same(points, reference):
+    for (qubits, distr, failed), (ref_qubits, ref_distr, ref_failed) in zip(points, reference):
+        assert np.array_equal(qubits, ref_qubits)
+        assert np.array_equal(distr, ref_distr)
+        assert failed == ref_failed
+
+
+@pytest.mark.parametrize('method', ['EWD', 'MCMC'])
+@pytest.mark.parametrize('backend', ['thread', 'process'])
+def test_workers_match_serial(method, backend):
+    # the data of a run does not depend on the workers, nor on the threads, that generate its points
+    params = dict(PARAMS, method=method)
+    reference = _points(params)
+    with DecoderSession(2, backend=backend) as session:
+        _assert_same(_points(params, session, workers=2), reference)